@@ -0,0 +1,574 @@
+# !/usr/bin/python
+
+'''
+A local stand-in for the parts of the XNAT REST API used by SpredNonDicomUpload.py, so that the upload can be measured (see SpredUploadBenchmark.py) without a SPReD server.  Everything is kept in memory; uploaded files are only kept as their size and MD5 digest.  Latency, a bandwidth cap shared by all connections, and random errors can be added to mimic a slow or unreliable link.
+
+Run it with: python SpredMockServer.py --port 8765, then point base_url in init_project_constants() to http://127.0.0.1:8765/data/archive/projects/
+'''
+
+import argparse
+import BaseHTTPServer
+import cgi
+import hashlib
+import io
+import json
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import xml.etree.ElementTree as ET
+
+
+class MockXnatHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''Handles the XNAT REST calls made by the upload script against the archive of a MockXnatServer.'''
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_DELETE(self):
+
+		self.handle_mock_request(delete_mock_node)
+
+	def do_GET(self):
+
+		self.handle_mock_request(get_mock_node)
+
+	def do_POST(self):
+
+		self.handle_mock_request(post_mock_files)
+
+	def do_PUT(self):
+
+		self.handle_mock_request(put_mock_node)
+
+	def handle_mock_request(self, handler):
+		'''
+		Summary:
+			Adds the configured latency, counts the request, injects an error if one is due, then passes the request to a handler function.
+		Args:
+			handler: A function taking the server, the request handler, the parsed url and the request body chunks, and returning an HTTP status code and a JSON serializable response (or None).
+		'''
+
+		server = self.server
+		settings = server.settings
+
+		if settings['latency_secs']:
+			time.sleep(settings['latency_secs'])
+
+		with server.lock:
+			server.stats['requests'] += 1
+			server.stats[self.command.lower()] = server.stats.get(self.command.lower(), 0) + 1
+
+		url = urlparse.urlparse(self.path)
+
+		if url.path.endswith('/_mock/stats'):
+			if self.command == 'DELETE':
+				reset_mock_stats(server)
+			return self.send_json(200, server.stats)
+
+		body_chunks = read_body_chunks(self)
+
+		if self.command in settings['error_methods'] and random.random() < settings['error_rate']:
+			# Read the body anyway, so the connection can be reused.
+			for chunk in body_chunks:
+				pass
+			with server.lock:
+				server.stats['errors_injected'] += 1
+			return self.send_json(settings['error_status'], None)
+
+		status, response = handler(server, self, url, body_chunks)
+
+		for chunk in body_chunks:
+			pass
+
+		self.send_json(status, response)
+
+	def log_message(self, format, *args):
+
+		if self.server.settings['verbose']:
+			BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+	def send_json(self, status, response):
+
+		body = json.dumps(response) if response is not None else ''
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class MockXnatServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''A threaded HTTP server holding the in-memory archive, the settings and the request statistics of the mock.'''
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, settings):
+
+		BaseHTTPServer.HTTPServer.__init__(self, address, MockXnatHandler)
+		self.settings = settings
+		self.lock = threading.Lock()
+		self.link_lock = threading.Lock()
+		self.link_free_at = 0.0
+		self.projects = {}
+		reset_mock_stats(self)
+
+
+def create_mock_node(parent, collection, node_id):
+	'''
+	Summary:
+		Creates an empty subject, experiment, scan or resource in the archive.
+	Args:
+		parent: The node the new node belongs to.
+		collection: A string; the kind of node (subjects, experiments, scans or resources).
+		node_id: A string; the label or ID of the node.
+	Returns:
+		node: The new node.
+	'''
+
+	node = {'fields': {}, 'files': {}, 'children': {}}
+	parent['children'].setdefault(collection, {})[node_id] = node
+
+	return node
+
+
+def delete_mock_node(server, handler, url, body_chunks):
+	'''
+	Summary:
+		Deletes a subject (or any other node), or a file of a resource.
+	Returns:
+		status: An HTTP status code.
+		response: None.
+	'''
+
+	path, rest = parse_mock_url(url)
+
+	with server.lock:
+		node = get_mock_path_node(server, path)
+		if node is None:
+			return 404, None
+
+		if rest and rest[0] == 'files':
+			if node['files'].pop('/'.join(rest[1:]), None) is None:
+				return 404, None
+			return 200, None
+
+		if len(path) < 2:
+			return 400, None
+
+		parent = get_mock_path_node(server, path[:-1])
+		del parent['children'][path[-1][0]][path[-1][1]]
+
+	return 200, None
+
+
+def get_mock_field_paths(element, prefix=''):
+	'''
+	Summary:
+		Flattens the fields of an element of an XNAT XML document into paths such as demographics/dob or parameters/voxelRes/x, leaving out the nested experiments and scans.
+	Args:
+		element: An xml.etree.ElementTree element.
+		prefix: The path of the element's fields, used when recursing.
+	Returns:
+		fields: A dictionary mapping field paths to values.
+	'''
+
+	fields = {}
+
+	for name, value in element.attrib.items():
+		if not name.startswith('{'):
+			fields[prefix + name] = value
+
+	for child in element:
+		tag = child.tag.split('}')[-1]
+		if tag in ['experiments', 'scans']:
+			continue
+		if child.text is not None and child.text.strip():
+			fields[prefix + tag] = child.text.strip()
+		fields.update(get_mock_field_paths(child, prefix + tag + '/'))
+
+	return fields
+
+
+def get_mock_item(collection, node_id, node):
+	'''
+	Summary:
+		Builds the XNAT JSON item of a node, including its sessions, scans and resources.
+	Args:
+		collection: A string; the kind of node.
+		node_id: A string; the label or ID of the node.
+		node: The node.
+	Returns:
+		An item in the XNAT JSON format, with data_fields and children.
+	'''
+
+	data_fields = dict(node['fields'])
+	data_fields['ID' if collection in ['scans', 'resources'] else 'label'] = node_id
+
+	children = []
+	for child_collection, field in [('experiments', 'experiments/experiment'), ('scans', 'scans/scan'), ('resources', 'file')]:
+		if child_collection in node['children']:
+			items = [get_mock_item(child_collection, child_id, child) for child_id, child in sorted(node['children'][child_collection].items())]
+			children.append({'field': field, 'items': items})
+
+	if collection == 'resources':
+		data_fields['label'] = node_id
+		data_fields['file_count'] = len(node['files'])
+		data_fields['file_size'] = sum(server_file['size'] for server_file in node['files'].values())
+
+	return {'data_fields': data_fields, 'children': children}
+
+
+def get_mock_node(server, handler, url, body_chunks):
+	'''
+	Summary:
+		Answers a GET: a subject listing (with the requested columns), a node in the XNAT JSON format, or the file listing of a resource or scan.
+	Returns:
+		status: An HTTP status code.
+		response: The JSON serializable response.
+	'''
+
+	path, rest = parse_mock_url(url)
+	query = dict(urlparse.parse_qsl(url.query))
+
+	with server.lock:
+		node = get_mock_path_node(server, path)
+		if node is None:
+			return 404, None
+
+		if len(rest) == 1 and rest[0] != 'files':
+			# A listing, e.g. the subjects of the project.
+			columns = [column for column in query.get('columns', 'label').split(',') if column]
+			results = []
+			for node_id, child in sorted(node['children'].get(rest[0], {}).items()):
+				result = {'ID': node_id, 'label': node_id}
+				for column in columns:
+					for field, value in child['fields'].items():
+						if field == column or field.endswith('/' + column):
+							result[column] = value
+				results.append(result)
+			return 200, {'ResultSet': {'Result': results}}
+
+		if rest and rest[0] == 'files':
+			if path and path[-1][0] == 'scans':
+				resources = node['children'].get('resources', {})
+			else:
+				resources = {path[-1][1] if path else '': node}
+			if len(rest) > 1:
+				server_file = node['files'].get('/'.join(rest[1:]))
+				return (200, server_file) if server_file is not None else (404, None)
+			results = []
+			for label, resource in sorted(resources.items()):
+				resource_path = '/data/archive/' + '/'.join(part for pair in get_mock_path_parts(url.path, label) for part in pair)
+				for name, server_file in sorted(resource['files'].items()):
+					results.append({'Name': name.split('/')[-1], 'Size': str(server_file['size']), 'digest': server_file['md5'],
+						'collection': label, 'URI': resource_path + '/files/' + name})
+			return 200, {'ResultSet': {'Result': results}}
+
+		if not path:
+			return 200, {'items': []}
+
+		return 200, {'items': [get_mock_item(path[-1][0], path[-1][1], node)]}
+
+
+def get_mock_path_node(server, path, create=False):
+	'''
+	Summary:
+		Finds the node at a path in the archive.  The project is created on demand.
+	Args:
+		server: The MockXnatServer.
+		path: A list of (collection, id) pairs, starting with the project.
+		create: A boolean; True to create the last node of the path if its parent exists.
+	Returns:
+		The node, or None if it (or, when creating, its parent) doesn't exist.
+	'''
+
+	node = server.projects.setdefault(path[0][1], {'fields': {}, 'files': {}, 'children': {}}) if path else None
+
+	for index, (collection, node_id) in enumerate(path[1:], 1):
+		child = node['children'].get(collection, {}).get(node_id)
+		if child is None:
+			if not create or index != len(path) - 1:
+				return None
+			child = create_mock_node(node, collection, node_id)
+		node = child
+
+	return node
+
+
+def get_mock_path_parts(url_path, resource_label):
+	'''Returns the (collection, id) pairs of the url of a resource of the scan (or resource) in url_path.'''
+
+	path, rest = parse_mock_url(urlparse.urlparse(url_path))
+	if path[-1][0] == 'resources':
+		path = path[:-1]
+
+	return [('projects', path[0][1])] + path[1:] + [('resources', resource_label)]
+
+
+def get_mock_subject_fields(params):
+	'''
+	Summary:
+		Maps the REST shortcuts used to create a subject (e.g. dob, pi_firstname) and the xsi typed parameters used to create sessions and scans (e.g. xnat:mrScanData/parameters/tr) to field paths.
+	Args:
+		params: A dictionary of query parameters.
+	Returns:
+		fields: A dictionary mapping field paths to values.
+	'''
+
+	shortcuts = {'pi_firstname': 'investigator/firstname', 'pi_lastname': 'investigator/lastname', 'group': 'group', 'src': 'src'}
+	fields = {}
+
+	for name, value in params.items():
+		if name in ['xsiType', 'format', 'content', 'inbody', 'overwrite']:
+			continue
+		if name.startswith('xnat:'):
+			fields[name.split('/', 1)[1]] = value
+		elif name in shortcuts:
+			fields[shortcuts[name]] = value
+		else:
+			fields['demographics/' + name] = value
+
+	return fields
+
+
+def parse_command_line_args(argv):
+	'''
+	Summary:
+		Parses the command line arguments of the mock server.
+	Args:
+		argv: A list of command line arguments, excluding the script name.
+	Returns:
+		args: An argparse.Namespace with the parsed arguments.
+	'''
+
+	parser = argparse.ArgumentParser(description='Serve a local, in-memory stand-in for the XNAT REST API used by SpredNonDicomUpload.py.')
+	parser.add_argument('--port', type=int, default=8765, help='port to listen on (default: 8765)')
+	parser.add_argument('--latency', dest='latency_secs', type=float, default=0.0, help='seconds added to every request (default: 0)')
+	parser.add_argument('--bandwidth', dest='bandwidth_mb', type=float, default=None, help='upload bandwidth in MB/s shared by all connections (default: unlimited)')
+	parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='fraction of requests answered with an error (default: 0)')
+	parser.add_argument('--error-status', dest='error_status', type=int, default=503, help='HTTP status of injected errors (default: 503)')
+	parser.add_argument('--error-methods', dest='error_methods', default='GET,PUT,POST,DELETE', help='comma separated methods errors are injected into (default: all)')
+	parser.add_argument('--verbose', action='store_true', help='log every request')
+
+	return parser.parse_args(argv)
+
+
+def parse_mock_url(url):
+	'''
+	Summary:
+		Splits the path of a request url into the nodes it refers to and what remains.
+	Args:
+		url: A urlparse.ParseResult.
+	Returns:
+		path: A list of (collection, id) pairs, starting with ('projects', <project>).
+		rest: A list of the remaining path components (e.g. ['subjects'], ['files', <name>]).
+	'''
+
+	parts = [part for part in url.path.split('/data/archive/projects/', 1)[-1].split('/') if part]
+	path = [('projects', parts[0])] if parts else []
+	rest = parts[1:]
+
+	while len(rest) >= 2 and rest[0] != 'files':
+		path.append((rest[0], rest[1]))
+		rest = rest[2:]
+
+	return path, rest
+
+
+def post_mock_files(server, handler, url, body_chunks):
+	'''
+	Summary:
+		Stores a file uploaded to a resource, either in the body of the request (inbody=true) or as a multipart form.  A missing resource is created, as long as its scan exists.
+	Returns:
+		status: An HTTP status code.
+		response: None.
+	'''
+
+	path, rest = parse_mock_url(url)
+	query = dict(urlparse.parse_qsl(url.query))
+
+	if not rest or rest[0] != 'files':
+		return 400, None
+
+	if query.get('inbody') == 'true':
+		name = '/'.join(rest[1:])
+		md5 = hashlib.md5()
+		size = 0
+		for chunk in body_chunks:
+			md5.update(chunk)
+			size += len(chunk)
+	else:
+		form = cgi.FieldStorage(fp=io.BytesIO(b''.join(body_chunks)), headers=handler.headers,
+			environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': handler.headers.get('Content-Type', '')})
+		if 'file' not in form:
+			return 400, None
+		name = form['file'].filename.replace('\\', '/').split('/')[-1]
+		md5 = hashlib.md5(form['file'].value)
+		size = len(form['file'].value)
+
+	with server.lock:
+		resource = get_mock_path_node(server, path, create=True)
+		if resource is None:
+			return 404, None
+		if name in resource['files'] and query.get('overwrite') != 'true':
+			return 409, None
+		resource['files'][name] = {'size': size, 'md5': md5.hexdigest()}
+		server.stats['files'] += 1
+		server.stats['file_bytes'] += size
+
+	return 200, None
+
+
+def put_mock_node(server, handler, url, body_chunks):
+	'''
+	Summary:
+		Creates or updates a subject, experiment, scan or resource from the query parameters, or a subject with its experiments and scans from an XNAT XML document in the body of the request.
+	Returns:
+		status: An HTTP status code; 201 when the node was created.
+		response: None.
+	'''
+
+	path, rest = parse_mock_url(url)
+	query = dict(urlparse.parse_qsl(url.query))
+
+	if not path or rest:
+		return 400, None
+
+	if 'xml' in handler.headers.get('Content-Type', ''):
+		try:
+			subject_element = ET.fromstring(b''.join(body_chunks))
+		except ET.ParseError:
+			return 400, None
+		return put_mock_subject_xml(server, path, subject_element), None
+
+	with server.lock:
+		created = get_mock_path_node(server, path) is None
+		node = get_mock_path_node(server, path, create=True)
+		if node is None:
+			return 404, None
+		node['fields'].update(get_mock_subject_fields(query))
+
+	return (201 if created else 200), None
+
+
+def put_mock_subject_xml(server, path, subject_element):
+	'''
+	Summary:
+		Creates or updates a subject with the experiments and scans nested in its XNAT XML document.
+	Args:
+		server: The MockXnatServer.
+		path: The path of the subject.
+		subject_element: The root xml.etree.ElementTree element of the document.
+	Returns:
+		An HTTP status code.
+	'''
+
+	with server.lock:
+		subject = get_mock_path_node(server, path, create=True)
+		if subject is None:
+			return 404
+		subject['fields'].update(get_mock_field_paths(subject_element))
+		server.stats['xml_documents'] += 1
+
+		for experiment_element in subject_element.iter('{http://nrg.wustl.edu/xnat}experiment'):
+			experiment_path = path + [('experiments', experiment_element.get('label'))]
+			experiment = get_mock_path_node(server, experiment_path, create=True)
+			experiment['fields'].update(get_mock_field_paths(experiment_element))
+
+			for scan_element in experiment_element.iter('{http://nrg.wustl.edu/xnat}scan'):
+				scan = get_mock_path_node(server, experiment_path + [('scans', scan_element.get('ID'))], create=True)
+				scan['fields'].update(get_mock_field_paths(scan_element))
+
+	return 200
+
+
+def read_body_chunks(handler, chunk_size=64*1024):
+	'''
+	Summary:
+		Reads the body of a request in chunks, whether it has a Content-Length or uses chunked transfer encoding.  With a bandwidth cap, every chunk reserves its share of the simulated link, which is shared by all connections.
+	Args:
+		handler: The MockXnatHandler of the request.
+		chunk_size: An integer; the maximum size of a chunk in bytes.
+	Returns:
+		A generator of the chunks of the body.
+	'''
+
+	server = handler.server
+
+	def throttle(chunk):
+		bandwidth_mb = server.settings['bandwidth_mb']
+		if bandwidth_mb:
+			with server.link_lock:
+				start = max(time.time(), server.link_free_at)
+				server.link_free_at = start + len(chunk) / (bandwidth_mb * 1024 * 1024)
+				free_at = server.link_free_at
+			time.sleep(max(0.0, free_at - time.time()))
+		with server.lock:
+			server.stats['bytes_received'] += len(chunk)
+		return chunk
+
+	def generate_chunks():
+		if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+			while True:
+				length = int(handler.rfile.readline().split(';')[0].strip(), 16)
+				if length == 0:
+					# Skip the trailer.
+					while handler.rfile.readline().strip():
+						pass
+					return
+				while length > 0:
+					chunk = handler.rfile.read(min(length, chunk_size))
+					length -= len(chunk)
+					yield throttle(chunk)
+				handler.rfile.readline()
+		else:
+			remaining = int(handler.headers.get('Content-Length', 0))
+			while remaining > 0:
+				chunk = handler.rfile.read(min(remaining, chunk_size))
+				if not chunk:
+					return
+				remaining -= len(chunk)
+				yield throttle(chunk)
+
+	return generate_chunks()
+
+
+def reset_mock_stats(server):
+	'''Resets the request statistics of the mock, e.g. between benchmark runs.'''
+
+	server.stats = {'requests': 0, 'errors_injected': 0, 'bytes_received': 0, 'files': 0, 'file_bytes': 0, 'xml_documents': 0}
+
+
+def main():
+	'''
+	Summary:
+		Runs the mock server until it is interrupted.
+	'''
+
+	args = parse_command_line_args(sys.argv[1:])
+
+	settings = {
+		'latency_secs': args.latency_secs,
+		'bandwidth_mb': args.bandwidth_mb,
+		'error_rate': args.error_rate,
+		'error_status': args.error_status,
+		'error_methods': [method.strip().upper() for method in args.error_methods.split(',')],
+		'verbose': args.verbose
+	}
+
+	server = MockXnatServer(('127.0.0.1', args.port), settings)
+	print 'Mock XNAT server listening on http://127.0.0.1:%d/data/archive/projects/' % server.server_address[1]
+	sys.stdout.flush()
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == '__main__':
+
+	main()
@@ -1,16 +1,32 @@
 # !/usr/bin/python
 
+import argparse
+import bisect
+import collections
 import datetime
+import hashlib
+import json
 import math
+import mmap
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
 import pdb
+import Queue
+import random
+import re
 import requests
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
 import zipfile
-# import zlib
+import zlib
 
 # if sys.version_info[0] < 3:
 #     from StringIO import StringIO
@@ -19,617 +35,3613 @@ import zipfile
 
 # from collections import namedtuple
 
-# try: import simplejson as json
-# except ImportError: import json
+from multiprocessing.pool import ThreadPool
+
+# os.scandir is only in Python 3.5+; the scandir package backports it.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 from jeffs_utilities import JeffUtility
 
-spred_log_file = 0
 
+class SpredUploadError(Exception):
+	'''Raised when a step of a subject's upload fails, so that the subject can be put on the dead letter list.'''
+	pass
 
-def assign_next_available_strain_code(server_uploaded_strains, cur_strain_count):
+
+def acquire_concurrency_slot(kind, project_constants):
 	'''
 	Summary:
-		Retrieve the next logical strain code to use for a given SPReD project.
+		Waits until fewer subjects or file transfers than the limit set by adjust_concurrency are in flight, then counts one more.  Does nothing unless adaptive concurrency is enabled.
 	Args:
-		server_uploaded_strains: A dictionary mapping strain labels currently existing in the project to their strain codes.
-		cur_strain_count: An integer representing the strain number to start counting from.  This argument is used to provide a slight speed up over starting at 1 each time.
-	Returns:
-		strain_code: A string representing the next available strain code which will be used for the current strain being uploaded.
+		kind: A string; subjects or files.
+		project_constants: A dictionary containing metadata related to the project and upload.
 	'''
 
-	while True:
-		strain_code =  JeffUtility.convert_decimal_to_base(cur_strain_count, 36)
-		strain_code = zero_pad_num(strain_code, 2)
+	concurrency = project_constants['concurrency']
+	if concurrency is None:
+		return
 
-		if strain_code in server_uploaded_strains:
-			cur_strain_count += 1
-		else:
-			return strain_code
+	with concurrency['condition']:
+		while concurrency['in_flight'][kind] >= concurrency['limits'][kind]:
+			concurrency['condition'].wait()
+		concurrency['in_flight'][kind] += 1
 
 
-def check_HTTP_status_code(action, response, subj_spred_ID):
+def add_dead_letter(subj_spred_ID, MINC_filename, problem, project_constants):
 	'''
 	Summary:
-		Given a response from a web service call, and an action (e.g. creating subject), outputs a meaningful error message to the user and to the log file.
+		Puts a subject whose upload failed on the dead letter list, so that the upload can carry on with the other subjects.  The list is reported at the end of the upload; the failed subjects can be retried with --resume.
 	Args:
-		action: A string representing the action that was taken in the program (e.g. creating subject, deleting subject, etc.).
-		response: The result of a web service call.
 		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		MINC_filename: The name of the MINC file of the subject.
+		problem: A string describing why the upload failed.
+		project_constants: A dictionary containing metadata related to the project and upload.
 	'''
 
-	if response.status_code == 401:
-		print 'You probably entered an invalid username or password.'
-
-	# User for some reason doesn't have permission to delete the subject.
-	# Ask admin to delete subject, and skip subject for the time being.
-	if response.status_code == 403 and action == 'deleting subject':
-		print 'You do not have permission to delete subject ' + subj_spred_ID
-		print 'Ask administrator of SPReD project to delete subject ' + subj_spred_ID
+	with project_constants['stats_lock']:
+		project_constants['dead_letters'].append((subj_spred_ID, MINC_filename, problem))
 
-	if response.status_code != 200 and response.status_code != 201:
-		print 'Error processing subject: ' + subj_spred_ID
-		print 'Problem related to action: ' + action
-		print 'Generated an HTTP Response Error Code: ' + str(response.status_code)
-		spred_log_file.writelines(' '.join(['Problem', action, 'for subject', subj_spred_ID]))
-		spred_log_file.close()
-		sys.exit()
+	write_to_logfile(' '.join(['Problem', problem, 'for subject', subj_spred_ID]) + '\n', project_constants)
 
 
-def create_scan(MINC_filename, subj_spred_ID, session_name, project_constants, processed_subj_dir):
+def adjust_concurrency(project_constants):
 	'''
 	Summary:
-		Creates a scan in SPReD, including the upload of any associated files.
+		The adaptive concurrency controller (additive increase, multiplicative decrease), called with the controller's lock held once an interval of requests has been observed by observe_request.  The limits of subjects and file transfers in flight are halved if more than adaptive_max_error_rate of the requests of the interval failed with a transient error (a few sporadic errors are retried anyway), or if the median latency of the requests without a body rose to adaptive_latency_factor times the lowest median seen, which means the server is overloaded.  Otherwise they are raised by one, unless the last raise didn't improve the throughput, in which case they are held once (the link is saturated) and raised again at the next interval to probe for more.  The limits stay between the adaptive minimums and -j and --file-jobs.  Every decision is recorded as a concurrency metric, and changes are logged.
 	Args:
-		MINC_filename: The name of the MINC file to upload.
-		subj_spred_ID: The well-formatted SPReD ID for the subject.
-		session_name: The well-formatted session name.
 		project_constants: A dictionary containing metadata related to the project and upload.
 	'''
 
-	# Create scan
-	scan_params = get_scan_metadata(MINC_filename, project_constants)
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num']))
-	resp = project_constants['session'].put(url, params=scan_params)
-	check_HTTP_status_code('creating scan', resp, subj_spred_ID)
+	concurrency = project_constants['concurrency']
+	window = concurrency['window']
+	now = time.time()
+	window_secs = now - window['start_time']
+
+	throughput = window['bytes'] / max(window_secs, 1e-6)
+	latency = float(np.median(window['latencies'])) if window['latencies'] else None
+	if latency is not None:
+		concurrency['lowest_latency'] = latency if concurrency['lowest_latency'] is None else min(concurrency['lowest_latency'], latency)
+
+	if window['errors'] > project_constants['adaptive_max_error_rate'] * window['requests']:
+		decision = 'decrease'
+		reason = '%d of %d requests failed' % (window['errors'], window['requests'])
+	elif latency is not None and latency > project_constants['adaptive_latency_factor'] * concurrency['lowest_latency']:
+		decision = 'decrease'
+		reason = 'median latency %.3f s, %.1f times the lowest' % (latency, latency / concurrency['lowest_latency'])
+	elif concurrency['last_decision'] == 'increase' and window['bytes'] and throughput < 1.05 * concurrency['last_throughput']:
+		decision = 'hold'
+		reason = 'throughput %.2f MB/s did not improve' % (throughput / (1024.0 * 1024.0))
+	else:
+		decision = 'increase'
+		reason = '%d of %d requests failed, median latency %s' % (window['errors'], window['requests'], '-' if latency is None else '%.3f s' % latency)
+
+	old_limits = dict(concurrency['limits'])
+	for kind, limit in concurrency['limits'].items():
+		if decision == 'decrease':
+			concurrency['limits'][kind] = max(concurrency['bounds'][kind][0], limit // 2)
+		elif decision == 'increase':
+			concurrency['limits'][kind] = min(concurrency['bounds'][kind][1], limit + 1)
+
+	concurrency['last_decision'] = decision
+	concurrency['last_throughput'] = throughput
+	concurrency['window'] = {'start_time': now, 'requests': 0, 'errors': 0, 'latencies': [], 'bytes': 0}
+	concurrency['condition'].notify_all()
+
+	record_metric('concurrency', None, window_secs, project_constants, decision=decision, reason=reason, requests=window['requests'], errors=window['errors'],
+		latency=latency, throughput=throughput, subjects=concurrency['limits']['subjects'], files=concurrency['limits']['files'])
+
+	if concurrency['limits'] != old_limits:
+		message = 'Concurrency: %d subjects and %d file transfers (was %d and %d): %s' % (concurrency['limits']['subjects'], concurrency['limits']['files'],
+			old_limits['subjects'], old_limits['files'], reason)
+		notify_user(message, project_constants)
+		write_to_logfile(message + '\n', project_constants)
+
+
+def apply_command_line_args(args, project_constants):
+	'''
+	Summary:
+		Applies the parsed command line arguments to the project constants.
+	Args:
+		args: An argparse.Namespace, as returned by parse_command_line_args.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
 
-	# Create resource
-	resource_params = get_resource_metadata(project_constants)
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num'])) + '/resources/' + str(int(project_constants['resource_num']))
-	resp = project_constants['session'].put(url, params=resource_params)
-	check_HTTP_status_code('creating resource', resp, subj_spred_ID)
+	# run script automatically or interactively
+	project_constants['automatic_upload'] = args.automatic_upload
+	project_constants['dry_run'] = args.dry_run
+	project_constants['num_workers'] = max(1, args.num_workers)
+	project_constants['stream_uploads'] = args.stream_uploads
+	project_constants['pipeline_uploads'] = args.pipeline_uploads
+	project_constants['raw_minc_upload'] = args.raw_minc_upload
+	project_constants['verify_uploads'] = not args.no_verify
+	project_constants['recreate_subjects'] = args.recreate_subjects
+	project_constants['fail_fast'] = args.fail_fast
+	project_constants['xml_upload'] = args.xml_upload
+	project_constants['upload_files_individually'] = args.sync
+	project_constants['num_file_workers'] = max(1, args.num_file_workers)
+	project_constants['adaptive_concurrency'] = args.adaptive_concurrency
+	if args.bandwidth_limit is not None:
+		project_constants['bandwidth_limit'] = args.bandwidth_limit
+	if args.bandwidth_schedule is not None:
+		project_constants['bandwidth_schedule'] = args.bandwidth_schedule
+	if args.compress_level is not None:
+		project_constants['compress_level'] = args.compress_level
+	if args.num_compress_workers is not None:
+		project_constants['num_compress_workers'] = max(1, args.num_compress_workers)
+
+
+def assign_next_available_strain_code(used_strain_nums, cur_strain_count):
+	'''
+	Summary:
+		Retrieve the next logical strain code to use for a given SPReD project, and mark it as used.
+	Args:
+		used_strain_nums: A sorted list of the strain codes already in use, as base 10 integers (see get_used_strain_nums).  The new strain code is inserted into it.
+		cur_strain_count: An integer representing the strain number to start counting from.
+	Returns:
+		strain_code: A string representing the next available strain code which will be used for the current strain being uploaded, or None if every 2 digit strain code is in use.
+	'''
 
-	# Upload the distortion corrected image 
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num'])) + '/resources/' +  str(int(project_constants['resource_num'])) + '/files/'
-	zip_name = subj_spred_ID + '_distortion_corrected' + '.zip'
-	upload_zip(file_names=[MINC_filename], zip_name=zip_name, url=url, subj_spred_ID=subj_spred_ID, action='upload distortion corrected', project_constants=project_constants)
+	# Find cur_strain_count in the index, then step over the used strain codes that follow it.
+	strain_num = cur_strain_count
+	index = bisect.bisect_left(used_strain_nums, strain_num)
+	while index < len(used_strain_nums) and used_strain_nums[index] == strain_num:
+		strain_num += 1
+		index += 1
 
-	# Create resource
-	# TODO - refactor so that resource number is automatically instead of manually incremented 
-	resource_params = get_resource_metadata(project_constants)
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num'])) + '/resources/' + str(int(project_constants['resource_num']) + 1)
-	resp = project_constants['session'].put(url, params=resource_params)
-	check_HTTP_status_code('creating resource', resp, subj_spred_ID)
+	if strain_num >= 36 ** 2:
+		return None
 
-	# Upload additional registrations of an image
-	file_names = get_registration_files(processed_subj_dir)
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num'])) + '/resources/' +  str(int(project_constants['resource_num']) + 1) + '/files/'
-	zip_name = subj_spred_ID + '_registrations' + '.zip'
-	upload_zip(file_names=file_names, zip_name=zip_name, url=url, subj_spred_ID=subj_spred_ID, action='upload resampled and stats registrations', project_constants=project_constants)
+	used_strain_nums.insert(index, strain_num)
 
-	# Notify user of success and print information about the upload to a logfile
-	notify_user_of_success(subj_spred_ID)
-	print_to_logfile(subj_spred_ID, MINC_filename, processed_subj_dir)
+	return zero_pad_num(JeffUtility.convert_decimal_to_base(strain_num, 36), 2)
 
 
-def create_session(MINC_filename, subj_spred_ID, session_name, project_constants):
+def audit_project(project_constants):
 	'''
 	Summary:
-		Creates a session in SPReD.
+		Reconciles the SPReD project with the subject metadata and the local files, without changing anything in SPReD.  The subject IDs are generated as the upload would generate them, the subjects of the project are listed with one request, and every subject of the subject metadata that SPReD has is compared with audit_subject, several subjects at a time (num_audit_workers).  Subjects of the project that the subject metadata doesn't have are reported as extra.  Every difference is written as a line of JSON to the audit report, and the number of differences of each kind is printed.
 	Args:
-		MINC_filename: The name of the MINC file to upload.
-		subj_spred_ID: The well-formatted SPReD ID for the subject.
-		session_name: The well-formatted session name.
 		project_constants: A dictionary containing metadata related to the project and upload.
 	'''
 
-	session_params = get_session_metadata(MINC_filename, session_name, project_constants)
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name
-	resp = project_constants['session'].put(url, params=session_params)
-	check_HTTP_status_code('creating session', resp, subj_spred_ID)
+	start_time = time.time()
 
+	# Get the SPReD IDs and strains currently in the project with one listing request.
+	subjects_json = get_server_project_snapshot(project_constants, ['label', 'ethnicity'])
+	server_subject_IDs = get_server_subject_IDs(project_constants, subjects_json)
+	project_constants['server_subject_IDs'] = server_subject_IDs
+	server_uploaded_strains = get_server_uploaded_strains(project_constants, server_subject_IDs, subjects_json)
 
-def create_subject(MINC_filename, subj_spred_ID, row, project_constants):
+	subject_metadata = pd.read_table(filepath_or_buffer=project_constants['subject_metadata_file'], dtype={'Filename': str}, sep=',')
+	check_subject_metadata_columns(subject_metadata, project_constants)
+	init_directory_index(subject_metadata, project_constants)
+	subject_metadata = generate_subject_IDs(project_constants, server_uploaded_strains, subject_metadata)
+
+	rows = [row for index, row in subject_metadata.iterrows()]
+	local_subject_IDs = set(get_subject_spred_names(row, project_constants)[0] for row in rows)
+
+	# SystemExit (invalid credentials) would silently kill a pool thread, so it is passed back and raised again once the pool is done.
+	def audit_worker(row):
+		try:
+			return audit_subject(row, project_constants)
+		except SpredUploadError as e:
+			return [{'subject': get_subject_spred_names(row, project_constants)[0], 'level': 'subject', 'path': '', 'status': 'error', 'problem': str(e)}]
+		except SystemExit:
+			return SystemExit
+
+	pool = ThreadPool(project_constants['num_audit_workers'])
+	try:
+		results = pool.map(audit_worker, rows)
+	finally:
+		pool.close()
+		pool.join()
+
+	if SystemExit in results:
+		sys.exit()
+
+	differences = [difference for result in results for difference in result]
+	differences.extend({'subject': subj_spred_ID, 'level': 'subject', 'path': '', 'status': 'extra'} for subj_spred_ID in server_subject_IDs - local_subject_IDs)
+	differences.sort(key=lambda difference: (difference['subject'], difference['path'], difference['status']))
+
+	for difference in differences:
+		project_constants['audit_report'].write(json.dumps(difference, sort_keys=True) + '\n')
+	project_constants['audit_report'].flush()
+
+	record_metric('audit', None, time.time() - start_time, project_constants, subjects=len(rows), server_subjects=len(server_subject_IDs), differences=len(differences))
+	print_audit_summary(differences, project_constants)
+	print_metrics_summary(project_constants)
+
+
+def audit_subject(row, project_constants):
 	'''
 	Summary:
-		Creates a subject in SPReD.
+		Compares a subject of the subject metadata with SPReD, with two requests: one for the subject with its sessions, scans and resources, and one for the files of every resource of its scan.  The session, scan and resources the upload creates must exist, and the files of the resources must match the local files by name and size.  Sessions, scans, resources and files that SPReD has but the upload wouldn't create are extra.  A resource holding the zip file of an earlier upload is reported as zipped, since the files in it can't be compared.
 	Args:
-		MINC_filename: The name of the MINC file to upload.
-		subj_spred_ID: The well-formatted SPReD ID for the subject.
-		row: A row in a pandas DataFrame with subject metadata.
+		row: A row in a pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
 		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		differences: A list of dictionaries, one per difference, with the subject, the level of the item (subject, session, scan, resource or file), its path below the subject, the status (missing, extra, size mismatch, zipped, missing locally) and, for files, the local_size and server_size.
 	'''
 
-	# Determine if the subject already exists.
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
-	resp = project_constants['session'].get(url)
-	
-	# If the subject already exists, delete it so it can be created again.
-	if resp.status_code != 404:
-		url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '?removeFiles=true'
-		resp = project_constants['session'].delete(url)
-		check_HTTP_status_code('deleting subject', resp, subj_spred_ID)
+	subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+	scan_ID = str(int(project_constants['scan_num']))
+	scan_path = session_name + '/scans/' + scan_ID
+	differences = []
+
+	def add_difference(level, path, status, **fields):
+		differences.append(dict(fields, subject=subj_spred_ID, level=level, path=path, status=status))
+
+	# The local files of each resource, by their name in the resource, or None if they can't be listed.
+	local_resources = {}
+	for label, column, zip_name in [
+		(str(int(project_constants['resource_num'])), 'Filename', subj_spred_ID + '_distortion_corrected.zip'),
+		(str(int(project_constants['resource_num']) + 1), 'ProcessedFolder', subj_spred_ID + '_registrations.zip')
+	]:
+		resource_path = scan_path + '/resources/' + label
+		local_files = None
+		if pd.isnull(row[column]):
+			add_difference('resource', resource_path, 'missing locally', problem='no ' + column)
+		else:
+			try:
+				if column == 'Filename':
+					file_names, base_dir = [row['Filename']], None
+				else:
+					file_names, base_dir = get_registration_files(row['ProcessedFolder'], project_constants), row['ProcessedFolder']
+				local_files = dict((get_resource_file_name(file_name, base_dir), get_file_entry(file_name, project_constants)['size']) for file_name in file_names)
+			except OSError as e:
+				add_difference('resource', resource_path, 'missing locally', problem=str(e))
+		local_resources[label] = (local_files, zip_name)
+
+	if subj_spred_ID not in project_constants['server_subject_IDs']:
+		add_difference('subject', '', 'missing')
+		return differences
+
+	subject_item = get_server_subject(subj_spred_ID, project_constants)
+	if subject_item is None:
+		add_difference('subject', '', 'missing')
+		return differences
+
+	for child in subject_item.get('children', []):
+		if child.get('field') == 'experiments/experiment':
+			for session_item in child.get('items', []):
+				label = str(session_item.get('data_fields', {}).get('label'))
+				if label != session_name:
+					add_difference('session', label, 'extra')
+
+	session_item = get_xnat_child_item(subject_item, 'experiments/experiment', 'label', session_name)
+	if session_item is None:
+		add_difference('session', session_name, 'missing')
+		return differences
+
+	for child in session_item.get('children', []):
+		if child.get('field') == 'scans/scan':
+			for scan_item in child.get('items', []):
+				ID = str(scan_item.get('data_fields', {}).get('ID'))
+				if ID != scan_ID:
+					add_difference('scan', session_name + '/scans/' + ID, 'extra')
+
+	scan_item = get_xnat_child_item(session_item, 'scans/scan', 'ID', scan_ID)
+	if scan_item is None:
+		add_difference('scan', scan_path, 'missing')
+		return differences
+
+	scan_url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + scan_ID
+	server_resources = get_server_scan_files(scan_url, subj_spred_ID, project_constants) or {}
+
+	# An empty resource doesn't appear in the file listing, only in the scan.
+	server_labels = set(server_resources)
+	for child in scan_item.get('children', []):
+		if child.get('field') == 'file':
+			server_labels.update(str(resource_item.get('data_fields', {}).get('label')) for resource_item in child.get('items', []))
+
+	for label in sorted(server_labels - set(local_resources)):
+		add_difference('resource', scan_path + '/resources/' + label, 'extra')
+
+	for label, (local_files, zip_name) in sorted(local_resources.items()):
+		resource_path = scan_path + '/resources/' + label
+		if label not in server_labels:
+			add_difference('resource', resource_path, 'missing')
+			continue
+
+		server_files = dict(server_resources.get(label, {}))
+		if zip_name in server_files:
+			add_difference('resource', resource_path, 'zipped', server_size=int(server_files.pop(zip_name).get('size', 0)))
+			zipped = True
+		else:
+			zipped = False
 
-	# Create the subject with PUT.
-	subj_params = get_subject_metadata(row, project_constants)
-	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
-	resp = project_constants['session'].put(url, params=subj_params)
-	check_HTTP_status_code('creating subject', resp, subj_spred_ID)
+		if local_files is None:
+			continue
 
+		for name, local_size in sorted(local_files.items()):
+			server_file = server_files.pop(name, None)
+			if server_file is None:
+				if not zipped:
+					add_difference('file', resource_path + '/files/' + name, 'missing', local_size=local_size)
+			elif 'size' in server_file and int(server_file['size']) != local_size:
+				add_difference('file', resource_path + '/files/' + name, 'size mismatch', local_size=local_size, server_size=int(server_file['size']))
 
-def generate_subject_IDs(project_constants, server_uploaded_strains, subject_metadata):
+		for name, server_file in sorted(server_files.items()):
+			add_difference('file', resource_path + '/files/' + name, 'extra', server_size=int(server_file['size']) if 'size' in server_file else None)
+
+	return differences
+
+
+def build_zip_file(file_names, zip_name, subj_spred_ID, action, project_constants):
 	'''
 	Summary:
-		Generates SPReD IDs for the subjects contained in the subject metadata DataFrame.
+		Writes a temporary zip file containing a set of files to the working directory, to be uploaded by send_zip_file.
 	Args:
+		file_names: A list of string paths to files.
+		zip_name: A string specifying the zip file name.
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string specifying whether distortion corrected files or stats volumes are being uploaded.
 		project_constants: A dictionary containing metadata related to the project and upload.
-		server_uploaded_strains: A dictionary mapping strain labels currently existing in the project to their strain codes.
-		subject_metadata: A pandas DataFrame containing information about each individual subject to be inserted into the SPReD project.
 	Returns:
-		subject_metadata: An updated version of the DataFrame containing metadata about subjects with SPReD IDs added.
+		zip_size: An integer; the size of the zip file in bytes.
+		zip_md5: A string; the hexadecimal MD5 digest of the zip file, computed while it is written.
 	'''
 
-	# Subject and strain numbers start at 1 (cur_strain_count is incremented near the beginning of the for loop, so it's effectively 1).
-	cur_subj_count = 1
-	cur_strain_count = 0
-	prev_ethnicity = ''
+	# Create .zip file containing all files in the file list to be uploaded.
+	# Hopefully faster than uploading the uncompressed files, but has added step of zipping the files.
+	# mode='wb' so that a zip file left over from a crashed run is overwritten instead of appended to.
+	start_time = time.time()
+	md5 = hashlib.md5()
+	with open(zip_name, 'wb') as zf:
+		for chunk in generate_zip_stream(file_names, subj_spred_ID, project_constants):
+			md5.update(chunk)
+			zf.write(chunk)
 
-	# Loop through each subject slated for upload, generate an appropriate ID for them, then populate the DataFrame.
-	for index, row in subject_metadata.iterrows():
+	zip_size = os.path.getsize(zip_name)
+	original_bytes = sum(os.path.getsize(file_name) for file_name in file_names)
+	record_metric('zip build', subj_spred_ID, time.time() - start_time, project_constants, action=action, bytes=zip_size, original_bytes=original_bytes, ratio=zip_size / float(max(original_bytes, 1)))
 
-		strain_label = row['ethnicity']
+	return zip_size, md5.hexdigest()
 
-		if prev_ethnicity != strain_label:
-			cur_subj_count = 1
-			cur_strain_count += 1
 
-		subj_num = JeffUtility.convert_decimal_to_base(str(cur_subj_count), 36)
-		subj_num = zero_pad_num(subj_num, 2)
+def check_HTTP_status_code(action, response, subj_spred_ID, project_constants):
+	'''
+	Summary:
+		Given a response from a web service call, and an action (e.g. creating subject), outputs a meaningful error message to the user, then raises SpredUploadError, or exits if the credentials are invalid.
+	Args:
+		action: A string representing the action that was taken in the program (e.g. creating subject, deleting subject, etc.).
+		response: The result of a web service call.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
 
-		if strain_label in server_uploaded_strains:
-			strain_code = server_uploaded_strains[strain_label]
-		else:
-			strain_code = assign_next_available_strain_code(server_uploaded_strains, cur_strain_count)
-			server_uploaded_strains[strain_label] = strain_code
-		
-		subject_metadata.loc[index, 'SubjNum'] = strain_code + subj_num
+	if response.status_code == 401:
+		notify_user('You probably entered an invalid username or password.', project_constants)
 
-		prev_ethnicity = strain_label
-		cur_subj_count += 1
+	# User for some reason doesn't have permission to delete the subject.
+	# Ask admin to delete subject, and skip subject for the time being.
+	if response.status_code == 403 and action == 'deleting subject':
+		notify_user('You do not have permission to delete subject ' + subj_spred_ID, project_constants)
+		notify_user('Ask administrator of SPReD project to delete subject ' + subj_spred_ID, project_constants)
 
-	return subject_metadata
+	if response.status_code != 200 and response.status_code != 201:
+		notify_user('Error processing subject: ' + subj_spred_ID + '\n' +
+			'Problem related to action: ' + action + '\n' +
+			'Generated an HTTP Response Error Code: ' + str(response.status_code), project_constants)
+
+		# Invalid credentials will fail every subject, so stop the upload.  The log file is closed by main().
+		if response.status_code == 401:
+			write_to_logfile(' '.join(['Problem', action, 'for subject', subj_spred_ID]) + '\n', project_constants)
+			sys.exit()
+
+		raise SpredUploadError(action + ' (HTTP ' + str(response.status_code) + ')')
+
+
+def check_minc_header_fields(minc_header):
+	'''
+	Summary:
+		Checks that a MINC header has the fields get_session_metadata and get_scan_metadata convert to numbers: the acquisition parameters the session always needs must be present and numeric, and the fields of the voxel sizes and scan parameters must be numeric when present, with non-zero dimensions.
+	Args:
+		minc_header: A dictionary of MINC header fields, as returned by get_minc_header.
+	Returns:
+		problems: A list of strings describing the fields that are missing or not numbers.
+	'''
+
+	problems = []
+
+	required_fields = ['vnmr:ni', 'vnmr:nf', 'vnmr:nfid', 'vnmr:nt', 'vnmr:tr', 'vnmr:etl']
+	optional_fields = ['vnmr:lpe', 'vnmr:lpe2', 'vnmr:lro', 'vnmr:nv', 'vnmr:nv2', 'vnmr:np', 'vnmr:te', 'vnmr:ti']
+	dimension_fields = ['vnmr:nv', 'vnmr:nv2', 'vnmr:np']
 
+	for field in required_fields + optional_fields:
+		value = minc_header.get(field)
+		if value is None:
+			if field in required_fields:
+				problems.append('the header has no ' + field)
+			continue
+		try:
+			number = float(value)
+		except (TypeError, ValueError):
+			problems.append('the header field ' + field + ' is not a number: ' + str(value))
+			continue
+		if field in dimension_fields and number == 0:
+			problems.append('the header field ' + field + ' is 0')
 
-def get_minc_field(field_name, MINC_filename):
+	return problems
+
+
+def check_subject_files(row, project_constants):
 	'''
 	Summary:
-		Calls a subprocess to extract a field's value from a MINC file. The mincinfo command is a specific command offered by MINC tools.
+		Checks, without changing anything in SPReD, that the files of a subject can be uploaded: the MINC file exists and is readable, and its header can be read and has the fields the upload needs (see check_minc_header_fields), and the resampled and stats-volumes folders of the processed folder exist and only contain readable files.
 	Args:
-		field_name: A valid field name from a MINC file.
-		MINC_filename: The MINC file to extract the field value from.
+		row: A row in a pandas DataFrame with subject metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
 	Returns:
-		value: The value associated with the specified field from a MINC file.
+		A dictionary with the files of the subject (file_names), their total size in bytes (bytes), and a list of the problems found (problems).
 	'''
 
-	value = None
+	file_names = []
+	problems = []
+
+	MINC_filename = row['Filename']
+	if pd.isnull(MINC_filename):
+		problems.append('no Filename')
+	else:
+		try:
+			with open(MINC_filename, 'rb') as minc_file:
+				minc_file.read(1)
+		except IOError as e:
+			problems.append(str(e))
+		else:
+			minc_header = get_minc_header(MINC_filename, project_constants)
+			if not minc_header:
+				problems.append('the header could not be read: ' + MINC_filename)
+			else:
+				problems.extend(problem + ': ' + MINC_filename for problem in check_minc_header_fields(minc_header))
+			file_names.append(MINC_filename)
+
+	processed_subj_dir = row['ProcessedFolder']
+	if pd.isnull(processed_subj_dir):
+		problems.append('no ProcessedFolder')
+	else:
+		try:
+			registration_files = get_registration_files(processed_subj_dir, project_constants)
+		except OSError as e:
+			problems.append(str(e))
+		else:
+			for registration_file in registration_files:
+				if get_file_entry(registration_file, project_constants)['is_dir']:
+					problems.append('not a file: ' + registration_file)
+				elif not os.access(registration_file, os.R_OK):
+					problems.append('not readable: ' + registration_file)
+			file_names.extend(registration_files)
 
 	try:
-		value = subprocess.check_output(["mincinfo", "-attvalue", field_name, MINC_filename])
-		value = value.rstrip()
-	except subprocess.CalledProcessError:
-		pass
+		num_bytes = sum(get_file_entry(file_name, project_constants)['size'] for file_name in file_names)
+	except OSError as e:
+		problems.append(str(e))
+		num_bytes = 0
 
-	return value
+	return {'file_names': file_names, 'bytes': num_bytes, 'problems': problems}
 
 
-def get_registration_files(processed_subj_dir):
+def check_subject_metadata(subject_metadata, project_constants):
 	'''
 	Summary:
-		Given the processed image folder associated with a subject, return a list of all registration files to be uploaded associated with the original file (e.g. lsq6, lsq12, nlin, processed).
+		The pre-flight check: checks the files of every subject of the subject metadata with check_subject_files before anything is changed in SPReD, so that problems are found up front instead of hours into the upload.  Subjects are checked concurrently, since each check mostly waits on the file system (often a network mount).  Subjects already uploaded by the run being resumed aren't checked.
 	Args:
-		processed_subj_dir: The name of the processed folder associated with the subject currently being uploaded.  Reason this needs to be supplied is that there could be several processed folders per strain, so the user must specify which one to upload.
+		subject_metadata: A pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		project_constants: A dictionary containing metadata related to the project and upload.
 	Returns:
-		registration_files: A list of associated registration files (lsq6, lsq12, nlin, stats_volumes) for a MINC file.
+		preflight: A dictionary mapping the index of every checked row to the result of check_subject_files.
 	'''
 
-	# Old stuff which assumed that there was a single processed folder 2 folders above the distortion corrected images folder.
-	# path_tuple = os.path.split(MINC_filename)
-	# basename = path_tuple[1]
-	# current_dir = path_tuple[0]
-	# parent_dir = os.path.dirname(current_dir)
-	# grandparent_dir = os.path.dirname(parent_dir)
-	# all_items = os.listdir(grandparent_dir)
-	# for item in all_items:
-	# 	if 'processed' in item:
-	# 		processed_dir = os.path.join(grandparent_dir, item)
-	# 		break
-	# processed_subj_dir = os.path.join(processed_dir, basename[0:-4])
+	start_time = time.time()
 
-	resampled_dir = os.path.join(processed_subj_dir, 'resampled')
-	stats_dir = os.path.join(processed_subj_dir, 'stats-volumes')
-	
-	# List of all relevant registration files for a subject.
-	registration_files = []
+	rows = []
+	for index, row in subject_metadata.iterrows():
+		subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+		if not is_step_completed(subj_spred_ID, 'complete', row['Filename'], project_constants):
+			rows.append((index, row))
 
-	resampled_files = os.listdir(resampled_dir)
-	for registration in resampled_files:
-		registration_files.append(os.path.join(resampled_dir, registration))
+	pool = ThreadPool(project_constants['num_preflight_workers'])
+	try:
+		results = pool.map(lambda index_row: check_subject_files(index_row[1], project_constants), rows)
+	finally:
+		pool.close()
+		pool.join()
 
-	stats_files = os.listdir(stats_dir)
-	for registration in stats_files:
-		registration_files.append(os.path.join(stats_dir, registration))
+	preflight = dict((index, result) for (index, row), result in zip(rows, results))
 
-	return registration_files
+	record_metric('preflight', None, time.time() - start_time, project_constants, subjects=len(rows),
+		failed=sum(1 for result in results if result['problems']))
 
+	return preflight
 
-def get_resource_metadata(project_constants):
+
+def check_subject_metadata_columns(subject_metadata, project_constants):
 	'''
 	Summary:
-		Populate resource metadata.
+		Checks that the subject metadata file has every column the upload reads, and exits listing the missing columns if it doesn't.
 	Args:
+		subject_metadata: A pandas DataFrame read from the subject metadata file.
 		project_constants: A dictionary containing metadata related to the project and upload.
-	Returns:
-		resource_params: A dictionary of name:value pairs needed to upload SPReD resources.
 	'''
 
-	resource_params = {
-		'format': project_constants['file_type'],
-		'content': project_constants['scan_type']
-	}
+	required_columns = ['Filename', 'ProcessedFolder', 'Genotype', 'dob', 'gender', 'handedness', 'race', 'ethnicity', 'weight', 'height']
+	missing_columns = [column for column in required_columns if column not in subject_metadata.columns]
 
-	return resource_params
+	if missing_columns:
+		notify_user(project_constants['subject_metadata_file'] + ' is missing the column(s): ' + ', '.join(missing_columns), project_constants)
+		sys.exit()
 
 
-def get_scan_metadata(MINC_filename, project_constants):
+def choose_compress_type(file_name, project_constants):
 	'''
 	Summary:
-		Extract scan metadata from a MINC file (MINC_filename) and return a dictionary mapping XNAT XML (keys) to MINC metadata (values).
+		Decides whether a file is worth compressing in a zip archive.  Files with a compressed file extension are stored as they are; otherwise a few blocks from the file are compressed with the fastest deflate level, and the file is stored if they shrink by less than the configured amount (e.g. MINC2 files with internal compression).
 	Args:
-		MINC_filename: A filename specifying the MINC file to upload.
+		file_name: A string path to a file.
 		project_constants: A dictionary containing metadata related to the project and upload.
 	Returns:
-		scan_params: A dictionary containing relevant scan metadata name value pairs for a given MINC file.
+		compress_type: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
 	'''
 
-	# constant key-value pairs go here which are the same for every subject
-	scan_params = {
-		'xsiType': 'xnat:mrScanData',
-		'xnat:mrScanData/type': project_constants['scan_type'],  # double check that this is the format SPReD wants
-		'xnat:mrScanData/quality': project_constants['quality'],
-		'xnat:mrScanData/scanner': project_constants['scanner'],
-		'xnat:mrScanData/scanner/manufacturer': project_constants['scanner_manufacturer'],
-		'xnat:mrScanData/fieldStrength': project_constants['field_strength']
-	}
+	if project_constants['compress_level'] == 0 or os.path.splitext(file_name)[1].lower() in ['.gz', '.bz2', '.xz', '.zip', '.png', '.jpg', '.jpeg']:
+		return zipfile.ZIP_STORED
 
-	# retrieve relevant fields from the mincheader
-	pslabel = get_minc_field('vnmr:pslabel', MINC_filename)
-	seqfil = get_minc_field('vnmr:seqfil', MINC_filename)
-	lpe = get_minc_field('vnmr:lpe', MINC_filename)
-	lpe2 = get_minc_field('vnmr:lpe2', MINC_filename)
-	lro = get_minc_field('vnmr:lro', MINC_filename)
-	nv = get_minc_field('vnmr:nv', MINC_filename)
-	nv2 = get_minc_field('vnmr:nv2', MINC_filename)
-	np = get_minc_field('vnmr:np', MINC_filename)
-	orient = get_minc_field('vnmr:orient', MINC_filename)
-	tr = get_minc_field('vnmr:tr', MINC_filename)
-	te = get_minc_field('vnmr:te', MINC_filename)
-	ti = get_minc_field('vnmr:ti', MINC_filename)
+	file_size = os.path.getsize(file_name)
+	# Blocks mustn't overlap, or deflate would find the repeated bytes and overestimate compressibility.
+	sample_size = min(64 * 1024, max(file_size // 4, 1))
+	sample = []
 
-	# omitted xnat:mrScanData/startTime = time since it's in the session anyway
-	# time must be of type xs:time
+	# Sample the middle of the file as well as the start, since the start of a MINC file is mostly header.
+	with open(file_name, 'rb') as f:
+		for fraction in [0, 0.25, 0.5, 0.75]:
+			f.seek(int(file_size * fraction))
+			sample.append(f.read(sample_size))
+	sample = b''.join(sample)
 
-	# TODO - refactor these lines to be single line statements with a helper function
-	# fov and matr don't allow 3D values
-	# fov must have integer values, yet MINC has them in float values
-	if pslabel is not None:
-		scan_params['xnat:mrScanData/series_description'] = pslabel
-	if lpe is not None and nv is not None:
-		scan_params['xnat:mrScanData/parameters/voxelRes/x'] = float(lpe) / float(nv)
-	if lpe2 is not None and nv2 is not None:
-		scan_params['xnat:mrScanData/parameters/voxelRes/y'] = float(lpe2) / float(nv2)
-	if lro is not None and np is not None:
-		scan_params['xnat:mrScanData/parameters/voxelRes/z'] = float(lro) / (float(np) / 2)
-	if orient is not None:
-		scan_params['xnat:mrScanData/parameters/orientation'] = orient
-	# These are not handled well because they aren't 3D and sometimes they're int, sometimes they're float.
-	# if lpe is not None:
-	# 	scan_params['xnat:mrScanData/parameters/fov/x'] = float(lpe)
-	# if lpe2 is not None:
-	# 	scan_params['xnat:mrScanData/parameters/fov/y'] = float(lpe2)
-	# if nv is not None:
-	# 	scan_params['xnat:mrScanData/parameters/matrix/x'] = int(nv)
-	# if nv2 is not None:
-	# 	scan_params['xnat:mrScanData/parameters/matrix/y'] = int(nv2)
-	if tr is not None:
-		scan_params['xnat:mrScanData/parameters/tr'] = float(tr)
-	if te is not None:
-		scan_params['xnat:mrScanData/parameters/te'] = float(te)
-	if ti is not None:
-		scan_params['xnat:mrScanData/parameters/ti'] = float(ti)
-	if project_constants['flip_angle'] is not None:
-		scan_params['xnat:mrScanData/parameters/flip'] = int(project_constants['flip_angle'])
-	if seqfil is not None:
-		scan_params['xnat:mrScanData/parameters/sequence'] = seqfil
-	if project_constants['file_type'] is not None:
-		scan_params['xnat:mrScanData/parameters/imageType'] = project_constants['file_type']
+	if not sample:
+		return zipfile.ZIP_STORED
 
-	return scan_params
+	compressed_fraction = len(zlib.compress(sample, 1)) / float(len(sample))
 
+	if compressed_fraction > project_constants['compress_min_ratio']:
+		return zipfile.ZIP_STORED
 
-def get_server_subject_IDs(project_constants):
+	return zipfile.ZIP_DEFLATED
+
+
+def compress_zip_member(file_name, zinfo, member_stats, project_constants, chunk_size=1024*1024):
 	'''
 	Summary:
-		Retrieves the spred IDs currently in use in the project.
+		Reads a file chunk by chunk and compresses it according to zinfo.compress_type, filling in the CRC and sizes of zinfo as it goes.
 	Args:
+		file_name: A string path to a file.
+		zinfo: A zipfile.ZipInfo for the file, as returned by get_zip_info.
+		member_stats: A dictionary in which the time spent reading and compressing the file is accumulated under compress_secs.
 		project_constants: A dictionary containing metadata related to the project and upload.
+		chunk_size: An integer; the number of bytes read from the file at a time.
 	Returns:
-		server_subject_IDs: A list containing spred IDs currently in use in the project.
+		A generator yielding the compressed data as strings of bytes.
 	'''
 
-	url = project_constants['base_url']
-	project_url = url + project_constants['project_name']
-	subjects_url = os.path.join(project_url, 'subjects')
+	start_time = time.time()
+
+	if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+		compressor = zlib.compressobj(project_constants['compress_level'], zlib.DEFLATED, -15)
+	else:
+		compressor = None
+
+	with open(file_name, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			zinfo.file_size += len(chunk)
+			zinfo.CRC = zlib.crc32(chunk, zinfo.CRC)
+			if compressor is not None:
+				chunk = compressor.compress(chunk)
+			if chunk:
+				zinfo.compress_size += len(chunk)
+				# Time spent waiting for the consumer of the chunk isn't counted as compression time.
+				member_stats['compress_secs'] += time.time() - start_time
+				yield chunk
+				start_time = time.time()
+
+	if compressor is not None:
+		chunk = compressor.flush()
+		zinfo.compress_size += len(chunk)
+		member_stats['compress_secs'] += time.time() - start_time
+		yield chunk
+	else:
+		member_stats['compress_secs'] += time.time() - start_time
+
+	zinfo.CRC &= 0xFFFFFFFF
+
+
+def confirm_upload_plan(plan, project_constants):
+	'''
+	Summary:
+		Asks the user once whether the upload plan should be carried out, unless the upload is automatic.
+	Args:
+		plan: A list of the subjects of the upload, as returned by get_upload_plan.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A boolean; True if the plan should be carried out.
+	'''
 
-	subjects_resp = project_constants['session'].get(subjects_url, params={'format': 'json'})
-	subjects_json = subjects_resp.json()
-	subjects_json = subjects_json['ResultSet']['Result']
+	# Don't give user option if it's an automatic upload.
+	if project_constants['automatic_upload'] == True:
+		return True
 
-	server_subject_IDs = []
+	num_subjects = len([entry for entry in plan if entry['upload']])
+	are_you_sure = ''
 
-	for subject in subjects_json:
-		spred_ID = subject['label']
-		spred_ID_str = str(spred_ID)  # strip unicode chars (u'') 
-		server_subject_IDs.append(spred_ID_str)
+	# Only accept 'y' and 'n' as valid user input.
+	while are_you_sure != 'y' and are_you_sure != 'n':
+		are_you_sure = raw_input('Carry out this plan for %d subjects? (y/n): ' % num_subjects)
+		if are_you_sure != 'y' and are_you_sure != 'n':
+			print 'Please enter either y or n'
 
-	return server_subject_IDs
+	return are_you_sure == 'y'
 
 
-def get_server_uploaded_strains(project_constants, server_subject_IDs):
+def create_resource(scan_url, resource_num, subj_spred_ID, project_constants):
 	'''
 	Summary:
-		Returns a dictionary to use to keep track of the strains which have already been uploaded and the SPReD strain codes used for those strains.
+		Creates a resource (a folder of files) in a SPReD scan.
 	Args:
+		scan_url: A string specifying the url of the scan.
+		resource_num: An integer; the number of the resource in the scan.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
 		project_constants: A dictionary containing metadata related to the project and upload.
-		server_subject_IDs: A list containing all SPReD IDs in the project being uploaded to before initiating the upload.
-	Returns:
-		server_uploaded_strains: A dictionary mapping mouse strains currently in the SPReD project to their respective strain codes.
 	'''
 
-	server_uploaded_strains = {}
+	resource_params = get_resource_metadata(project_constants)
+	url = scan_url + '/resources/' + str(resource_num)
+	send_request('put', url, 'creating resource', subj_spred_ID, project_constants, params=resource_params)
+
 
-	for subject in server_subject_IDs:
+def create_scan(MINC_filename, subj_spred_ID, session_name, project_constants, minc_header=None):
+	'''
+	Summary:
+		Creates a scan in SPReD and the resources its files are uploaded to (see upload_scan_files).  Steps already recorded in the journal of a resumed upload are skipped.
+	Args:
+		MINC_filename: The name of the MINC file to upload.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		session_name: The well-formatted session name.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		minc_header: Optionally, the header of the MINC file as returned by get_minc_header, so it isn't read again.
+	'''
 
-		strain_code = subject[-4:-2]
+	scan_url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num']))
 
-		url = os.path.join(project_constants['base_url'], project_constants['project_name'], 'subjects', subject)
-		subject_resp = project_constants['session'].get(url, params={'format': 'json'})
-		subject_json = subject_resp.json()
+	# Create scan
+	if not is_step_completed(subj_spred_ID, 'scan', MINC_filename, project_constants):
+		if minc_header is None:
+			minc_header = get_minc_header(MINC_filename, project_constants)
+		scan_params = get_scan_metadata(minc_header, project_constants)
+		send_request('put', scan_url, 'creating scan', subj_spred_ID, project_constants, params=scan_params)
+		record_step_completed(subj_spred_ID, 'scan', MINC_filename, project_constants)
 
-		# Transforms the complex data structure into a generator which can be looped over as a list of lists.
-		subject_info = JeffUtility.dict_generator(subject_json)
-		
-		for line in subject_info:
-			# Get the json part that has ethnicity, and store the strain ethnicity in a list.
-			if 'ethnicity' in line:
-				ethnicity = str(line[-1])
-				if ethnicity not in server_uploaded_strains.keys():
-					server_uploaded_strains[ethnicity] = strain_code
-				break
+	# Create resource
+	if not is_step_completed(subj_spred_ID, 'distortion corrected resource', MINC_filename, project_constants):
+		create_resource(scan_url, int(project_constants['resource_num']), subj_spred_ID, project_constants)
+		record_step_completed(subj_spred_ID, 'distortion corrected resource', MINC_filename, project_constants)
 
-	return server_uploaded_strains
+	# Create resource
+	# TODO - refactor so that resource number is automatically instead of manually incremented 
+	if not is_step_completed(subj_spred_ID, 'registrations resource', MINC_filename, project_constants):
+		create_resource(scan_url, int(project_constants['resource_num']) + 1, subj_spred_ID, project_constants)
+		record_step_completed(subj_spred_ID, 'registrations resource', MINC_filename, project_constants)
 
 
-def get_session_metadata(MINC_filename, session_name, project_constants):
+def create_session(MINC_filename, subj_spred_ID, session_name, project_constants, minc_header=None):
 	'''
 	Summary:
-		Extract session metadata from a MINC file (MINC_filename) and return a dictionary mapping XNAT XML (keys) to MINC metadata (values).
+		Creates a session in SPReD, unless it is already recorded in the journal of a resumed upload.
 	Args:
-		MINC_filename: A filename specifying the MINC file to upload.
-		session_name: A string representing the well-formatted SPReD session name.
+		MINC_filename: The name of the MINC file to upload.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		session_name: The well-formatted session name.
 		project_constants: A dictionary containing metadata related to the project and upload.
-	Returns:
-		session_params: A dictionary containing relevant session metadata name value pairs for a given MINC file.
+		minc_header: Optionally, the header of the MINC file as returned by get_minc_header, so it isn't read again.
 	'''
 
-	# add constant key-values here
-	session_params = {
-		'xsiType': 'xnat:mrSessionData',
-		'xnat:mrSessionData/visit_id': int(project_constants['visit_num']), 
-		'xnat:mrSessionData/project': project_constants['project_name'],  # don't include this!  it generates a 403 for some reason
-		'xnat:mrSessionData/label': session_name,
-		'xnat:mrSessionData/scanner': project_constants['scanner'],
-		'xnat:mrSessionData/scanner/manufacturer': project_constants['scanner_manufacturer'],
-		'xnat:mrSessionData/modality':  project_constants['modality'],
-		'xnat:mrSessionData/fieldStrength': project_constants['field_strength'],
-		'xnat:mrSessionData/acquisition_site': project_constants['acquisition_site']
-	}
+	if is_step_completed(subj_spred_ID, 'session', MINC_filename, project_constants):
+		return
 
-	ni = float(get_minc_field('vnmr:ni', MINC_filename))
-	nf = float(get_minc_field('vnmr:nf', MINC_filename))
-	nfid = float(get_minc_field('vnmr:nfid', MINC_filename))
-	nt = float(get_minc_field('vnmr:nt', MINC_filename))
-	tr = float(get_minc_field('vnmr:tr', MINC_filename))
-	etl = float(get_minc_field('vnmr:etl', MINC_filename))
-	
-	# TODO - look into when this bug has been fixed
-	# duration isn't handled properly for some reason
-	# this is a confirmed bug on XNAT's end
-	# if ni is not None and nf is not None and nfid is not None and nt is not None and tr is not None and etl is not None:
-	# 	duration_secs = int(ni) * int(nf) * int(nfid) * int(nt) * int(tr)  / int(etl)
-	# 	# format duration value into xs:duration format
-	# 	hours = math.floor(duration_secs / (60*60))
-	# 	leftover = duration_secs - hours*60*60
-	# 	minutes = math.floor(leftover / 60)
-	# 	leftover = leftover - minutes*60
-	# 	seconds = leftover
-	# 	xs_duration = 'PT' + str(int(hours)) + 'H' + str(int(minutes)) + 'M' + str(int(seconds)) + 'S'
-	# 	session_params['xnat:mrSessionData/duration'] = xs_duration
+	if minc_header is None:
+		minc_header = get_minc_header(MINC_filename, project_constants)
+
+	session_params = get_session_metadata(minc_header, session_name, project_constants)
+	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name
+	send_request('put', url, 'creating session', subj_spred_ID, project_constants, params=session_params)
+	record_step_completed(subj_spred_ID, 'session', MINC_filename, project_constants)
+
+
+def create_subject(MINC_filename, subj_spred_ID, row, project_constants):
+	'''
+	Summary:
+		Creates a subject in SPReD, unless it is already recorded in the journal of a resumed upload.
+	Args:
+		MINC_filename: The name of the MINC file to upload.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		row: A row in a pandas DataFrame with subject metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	# A subject created by the upload being resumed mustn't be deleted, or its files would have to be uploaded again.
+	if is_step_completed(subj_spred_ID, 'subject', MINC_filename, project_constants):
+		return
+
+	# Determine if the subject already exists.
+	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
+	resp = send_request('get', url, 'checking subject', subj_spred_ID, project_constants, accept_statuses=[404])
 	
-	coil = get_minc_field('vnmr:rfcoil', MINC_filename)
-	if coil is not None:
-		session_params['xnat:mrSessionData/coil'] = coil
+	# If the subject already exists and is to be recreated, delete it so it can be created again; otherwise the PUT below updates it.
+	# A retried delete may find that the first attempt already deleted the subject.
+	if resp.status_code != 404 and project_constants['recreate_subjects']:
+		url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '?removeFiles=true'
+		send_request('delete', url, 'deleting subject', subj_spred_ID, project_constants, replay_accept_statuses=[404])
+
+	# Create the subject with PUT.
+	subj_params = get_subject_metadata(row, project_constants)
+	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
+	send_request('put', url, 'creating subject', subj_spred_ID, project_constants, params=subj_params)
+	record_step_completed(subj_spred_ID, 'subject', MINC_filename, project_constants)
+
+
+def create_subject_hierarchy(MINC_filename, subj_spred_ID, session_name, row, project_constants, minc_header=None):
+	'''
+	Summary:
+		Creates a subject, its session and its scan in SPReD with a single XML document, instead of one request each.  An existing subject (according to the project listing retrieved at the start of the upload) is deleted first.  The resources are created by the file uploads, so only the files are left to upload.  If SPReD rejects the document, XML uploads are turned off and the subject is created step by step instead.
+	Args:
+		MINC_filename: The name of the MINC file to upload.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		session_name: The well-formatted session name.
+		row: A row in a pandas DataFrame with subject metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		minc_header: Optionally, the header of the MINC file as returned by get_minc_header, so it isn't read again.
+	'''
+
+	if minc_header is None:
+		minc_header = get_minc_header(MINC_filename, project_constants)
+
+	subject_xml = get_subject_xml(subj_spred_ID,
+		get_subject_metadata(row, project_constants),
+		get_session_metadata(minc_header, session_name, project_constants),
+		get_scan_metadata(minc_header, project_constants),
+		project_constants)
+
+	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
+
+	# The project listing saves a request per subject checking whether it exists.
+	if subj_spred_ID in project_constants['server_subject_IDs']:
+		send_request('delete', url + '?removeFiles=true', 'deleting subject', subj_spred_ID, project_constants, accept_statuses=[404])
+
+	resp = send_request('put', url, 'creating subject, session and scan', subj_spred_ID, project_constants, accept_statuses=[400, 415],
+		data=subject_xml, params={'inbody': 'true'}, headers={'Content-Type': 'text/xml'})
+
+	if resp.status_code in [400, 415]:
+		project_constants['xml_upload'] = False
+		notify_user('SPReD rejected the XML document for subject ' + subj_spred_ID + ' (HTTP ' + str(resp.status_code) + '), creating subjects step by step from now on', project_constants)
+		return
+
+	for step in ['subject', 'session', 'scan', 'distortion corrected resource', 'registrations resource']:
+		record_step_completed(subj_spred_ID, step, MINC_filename, project_constants)
+
+
+def evict_header_cache(header_cache, project_constants):
+	'''
+	Summary:
+		Evicts the least recently used entries of the header cache, whether headers, digests or directory listings, until their total size is within header_cache_max_bytes.  The last uses recorded since the last flush are written first.  Doesn't commit; the caller must hold header_cache_lock.
+	Args:
+		header_cache: The sqlite3 connection to the cache database.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	if project_constants['header_cache_bytes'] <= project_constants['header_cache_max_bytes']:
+		return
+
+	write_header_cache_hits(header_cache, project_constants)
+
+	evicted_paths = dict((table, []) for table in project_constants['header_cache_tables'])
+	for table, path, entry_bytes in select_header_cache_entries(header_cache, project_constants):
+		if project_constants['header_cache_bytes'] <= project_constants['header_cache_max_bytes']:
+			break
+		evicted_paths[table].append((path,))
+		project_constants['header_cache_bytes'] -= entry_bytes
+
+	for table, paths in evicted_paths.items():
+		header_cache.executemany('DELETE FROM ' + table + ' WHERE path = ?', paths)
+
+
+def flush_header_cache(project_constants):
+	'''
+	Summary:
+		Commits the entries stored in the header cache since the last flush (see store_header_cache_entry), with the last use of the entries read from it, in a single transaction.  Called at the end of the run, so that neither a cache hit nor a new entry costs a commit.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	header_cache = project_constants.get('header_cache')
+
+	if header_cache is None:
+		return
+
+	with project_constants['header_cache_lock']:
+		write_header_cache_hits(header_cache, project_constants)
+		header_cache.commit()
+
+
+def generate_mapped_file_chunks(file_name, digests=None, chunk_size=1024*1024):
+	'''
+	Summary:
+		Reads a file chunk by chunk through a read-only memory map.  The chunks are buffers pointing into the map rather than copies of the data, so the file is sent from the page cache without being copied into Python strings, and each chunk is added to the file's MD5 digest as it goes, so that the file is only read once.
+	Args:
+		file_name: A string path to a file.
+		digests: Optionally, a dictionary to which the MD5 digest of the file is added (md5) once the whole file has been read.
+		chunk_size: An integer; the number of bytes in each chunk.
+	Returns:
+		A generator yielding the file as buffers.
+	'''
+
+	md5 = hashlib.md5()
+
+	with open(file_name, 'rb') as f:
+		file_size = os.fstat(f.fileno()).st_size
+
+		# An empty file can't be mapped.
+		if file_size > 0:
+			file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				for offset in xrange(0, file_size, chunk_size):
+					chunk = buffer(file_map, offset, chunk_size)
+					md5.update(chunk)
+					yield chunk
+			finally:
+				file_map.close()
+
+	if digests is not None:
+		digests['md5'] = md5.hexdigest()
+
+
+def generate_subject_IDs(project_constants, server_uploaded_strains, subject_metadata):
+	'''
+	Summary:
+		Generates SPReD IDs for the subjects contained in the subject metadata DataFrame.  An ID is a 2 digit base 36 strain code followed by the 2 digit base 36 number of the subject within its strain (counted in the order of the subject metadata).  Strains already in the project keep their strain code; new strains are given the first free strain code from their position among the strains of the subject metadata, and the IDs of their subjects are checked against every ID in the project (server_subject_IDs).  The program exits if an ID can't be generated.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		server_uploaded_strains: A dictionary mapping strain labels currently existing in the project to their strain codes.  New strains are added to it.
+		subject_metadata: A pandas DataFrame containing information about each individual subject to be inserted into the SPReD project.
+	Returns:
+		subject_metadata: An updated version of the DataFrame containing metadata about subjects with SPReD IDs added.
+	'''
+
+	num_codes = 36 ** 2
+	two_digit_codes = np.array([zero_pad_num(JeffUtility.convert_decimal_to_base(num, 36), 2) for num in range(num_codes)], dtype=object)
+
+	# Strains are numbered in the order they first appear, and subjects in the order they appear within their strain, starting at 1.
+	strain_labels = subject_metadata['ethnicity'].fillna('').astype(str)
+	strain_indices, strains = pd.factorize(strain_labels)
+	subj_nums = strain_labels.groupby(strain_labels, sort=False).cumcount().values + 1
+
+	if len(subj_nums) and subj_nums.max() >= num_codes:
+		notify_user('A strain has more than ' + str(num_codes - 1) + ' subjects, which is more than a 2 digit subject number can hold.', project_constants)
+		sys.exit()
+
+	used_strain_nums = get_used_strain_nums(project_constants['server_subject_IDs'], server_uploaded_strains, project_constants)
+	new_strains = []
+	strain_codes = []
+	for strain_count, strain_label in enumerate(strains, 1):
+		if strain_label not in server_uploaded_strains:
+			strain_code = assign_next_available_strain_code(used_strain_nums, strain_count)
+			if strain_code is None:
+				notify_user('There are no strain codes left for strain ' + strain_label + '.', project_constants)
+				sys.exit()
+			server_uploaded_strains[strain_label] = strain_code
+			new_strains.append(strain_label)
+		strain_codes.append(server_uploaded_strains[strain_label])
+
+	subject_metadata['SubjNum'] = np.array(strain_codes, dtype=object)[strain_indices] + two_digit_codes[subj_nums]
+
+	# Subjects of strains already in the project are meant to reuse their IDs; subjects of new strains must not.
+	subj_spred_IDs = project_constants['project_name'] + '_' + subject_metadata['SubjNum']
+	collisions = subj_spred_IDs[strain_labels.isin(new_strains) & subj_spred_IDs.isin(project_constants['server_subject_IDs'])]
+	if len(collisions):
+		notify_user('Generated IDs are already in use in the project: ' + ', '.join(collisions), project_constants)
+		sys.exit()
+
+	return subject_metadata
+
+
+def generate_throttled_chunks(chunks, project_constants):
+	'''
+	Summary:
+		Passes the chunks of a request body through the bandwidth limit (see throttle_bandwidth), so that every transfer draws from the same token bucket.
+	Args:
+		chunks: An iterable of strings or buffers; the body of a request.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A generator yielding the chunks, each once the bandwidth limit allows it to be sent.
+	'''
+
+	for chunk in chunks:
+		throttle_bandwidth(len(chunk), project_constants)
+		yield chunk
+
+
+def generate_zip_stream(file_names, subj_spred_ID, project_constants, chunk_size=1024*1024):
+	'''
+	Summary:
+		Generates a zip archive of a set of files chunk by chunk, without writing the archive to disk or holding it in memory.  The zipfile module in Python 2 can only write to seekable files, so the archive is built here using data descriptors (general purpose flag bit 3), which let the CRC and sizes of each member follow its data.  Members are named the same way zipfile.ZipFile.write names them.  Each file is compressed according to choose_compress_type.  When there are several files and several compression workers, files are compressed in parallel a few files ahead of the one being written (zlib releases the GIL).  Each file compressed ahead is handed on through a queue of at most compress_queue_chunks chunks, and its worker waits while the queue is full, so memory use stays bounded by the number of workers times compress_queue_chunks chunks whatever the size of the files.
+	Args:
+		file_names: A list of string paths to files.
+		subj_spred_ID: The well-formatted SPReD ID, used in the compression report.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		chunk_size: An integer; the number of bytes read from a file at a time.
+	Returns:
+		A generator yielding the archive as strings of bytes.
+	'''
+
+	# A worker puts the member's zinfo and stats, then its chunks, then None (or the error it ran into) in the member's queue.
+	# It gives up once the archive is abandoned, so that a worker waiting on a full queue doesn't block the pool from shutting down.
+	def compress_member_ahead(file_name, chunk_queue, abort_event):
+		def put(item):
+			while not abort_event.is_set():
+				try:
+					chunk_queue.put(item, timeout=0.1)
+					return True
+				except Queue.Full:
+					pass
+			return False
+
+		try:
+			zinfo = get_zip_info(file_name, choose_compress_type(file_name, project_constants))
+			member_stats = {'compress_secs': 0.0}
+			if not put((zinfo, member_stats)):
+				return
+			for chunk in compress_zip_member(file_name, zinfo, member_stats, project_constants, chunk_size):
+				if not put(chunk):
+					return
+		except Exception as e:
+			put(e)
+			return
+		put(None)
+
+	def get_member_item(chunk_queue):
+		item = chunk_queue.get()
+		if isinstance(item, Exception):
+			raise item
+		return item
+
+	def read_member_chunks(chunk_queue):
+		while True:
+			chunk = get_member_item(chunk_queue)
+			if chunk is None:
+				return
+			yield chunk
+
+	def iter_members():
+		num_compress_workers = min(project_constants['num_compress_workers'], len(file_names))
+
+		if num_compress_workers <= 1:
+			for file_name in file_names:
+				zinfo = get_zip_info(file_name, choose_compress_type(file_name, project_constants))
+				member_stats = {'compress_secs': 0.0}
+				yield file_name, zinfo, compress_zip_member(file_name, zinfo, member_stats, project_constants, chunk_size), member_stats
+			return
+
+		pool = ThreadPool(num_compress_workers)
+		abort_event = threading.Event()
+		try:
+			pending = collections.deque()
+			for file_name in file_names:
+				chunk_queue = Queue.Queue(maxsize=project_constants['compress_queue_chunks'])
+				pool.apply_async(compress_member_ahead, (file_name, chunk_queue, abort_event))
+				pending.append((file_name, chunk_queue))
+				# Only compress a bounded number of files ahead of the one being written, one per worker.
+				if len(pending) >= num_compress_workers:
+					pending_name, pending_queue = pending.popleft()
+					zinfo, member_stats = get_member_item(pending_queue)
+					yield pending_name, zinfo, read_member_chunks(pending_queue), member_stats
+			while pending:
+				pending_name, pending_queue = pending.popleft()
+				zinfo, member_stats = get_member_item(pending_queue)
+				yield pending_name, zinfo, read_member_chunks(pending_queue), member_stats
+		finally:
+			abort_event.set()
+			pool.terminate()
+			pool.join()
+
+	central_directory = []
+	offset = 0
+
+	for file_name, zinfo, chunks, member_stats in iter_members():
+		zinfo.header_offset = offset
+		dos_date = (zinfo.date_time[0] - 1980) << 9 | zinfo.date_time[1] << 5 | zinfo.date_time[2]
+		dos_time = zinfo.date_time[3] << 11 | zinfo.date_time[4] << 5 | (zinfo.date_time[5] // 2)
+
+		# Local file header; the CRC and sizes are left at 0 and written in the data descriptor instead.
+		local_header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, 20, 0, zinfo.flag_bits, zinfo.compress_type, dos_time, dos_date, 0, 0, 0, len(zinfo.filename), 0) + zinfo.filename
+		yield local_header
+		offset += len(local_header)
+
+		for chunk in chunks:
+			yield chunk
+
+		if zinfo.file_size > zipfile.ZIP64_LIMIT or offset + zinfo.compress_size > zipfile.ZIP64_LIMIT:
+			raise zipfile.LargeZipFile('Streamed zip archives larger than 4 GB are not supported: ' + file_name)
+
+		data_descriptor = struct.pack('<4s3L', b'PK\x07\x08', zinfo.CRC, zinfo.compress_size, zinfo.file_size)
+		yield data_descriptor
+		offset += zinfo.compress_size + len(data_descriptor)
+
+		central_directory.append(struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, 20, 3, 20, 0, zinfo.flag_bits, zinfo.compress_type, dos_time, dos_date,
+			zinfo.CRC, zinfo.compress_size, zinfo.file_size, len(zinfo.filename), 0, 0, 0, 0, zinfo.external_attr, zinfo.header_offset) + zinfo.filename)
+
+		record_compression_stats(subj_spred_ID, file_name, zinfo, member_stats['compress_secs'], project_constants)
+
+	central_directory = b''.join(central_directory)
+	yield central_directory
+	yield struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len(file_names), len(file_names), len(central_directory), offset, 0)
+
+
+def get_bandwidth_limit(project_constants, now=None):
+	'''
+	Summary:
+		Returns the bandwidth limit in force: the limit of the first window of the bandwidth schedule containing the time of day, or bandwidth_limit outside them.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		now: Optionally, the datetime to look up; the current time if it isn't given.
+	Returns:
+		The limit in bytes per second, or None if transfers aren't limited.
+	'''
+
+	if now is None:
+		now = datetime.datetime.now()
+	minute = now.hour * 60 + now.minute
+
+	limit = project_constants['bandwidth_limit']
+	for start, end, window_limit in project_constants['bandwidth_schedule']:
+		# A window ending before it starts runs over midnight.
+		if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+			limit = window_limit
+			break
+
+	if limit is None:
+		return None
+
+	return limit * 1024.0 * 1024.0
+
+
+def get_changed_metadata(params, field_paths, server_fields):
+	'''
+	Summary:
+		Compares the metadata that would be uploaded for a subject, session or scan with the metadata SPReD already has, so that only the changed fields are sent.
+	Args:
+		params: A dictionary of REST parameters, as returned by get_subject_metadata, get_session_metadata or get_scan_metadata.
+		field_paths: A dictionary mapping the parameters to compare to the paths of their fields in SPReD (e.g. demographics/dob).
+		server_fields: A dictionary of the fields SPReD has, as returned by get_xnat_item_fields.
+	Returns:
+		changed_params: A dictionary of the parameters that are missing or different in SPReD.
+	'''
+
+	def is_same_value(value, server_value):
+		if server_value is None:
+			return False
+		# Numbers may come back formatted differently (e.g. 2 and 2.0).
+		try:
+			value, server_value = float(value), float(server_value)
+			return abs(value - server_value) <= 1e-6 * max(abs(value), abs(server_value))
+		except (TypeError, ValueError):
+			return ('%s' % (value,)).strip() == ('%s' % (server_value,)).strip()
+
+	changed_params = {}
+	for key, path in field_paths.items():
+		if not is_same_value(params[key], server_fields.get(path)):
+			changed_params[key] = params[key]
+
+	return changed_params
+
+
+def get_current_zip_files(url, server_files, file_names, project_constants):
+	'''
+	Summary:
+		Finds the zip files of a SPReD resource, left by earlier uploads, that still hold the current local files.  The manifest recorded when a zip file was uploaded (see record_zip_manifests) must match its size, and its digest when SPReD reports one, and every file it holds must still exist locally with the same size and modification time.  Without the header cache, no zip file can be matched.
+	Args:
+		url: A string specifying the url of the resource's files (ending in /files/).
+		server_files: The listing of the resource, as returned by get_server_resource_files.
+		file_names: A list of string paths to the local files of the resource.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		current_zips: A dictionary mapping the name of every current zip file to the list of local files it holds.
+	'''
+
+	header_cache = project_constants.get('header_cache')
+	current_zips = {}
+
+	if header_cache is None:
+		return current_zips
+
+	local_files = dict((os.path.abspath(file_name), file_name) for file_name in file_names)
+
+	for server_name, server_file in server_files.items():
+		if not server_name.endswith('.zip'):
+			continue
+
+		with project_constants['header_cache_lock']:
+			cache_row = header_cache.execute('SELECT size, md5, members FROM zip_files WHERE path = ?', (url + server_name,)).fetchone()
+		if cache_row is None:
+			continue
+
+		zip_size, zip_md5, members = cache_row[0], cache_row[1], json.loads(cache_row[2])
+		if 'size' in server_file and int(server_file['size']) != zip_size:
+			continue
+		if zip_md5 and server_file.get('digest') and str(server_file['digest']).lower() != zip_md5:
+			continue
+
+		try:
+			local_entries = [get_file_entry(path, project_constants) if path in local_files else None for path, size, mtime in members]
+		except OSError:
+			continue
+		if not all(entry is not None and [entry['size'], entry['mtime']] == [size, mtime] for entry, (path, size, mtime) in zip(local_entries, members)):
+			continue
+
+		with project_constants['header_cache_lock']:
+			project_constants['header_cache_hits'][('zip_files', url + server_name)] = time.time()
+		current_zips[server_name] = [local_files[path] for path, size, mtime in members]
+
+	return current_zips
+
+
+def get_directory_entries(dir_name, project_constants):
+	'''
+	Summary:
+		Returns the entries of a directory from the directory index (see init_directory_index), listing the directory with scan_directory and adding it to the index if it isn't there yet.
+	Args:
+		dir_name: A string path to a directory.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		entries: A dictionary mapping the names in the directory to dictionaries with their size, mtime and is_dir.  Raises OSError if the directory can't be listed.
+	'''
+
+	dir_name = os.path.abspath(dir_name)
+
+	with project_constants['directory_index_lock']:
+		entries = project_constants['directory_index'].get(dir_name)
+
+	if entries is None:
+		try:
+			entries = scan_directory(dir_name)
+		except OSError as e:
+			entries = e
+		with project_constants['directory_index_lock']:
+			project_constants['directory_index'][dir_name] = entries
+
+	# A directory that couldn't be listed is indexed with its error.
+	if isinstance(entries, OSError):
+		raise entries
+
+	return entries
+
+
+def get_file_entry(file_name, project_constants):
+	'''
+	Summary:
+		Returns the size, modification time and type of a file from the directory index when its directory has been indexed, and from the file itself otherwise.
+	Args:
+		file_name: A string path to a file.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A dictionary with the size, mtime and is_dir of the file.  Raises OSError if the file doesn't exist.
+	'''
+
+	dir_name, name = os.path.split(os.path.abspath(file_name))
+
+	with project_constants['directory_index_lock']:
+		entries = project_constants['directory_index'].get(dir_name)
+
+	if isinstance(entries, dict) and name in entries:
+		return entries[name]
+
+	file_stat = os.stat(file_name)
+	return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'is_dir': stat.S_ISDIR(file_stat.st_mode)}
+
+
+def get_file_md5(file_name, project_constants):
+	'''
+	Summary:
+		Computes the MD5 digest of a file.  If the header cache is enabled, digests are cached in it, keyed on the path, size and modification time of the file like MINC headers.
+	Args:
+		file_name: A string path to a file.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		md5: A string; the hexadecimal MD5 digest of the file.
+	'''
+
+	header_cache = project_constants.get('header_cache')
+
+	if header_cache is not None:
+		file_stat = os.stat(file_name)
+		cache_key = (os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime)
+		with project_constants['header_cache_lock']:
+			cache_row = header_cache.execute('SELECT md5 FROM file_digests WHERE path = ? AND size = ? AND mtime = ?', cache_key).fetchone()
+			if cache_row is not None:
+				project_constants['header_cache_hits'][('file_digests', cache_key[0])] = time.time()
+		if cache_row is not None:
+			return str(cache_row[0])
+
+	md5 = hashlib.md5()
+	with open(file_name, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024*1024), b''):
+			md5.update(chunk)
+	md5 = md5.hexdigest()
+
+	if header_cache is not None:
+		record_file_md5(file_name, file_stat, md5, project_constants)
+
+	return md5
+
+
+def get_measured_throughput(project_constants):
+	'''
+	Summary:
+		Finds the throughput of the most recent upload that sent any files, from the run record in its metrics file (see record_metric), to estimate how long a new upload will take.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		throughput: A float; the aggregate throughput in bytes per second, or None if no previous upload was measured.
+		num_workers: An integer; the number of workers of that upload, or None.
+	'''
+
+	log_dir = os.path.dirname(project_constants['log_file'].name)
+	metrics_fname = project_constants['metrics_file'].name if project_constants['metrics_file'] is not None else None
+
+	# The log files are named after the time the upload started, so the newest sort last.
+	for fname in sorted(os.listdir(log_dir), reverse=True):
+		fname = os.path.join(log_dir, fname)
+		if not fname.endswith(' metrics.jsonl') or fname == metrics_fname:
+			continue
+		with open(fname) as metrics_file:
+			for line in metrics_file:
+				try:
+					metric = json.loads(line)
+				except ValueError:
+					continue
+				# The plan counts the bytes of the files before compression, so the throughput is measured against the bytes the run planned to send when they were recorded.
+				planned_bytes = metric.get('planned_bytes', metric.get('bytes')) if metric['phase'] == 'run' else None
+				if planned_bytes and metric['secs'] > 0:
+					return planned_bytes / metric['secs'], metric.get('workers', 1)
+
+	return None, None
+
+
+def get_minc_header(MINC_filename, project_constants):
+	'''
+	Summary:
+		Calls a single mincheader subprocess to extract every attribute from the header of a MINC file.  The mincheader command is a specific command offered by MINC tools, and works for both MINC1 (NetCDF) and MINC2 (HDF5) files.  If the header cache is enabled, a header parsed by a previous run is reused as long as the file's size and modification time haven't changed.
+	Args:
+		MINC_filename: The MINC file to extract the header from.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		minc_header: A dictionary mapping field names (e.g. vnmr:tr) to their values, formatted the same way as mincinfo -attvalue would print them.  Empty if the header could not be read.
+	'''
+
+	header_cache = project_constants.get('header_cache')
+	start_time = time.time()
+
+	if header_cache is not None:
+		file_stat = os.stat(MINC_filename)
+		cache_key = (os.path.abspath(MINC_filename), file_stat.st_size, file_stat.st_mtime)
+
+		with project_constants['header_cache_lock']:
+			cache_row = header_cache.execute('SELECT header FROM minc_headers WHERE path = ? AND size = ? AND mtime = ?', cache_key).fetchone()
+			if cache_row is not None:
+				# The last use is written by flush_header_cache, not on every hit.
+				project_constants['header_cache_hits'][('minc_headers', cache_key[0])] = time.time()
+				record_metric('header', None, time.time() - start_time, project_constants, file=MINC_filename, cached=True)
+				return dict((key.encode('utf-8'), value.encode('utf-8')) for key, value in json.loads(cache_row[0]).items())
+
+	try:
+		header_text = subprocess.check_output(["mincheader", MINC_filename])
+	except (subprocess.CalledProcessError, OSError):
+		record_metric('header', None, time.time() - start_time, project_constants, file=MINC_filename, cached=False, status='failed')
+		return {}
+
+	minc_header = parse_minc_header(header_text)
+
+	if header_cache is not None and minc_header:
+		with project_constants['header_cache_lock']:
+			store_header_cache_entry(header_cache, 'minc_headers', cache_key[0], {'size': cache_key[1], 'mtime': cache_key[2], 'header': json.dumps(minc_header)}, project_constants)
+
+	record_metric('header', None, time.time() - start_time, project_constants, file=MINC_filename, cached=False)
+
+	return minc_header
+
+
+def get_registration_files(processed_subj_dir, project_constants):
+	'''
+	Summary:
+		Given the processed image folder associated with a subject, return a list of all registration files to be uploaded associated with the original file (e.g. lsq6, lsq12, nlin, processed).  The folders are looked up in the directory index, so they are only listed once per upload.
+	Args:
+		processed_subj_dir: The name of the processed folder associated with the subject currently being uploaded.  Reason this needs to be supplied is that there could be several processed folders per strain, so the user must specify which one to upload.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		registration_files: A list of associated registration files (lsq6, lsq12, nlin, stats_volumes) for a MINC file.
+	'''
+
+	# Old stuff which assumed that there was a single processed folder 2 folders above the distortion corrected images folder.
+	# path_tuple = os.path.split(MINC_filename)
+	# basename = path_tuple[1]
+	# current_dir = path_tuple[0]
+	# parent_dir = os.path.dirname(current_dir)
+	# grandparent_dir = os.path.dirname(parent_dir)
+	# all_items = os.listdir(grandparent_dir)
+	# for item in all_items:
+	# 	if 'processed' in item:
+	# 		processed_dir = os.path.join(grandparent_dir, item)
+	# 		break
+	# processed_subj_dir = os.path.join(processed_dir, basename[0:-4])
+
+	resampled_dir = os.path.join(processed_subj_dir, 'resampled')
+	stats_dir = os.path.join(processed_subj_dir, 'stats-volumes')
+	
+	# List of all relevant registration files for a subject.
+	registration_files = []
+
+	resampled_files = sorted(get_directory_entries(resampled_dir, project_constants))
+	for registration in resampled_files:
+		registration_files.append(os.path.join(resampled_dir, registration))
+
+	stats_files = sorted(get_directory_entries(stats_dir, project_constants))
+	for registration in stats_files:
+		registration_files.append(os.path.join(stats_dir, registration))
+
+	return registration_files
+
+
+def get_resource_file_name(file_name, base_dir=None):
+	'''
+	Summary:
+		Returns the path of a file within a SPReD resource when it is uploaded individually.  Registration files keep their path relative to the processed folder (e.g. resampled/... and stats-volumes/...), so files with the same name in different folders don't collide.
+	Args:
+		file_name: A string path to a file.
+		base_dir: The folder the path is relative to, or None to use the file's name only.
+	Returns:
+		A string path using forward slashes.
+	'''
+
+	if base_dir is None:
+		return os.path.basename(file_name)
+
+	return os.path.relpath(file_name, base_dir).replace(os.sep, '/')
+
+
+def get_resource_metadata(project_constants):
+	'''
+	Summary:
+		Populate resource metadata.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		resource_params: A dictionary of name:value pairs needed to upload SPReD resources.
+	'''
+
+	resource_params = {
+		'format': project_constants['file_type'],
+		'content': project_constants['scan_type']
+	}
+
+	return resource_params
+
+
+def get_scan_metadata(minc_header, project_constants):
+	'''
+	Summary:
+		Extract scan metadata from the header of a MINC file (minc_header) and return a dictionary mapping XNAT XML (keys) to MINC metadata (values).
+	Args:
+		minc_header: A dictionary of MINC header fields, as returned by get_minc_header.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		scan_params: A dictionary containing relevant scan metadata name value pairs for a given MINC file.
+	'''
+
+	# constant key-value pairs go here which are the same for every subject
+	scan_params = {
+		'xsiType': 'xnat:mrScanData',
+		'xnat:mrScanData/type': project_constants['scan_type'],  # double check that this is the format SPReD wants
+		'xnat:mrScanData/quality': project_constants['quality'],
+		'xnat:mrScanData/scanner': project_constants['scanner'],
+		'xnat:mrScanData/scanner/manufacturer': project_constants['scanner_manufacturer'],
+		'xnat:mrScanData/fieldStrength': project_constants['field_strength']
+	}
+
+	# retrieve relevant fields from the mincheader
+	pslabel = minc_header.get('vnmr:pslabel')
+	seqfil = minc_header.get('vnmr:seqfil')
+	lpe = minc_header.get('vnmr:lpe')
+	lpe2 = minc_header.get('vnmr:lpe2')
+	lro = minc_header.get('vnmr:lro')
+	nv = minc_header.get('vnmr:nv')
+	nv2 = minc_header.get('vnmr:nv2')
+	np = minc_header.get('vnmr:np')
+	orient = minc_header.get('vnmr:orient')
+	tr = minc_header.get('vnmr:tr')
+	te = minc_header.get('vnmr:te')
+	ti = minc_header.get('vnmr:ti')
+
+	# omitted xnat:mrScanData/startTime = time since it's in the session anyway
+	# time must be of type xs:time
+
+	# TODO - refactor these lines to be single line statements with a helper function
+	# fov and matr don't allow 3D values
+	# fov must have integer values, yet MINC has them in float values
+	if pslabel is not None:
+		scan_params['xnat:mrScanData/series_description'] = pslabel
+	if lpe is not None and nv is not None:
+		scan_params['xnat:mrScanData/parameters/voxelRes/x'] = float(lpe) / float(nv)
+	if lpe2 is not None and nv2 is not None:
+		scan_params['xnat:mrScanData/parameters/voxelRes/y'] = float(lpe2) / float(nv2)
+	if lro is not None and np is not None:
+		scan_params['xnat:mrScanData/parameters/voxelRes/z'] = float(lro) / (float(np) / 2)
+	if orient is not None:
+		scan_params['xnat:mrScanData/parameters/orientation'] = orient
+	# These are not handled well because they aren't 3D and sometimes they're int, sometimes they're float.
+	# if lpe is not None:
+	# 	scan_params['xnat:mrScanData/parameters/fov/x'] = float(lpe)
+	# if lpe2 is not None:
+	# 	scan_params['xnat:mrScanData/parameters/fov/y'] = float(lpe2)
+	# if nv is not None:
+	# 	scan_params['xnat:mrScanData/parameters/matrix/x'] = int(nv)
+	# if nv2 is not None:
+	# 	scan_params['xnat:mrScanData/parameters/matrix/y'] = int(nv2)
+	if tr is not None:
+		scan_params['xnat:mrScanData/parameters/tr'] = float(tr)
+	if te is not None:
+		scan_params['xnat:mrScanData/parameters/te'] = float(te)
+	if ti is not None:
+		scan_params['xnat:mrScanData/parameters/ti'] = float(ti)
+	if project_constants['flip_angle'] is not None:
+		scan_params['xnat:mrScanData/parameters/flip'] = int(project_constants['flip_angle'])
+	if seqfil is not None:
+		scan_params['xnat:mrScanData/parameters/sequence'] = seqfil
+	if project_constants['file_type'] is not None:
+		scan_params['xnat:mrScanData/parameters/imageType'] = project_constants['file_type']
+
+	return scan_params
+
+
+def get_scan_uploads(MINC_filename, subj_spred_ID, session_name, processed_subj_dir, project_constants):
+	'''
+	Summary:
+		Lists the file uploads of a scan that haven't been completed yet (by the run being resumed): the distortion corrected image to the first resource, and the resampled and stats registrations to the second.
+	Args:
+		MINC_filename: The name of the MINC file to upload.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		session_name: The well-formatted session name.
+		processed_subj_dir: The processed folder containing the registrations of the MINC file.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		uploads: A list of dictionaries with the journal step, file_names, url, zip_name, action and base_dir of each upload, and whether its files are always uploaded individually (the MINC file with --raw-minc).
+	'''
+
+	scan_url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID + '/experiments/' + session_name + '/scans/' + str(int(project_constants['scan_num']))
+	uploads = []
+
+	# Upload the distortion corrected image 
+	if not is_step_completed(subj_spred_ID, 'distortion corrected file', MINC_filename, project_constants):
+		uploads.append({'step': 'distortion corrected file', 'file_names': [MINC_filename],
+			'url': scan_url + '/resources/' +  str(int(project_constants['resource_num'])) + '/files/',
+			'zip_name': subj_spred_ID + '_distortion_corrected' + '.zip', 'action': 'upload distortion corrected', 'base_dir': None,
+			'individually': project_constants['raw_minc_upload']})
+
+	# Upload additional registrations of an image
+	if not is_step_completed(subj_spred_ID, 'registrations file', MINC_filename, project_constants):
+		uploads.append({'step': 'registrations file', 'file_names': get_registration_files(processed_subj_dir, project_constants),
+			'url': scan_url + '/resources/' +  str(int(project_constants['resource_num']) + 1) + '/files/',
+			'zip_name': subj_spred_ID + '_registrations' + '.zip', 'action': 'upload resampled and stats registrations', 'base_dir': processed_subj_dir,
+			'individually': False})
+
+	return uploads
+
+
+def get_server_project_snapshot(project_constants, columns):
+	'''
+	Summary:
+		Retrieves the subject listing of the project in a single request, limited to the requested columns.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		columns: A list of subject listing columns to request (e.g. label, ethnicity).
+	Returns:
+		subjects_json: A list of dictionaries, one per subject in the project, mapping lower case column names to values.
+	'''
+
+	subjects_url = project_constants['base_url'] + project_constants['project_name'] + '/subjects'
+
+	subjects_resp = send_request('get', subjects_url, 'listing subjects', project_constants['project_name'], project_constants, params={'format': 'json', 'columns': ','.join(columns)})
+	subjects_json = subjects_resp.json()['ResultSet']['Result']
+
+	return [dict((str(key).lower(), value) for key, value in subject.items()) for subject in subjects_json]
+
+
+def get_server_resource_files(url, subj_spred_ID, project_constants):
+	'''
+	Summary:
+		Retrieves the listing of the files in a SPReD resource.
+	Args:
+		url: A string specifying the url of the resource's files (ending in /files/).
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		server_files: A dictionary mapping file names (paths within the resource) to dictionaries of their listing columns (lower case, e.g. size, digest, uri), or None if the resource doesn't exist.
+	'''
+
+	resp = send_request('get', url, 'listing resource files', subj_spred_ID, project_constants, accept_statuses=[404], params={'format': 'json'})
+
+	if resp.status_code == 404:
+		return None
+
+	server_files = {}
+	for server_file in resp.json()['ResultSet']['Result']:
+		server_name, server_file = parse_server_file(server_file)
+		server_files[server_name] = server_file
+
+	return server_files
+
+
+def get_server_scan_files(scan_url, subj_spred_ID, project_constants):
+	'''
+	Summary:
+		Retrieves the listing of the files in every resource of a SPReD scan with a single request.
+	Args:
+		scan_url: A string specifying the url of the scan.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		server_resources: A dictionary mapping resource labels to file listings like the ones returned by get_server_resource_files, or None if the scan doesn't exist.
+	'''
+
+	resp = send_request('get', scan_url + '/files', 'listing scan files', subj_spred_ID, project_constants, accept_statuses=[404], params={'format': 'json'})
+
+	if resp.status_code == 404:
+		return None
+
+	server_resources = {}
+	for server_file in resp.json()['ResultSet']['Result']:
+		server_name, server_file = parse_server_file(server_file)
+		# The collection column holds the label of the file's resource.
+		server_resources.setdefault(str(server_file.get('collection')), {})[server_name] = server_file
+
+	return server_resources
+
+
+def get_server_subject(subj_spred_ID, project_constants):
+	'''
+	Summary:
+		Retrieves a subject with a single request, including the metadata of its sessions, scans and resources.
+	Args:
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		The subject's item in the XNAT JSON format (with data_fields and children), or None if the subject doesn't exist.
+	'''
+
+	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
+	resp = send_request('get', url, 'retrieving subject', subj_spred_ID, project_constants, accept_statuses=[404], params={'format': 'json'})
+
+	if resp.status_code == 404:
+		return None
+
+	return resp.json()['items'][0]
+
+
+def get_server_subject_IDs(project_constants, subjects_json=None):
+	'''
+	Summary:
+		Retrieves the spred IDs currently in use in the project.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		subjects_json: Optionally, a subject listing already returned by get_server_project_snapshot.
+	Returns:
+		server_subject_IDs: A set containing spred IDs currently in use in the project.
+	'''
+
+	if subjects_json is None:
+		subjects_json = get_server_project_snapshot(project_constants, ['label'])
+
+	# str strips unicode chars (u'')
+	server_subject_IDs = set(str(subject['label']) for subject in subjects_json)
+
+	return server_subject_IDs
+
+
+def get_server_subject_strain(subject, project_constants):
+	'''
+	Summary:
+		Retrieves the strain (ethnicity) of a single subject already in the project.
+	Args:
+		subject: The SPReD ID of the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		ethnicity: A string representing the strain of the subject, or None if the subject has no strain.
+	'''
+
+	url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subject
+	subject_resp = send_request('get', url, 'retrieving subject', subject, project_constants, params={'format': 'json'})
+	subject_json = subject_resp.json()
+
+	# Transforms the complex data structure into a generator which can be looped over as a list of lists.
+	subject_info = JeffUtility.dict_generator(subject_json)
+
+	for line in subject_info:
+		# Get the json part that has ethnicity.
+		if 'ethnicity' in line:
+			return str(line[-1])
+
+	return None
+
+
+def get_server_uploaded_strains(project_constants, server_subject_IDs, subjects_json=None):
+	'''
+	Summary:
+		Returns a dictionary to use to keep track of the strains which have already been uploaded and the SPReD strain codes used for those strains.  Uses the ethnicity column of the subject listing when the server provided it, otherwise falls back to retrieving each subject with a bounded number of concurrent requests.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		server_subject_IDs: A collection containing all SPReD IDs in the project being uploaded to before initiating the upload.
+		subjects_json: Optionally, a subject listing already returned by get_server_project_snapshot.
+	Returns:
+		server_uploaded_strains: A dictionary mapping mouse strains currently in the SPReD project to their respective strain codes.
+	'''
+
+	server_uploaded_strains = {}
+
+	if subjects_json is not None and all('ethnicity' in subject for subject in subjects_json):
+		subject_strains = [(str(subject['label']), subject['ethnicity']) for subject in subjects_json]
+	else:
+		subjects = sorted(server_subject_IDs)
+		pool = ThreadPool(project_constants['num_metadata_workers'])
+		try:
+			strains = pool.map(lambda subject: get_server_subject_strain(subject, project_constants), subjects)
+		finally:
+			pool.close()
+			pool.join()
+		subject_strains = zip(subjects, strains)
+
+	for subject, ethnicity in subject_strains:
+		if ethnicity:
+			ethnicity = str(ethnicity)
+			if ethnicity not in server_uploaded_strains:
+				server_uploaded_strains[ethnicity] = subject[-4:-2]
+
+	return server_uploaded_strains
+
+
+def get_session_metadata(minc_header, session_name, project_constants):
+	'''
+	Summary:
+		Extract session metadata from the header of a MINC file (minc_header) and return a dictionary mapping XNAT XML (keys) to MINC metadata (values).
+	Args:
+		minc_header: A dictionary of MINC header fields, as returned by get_minc_header.
+		session_name: A string representing the well-formatted SPReD session name.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		session_params: A dictionary containing relevant session metadata name value pairs for a given MINC file.
+	'''
+
+	# add constant key-values here
+	session_params = {
+		'xsiType': 'xnat:mrSessionData',
+		'xnat:mrSessionData/visit_id': int(project_constants['visit_num']), 
+		'xnat:mrSessionData/project': project_constants['project_name'],  # don't include this!  it generates a 403 for some reason
+		'xnat:mrSessionData/label': session_name,
+		'xnat:mrSessionData/scanner': project_constants['scanner'],
+		'xnat:mrSessionData/scanner/manufacturer': project_constants['scanner_manufacturer'],
+		'xnat:mrSessionData/modality':  project_constants['modality'],
+		'xnat:mrSessionData/fieldStrength': project_constants['field_strength'],
+		'xnat:mrSessionData/acquisition_site': project_constants['acquisition_site']
+	}
+
+	ni = float(minc_header.get('vnmr:ni'))
+	nf = float(minc_header.get('vnmr:nf'))
+	nfid = float(minc_header.get('vnmr:nfid'))
+	nt = float(minc_header.get('vnmr:nt'))
+	tr = float(minc_header.get('vnmr:tr'))
+	etl = float(minc_header.get('vnmr:etl'))
+	
+	# TODO - look into when this bug has been fixed
+	# duration isn't handled properly for some reason
+	# this is a confirmed bug on XNAT's end
+	# if ni is not None and nf is not None and nfid is not None and nt is not None and tr is not None and etl is not None:
+	# 	duration_secs = int(ni) * int(nf) * int(nfid) * int(nt) * int(tr)  / int(etl)
+	# 	# format duration value into xs:duration format
+	# 	hours = math.floor(duration_secs / (60*60))
+	# 	leftover = duration_secs - hours*60*60
+	# 	minutes = math.floor(leftover / 60)
+	# 	leftover = leftover - minutes*60
+	# 	seconds = leftover
+	# 	xs_duration = 'PT' + str(int(hours)) + 'H' + str(int(minutes)) + 'M' + str(int(seconds)) + 'S'
+	# 	session_params['xnat:mrSessionData/duration'] = xs_duration
+	
+	coil = minc_header.get('vnmr:rfcoil')
+	if coil is not None:
+		session_params['xnat:mrSessionData/coil'] = coil
+
+	datetime = minc_header.get('vnmr:time_submitted')
+	if datetime is not None:
+		date = datetime[0:8]
+		date = insert(date, '-', 6)
+		date = insert(date, '-', 4)
+		# date should conform to YYYY-MM-DD format
+		session_params['xnat:mrSessionData/date'] = date
+		time = datetime[9:len(datetime)]
+		time = insert(time, ':', 4)
+		time = insert(time, ':', 2)
+		# time should conform to HH:MM:SS format
+		session_params['xnat:mrSessionData/time'] = time
+	
+	operator = minc_header.get('study:operator')
+	if operator is not None:
+		session_params['xnat:mrSessionData/operator'] = operator
+
+	return session_params
+
+
+def get_subject_metadata(row, project_constants):
+	'''
+	Summary:
+		Extracts subject metadata from a row from a pandas data frame (row) and creates a dictionary mapping XNAT XML (keys) to MINC metadata (values).
+	Args:
+		row: A row in a pandas data frame representing subject metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		subj_params: A dictionary containing subject metadata.
+	'''
+
+	subj_params = {
+		'pi_firstname': project_constants['pi_firstname'],
+		'pi_lastname': project_constants['pi_lastname']
+	}
+	
+	if pd.notnull(row['Genotype']):
+		subj_params['group'] = row['Genotype']
+	if pd.notnull(row['dob']):
+		subj_params['dob'] = row['dob']
+	if pd.notnull(row['gender']):
+		subj_params['gender'] = row['gender']
+	if pd.notnull(row['handedness']):
+		subj_params['handedness'] = row['handedness']
+	if pd.notnull(row['race']):
+		subj_params['race'] = row['race']
+	if pd.notnull(row['ethnicity']):
+		subj_params['ethnicity'] = row['ethnicity']
+	if pd.notnull(row['weight']):
+		subj_params['weight'] = row['weight']
+	if pd.notnull(row['height']):
+		subj_params['height'] = row['height']
+
+	return subj_params
+
+
+def get_subject_schedule(plan, num_workers):
+	'''
+	Summary:
+		Orders the subjects to upload largest first, so that with several workers the biggest subjects start early instead of being left for the end, and predicts how the bytes will be shared between the workers.  The pool hands the next subject to the first worker that is free, so the prediction assigns each subject to the least loaded worker.  IDs have already been assigned in the order of the subject metadata, so this doesn't change them.
+	Args:
+		plan: A list of the subjects of the upload, as returned by get_upload_plan.
+		num_workers: An integer; the number of subjects uploaded concurrently.
+	Returns:
+		schedule: A list of the plan entries to upload, in the order they should be started.
+		worker_loads: A list of the number of bytes predicted to be uploaded by each worker.
+	'''
+
+	schedule = [entry for entry in plan if entry['upload']]
+
+	# With a single worker the order doesn't change how long the upload takes, so the order of the subject metadata is kept.
+	if num_workers > 1:
+		schedule.sort(key=lambda entry: entry['bytes'], reverse=True)
+
+	worker_loads = [0] * num_workers
+	for entry in schedule:
+		worker_loads[worker_loads.index(min(worker_loads))] += entry['bytes']
+
+	return schedule, worker_loads
+
+
+def get_subject_spred_names(row, project_constants):
+	'''
+	Summary:
+		Builds the SPReD subject ID and session name for a row of the subject metadata DataFrame.
+	Args:
+		row: A row in a pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		session_name: The well-formatted session name.
+	'''
+
+	subj_num = str(row['SubjNum'])
+	# subj_num = zero_pad_num(subj_num, 4)
+
+	subj_spred_ID = project_constants['project_name'] + '_' + subj_num
+	session_name = subj_spred_ID + '_' +  project_constants['visit_num'] + '_' + 'SE' +  project_constants['session_num'] + '_' +  project_constants['modality']
+
+	return subj_spred_ID, session_name
+
+
+def get_subject_xml(subj_spred_ID, subj_params, session_params, scan_params, project_constants):
+	'''
+	Summary:
+		Builds an XNAT XML document describing a subject, its session and its scan from the metadata used to create them one at a time.  Elements are written in the order of the XNAT schema.
+	Args:
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		subj_params: A dictionary of subject metadata, as returned by get_subject_metadata.
+		session_params: A dictionary of session metadata, as returned by get_session_metadata.
+		scan_params: A dictionary of scan metadata, as returned by get_scan_metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A string containing the XML document.
+	'''
+
+	xnat_ns = 'http://nrg.wustl.edu/xnat'
+	xsi_ns = 'http://www.w3.org/2001/XMLSchema-instance'
+	ET.register_namespace('xnat', xnat_ns)
+	ET.register_namespace('xsi', xsi_ns)
+	xsi_type = '{' + xsi_ns + '}type'
+
+	def add_element(parent, tag, text=None, attrib=None):
+		attrib = dict((name, '%s' % (value,)) for name, value in (attrib or {}).items() if value is not None)
+		if text is None and not attrib:
+			return None
+		element = ET.SubElement(parent, '{' + xnat_ns + '}' + tag, attrib)
+		if text is not None:
+			element.text = '%s' % (text,)
+		return element
+
+	session_value = lambda field: session_params.get('xnat:mrSessionData/' + field)
+	scan_value = lambda field: scan_params.get('xnat:mrScanData/' + field)
+
+	subject = ET.Element('{' + xnat_ns + '}Subject', {'project': project_constants['project_name'], 'label': subj_spred_ID})
+	if subj_params.get('group') is not None:
+		subject.set('group', '%s' % (subj_params['group'],))
+
+	investigator = ET.SubElement(subject, '{' + xnat_ns + '}investigator')
+	add_element(investigator, 'firstname', subj_params.get('pi_firstname'))
+	add_element(investigator, 'lastname', subj_params.get('pi_lastname'))
+
+	demographics = ET.SubElement(subject, '{' + xnat_ns + '}demographics', {xsi_type: 'xnat:demographicData'})
+	for field in ['dob', 'gender', 'handedness', 'race', 'ethnicity', 'weight', 'height']:
+		add_element(demographics, field, subj_params.get(field))
+
+	experiments = ET.SubElement(subject, '{' + xnat_ns + '}experiments')
+	session = add_element(experiments, 'experiment', attrib={
+		xsi_type: session_params['xsiType'],
+		'project': session_value('project'),
+		'label': session_value('label'),
+		'visit_id': session_value('visit_id'),
+		'modality': session_value('modality')
+	})
+	add_element(session, 'date', session_value('date'))
+	add_element(session, 'time', session_value('time'))
+	add_element(session, 'acquisition_site', session_value('acquisition_site'))
+	add_element(session, 'scanner', session_value('scanner'), {'manufacturer': session_value('scanner/manufacturer')})
+	add_element(session, 'operator', session_value('operator'))
+
+	scans = ET.SubElement(session, '{' + xnat_ns + '}scans')
+	scan = add_element(scans, 'scan', attrib={
+		xsi_type: scan_params['xsiType'],
+		'ID': int(project_constants['scan_num']),
+		'type': scan_value('type')
+	})
+	add_element(scan, 'quality', scan_value('quality'))
+	add_element(scan, 'series_description', scan_value('series_description'))
+	add_element(scan, 'scanner', scan_value('scanner'), {'manufacturer': scan_value('scanner/manufacturer')})
+	add_element(scan, 'fieldStrength', scan_value('fieldStrength'))
+	parameters = ET.SubElement(scan, '{' + xnat_ns + '}parameters')
+	add_element(parameters, 'voxelRes', attrib=dict((axis, scan_value('parameters/voxelRes/' + axis)) for axis in ['x', 'y', 'z']))
+	for field in ['orientation', 'tr', 'te', 'ti', 'flip', 'sequence', 'imageType']:
+		add_element(parameters, field, scan_value('parameters/' + field))
+
+	add_element(session, 'coil', session_value('coil'))
+	add_element(session, 'fieldStrength', session_value('fieldStrength'))
+
+	return ET.tostring(subject, encoding='UTF-8')
+
+
+def get_upload_plan(subject_metadata, preflight, project_constants):
+	'''
+	Summary:
+		Works out what the upload will do for every subject of the subject metadata, without changing anything in SPReD: whether the subject will be created, updated in place, or deleted and recreated, or why it will be skipped, and the files and bytes to upload.  Subjects with problems found by the pre-flight check are skipped.
+	Args:
+		subject_metadata: A pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		preflight: The results of the pre-flight check, as returned by check_subject_metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		plan: A list of dictionaries, one per subject, with the row, subject, file, action, upload (a boolean), num_files and bytes.
+	'''
+
+	plan = []
+
+	for index, row in subject_metadata.iterrows():
+
+		subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+		MINC_filename = row['Filename']
+		entry = {'row': row, 'subject': subj_spred_ID, 'file': MINC_filename, 'upload': False, 'num_files': 0, 'bytes': 0}
+		plan.append(entry)
+
+		if is_step_completed(subj_spred_ID, 'complete', MINC_filename, project_constants):
+			entry['action'] = 'skip (uploaded by the run being resumed)'
+			continue
+
+		if preflight[index]['problems']:
+			entry['action'] = 'skip (' + '; '.join(preflight[index]['problems']) + ')'
+			continue
+
+		entry['num_files'] = len(preflight[index]['file_names'])
+		entry['bytes'] = preflight[index]['bytes']
+		entry['upload'] = True
+
+		if subj_spred_ID not in project_constants['server_subject_IDs']:
+			entry['action'] = 'create'
+		elif project_constants['recreate_subjects']:
+			entry['action'] = 'delete and recreate'
+		else:
+			entry['action'] = 'update (only changed files)'
+
+	return plan
+
+
+def get_used_strain_nums(server_subject_IDs, server_uploaded_strains, project_constants):
+	'''
+	Summary:
+		Builds the index of strain codes in use in the project used by assign_next_available_strain_code: the strain codes of the strains in the project, and of every subject ID in the project, including subjects without a strain.
+	Args:
+		server_subject_IDs: A collection containing all SPReD IDs in the project being uploaded to before initiating the upload.
+		server_uploaded_strains: A dictionary mapping strain labels currently existing in the project to their strain codes.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		used_strain_nums: A sorted list of the strain codes in use, as base 10 integers.
+	'''
+
+	prefix = project_constants['project_name'] + '_'
+	strain_codes = set(server_uploaded_strains.values())
+	strain_codes.update(subject[-4:-2] for subject in server_subject_IDs if subject.startswith(prefix) and len(subject) == len(prefix) + 4)
+
+	used_strain_nums = set(JeffUtility.convert_base_to_decimal(strain_code, 36) for strain_code in strain_codes)
+	used_strain_nums.discard(-1)
+
+	return sorted(used_strain_nums)
+
+
+def get_xnat_child_item(item, field, id_field, id_value):
+	'''
+	Summary:
+		Finds a child of an item in the XNAT JSON format, e.g. a session of a subject or a scan of a session.
+	Args:
+		item: An item in the XNAT JSON format, or None.
+		field: A string; the field holding the children (e.g. experiments/experiment, scans/scan, file).
+		id_field: A string; the data field identifying the child (e.g. label, ID).
+		id_value: A string; the value of the data field of the child to find.
+	Returns:
+		The child item, or None if it doesn't exist.
+	'''
+
+	if item is None:
+		return None
+
+	for child in item.get('children', []):
+		if child.get('field') == field:
+			for child_item in child.get('items', []):
+				if str(child_item.get('data_fields', {}).get(id_field)) == id_value:
+					return child_item
+
+	return None
+
+
+def get_xnat_item_fields(item, prefix=''):
+	'''
+	Summary:
+		Flattens the fields of an item in the XNAT JSON format, including those of its nested elements (e.g. demographics, investigator), into paths such as demographics/dob.  Sessions, scans and resources are left out, since they are items of their own.
+	Args:
+		item: An item in the XNAT JSON format, or None.
+		prefix: The path of the item's fields, used when recursing.
+	Returns:
+		item_fields: A dictionary mapping field paths to values.
+	'''
+
+	item_fields = {}
+
+	if item is None:
+		return item_fields
+
+	for key, value in item.get('data_fields', {}).items():
+		item_fields[prefix + str(key)] = value
+
+	for child in item.get('children', []):
+		if child.get('field') in ['experiments/experiment', 'scans/scan', 'file', 'resources/resource']:
+			continue
+		for child_item in child.get('items', []):
+			item_fields.update(get_xnat_item_fields(child_item, prefix + str(child.get('field')) + '/'))
+
+	return item_fields
+
+
+def get_zip_info(file_name, compress_type):
+	'''
+	Summary:
+		Creates the zipfile.ZipInfo describing a file in a streamed zip archive, with its CRC and sizes zeroed so that compress_zip_member can fill them in.
+	Args:
+		file_name: A string path to a file.
+		compress_type: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+	Returns:
+		zinfo: A zipfile.ZipInfo.
+	'''
+
+	file_stat = os.stat(file_name)
+	zinfo = zipfile.ZipInfo(os.path.splitdrive(file_name)[1].lstrip(os.sep), time.localtime(file_stat.st_mtime)[0:6])
+	zinfo.external_attr = (file_stat.st_mode & 0xFFFF) << 16
+	zinfo.compress_type = compress_type
+	zinfo.flag_bits = 0x08
+	zinfo.file_size = 0
+	zinfo.compress_size = 0
+	zinfo.CRC = 0
+
+	return zinfo
+
+
+def init_audit_report(log_fname):
+	'''
+	Summary:
+		Creates the file recording the differences found by audit_project, next to the log file.  Every line is a JSON object.
+	Args:
+		log_fname: The name of the log file of the audit.
+	Returns:
+		audit_report: The audit report file handle.
+	'''
+
+	return open(os.path.splitext(log_fname)[0] + ' audit.jsonl', 'w')
+
+
+def init_compression_report(log_fname):
+	'''
+	Summary:
+		Creates a report recording how each uploaded file was compressed, next to the log file.
+	Args:
+		log_fname: The name of the log file of the upload.
+	Returns:
+		compression_report: The report file handle.
+	'''
+
+	compression_report = open(os.path.splitext(log_fname)[0] + ' compression.csv', 'w')
+	compression_report.writelines(','.join(['SPReD_ID', 'Filename', 'Method', 'Original_Bytes', 'Compressed_Bytes', 'Ratio', 'Seconds']) + '\n')
+
+	return compression_report
+
+
+def init_concurrency_control(project_constants):
+	'''
+	Summary:
+		Sets up the adaptive concurrency controller (see adjust_concurrency) when it is enabled.  The subjects in flight are bounded by adaptive_min_workers and -j, and the file transfers in flight (zip files and individual files, for every subject) by adaptive_min_file_workers and -j times --file-jobs.  Both limits start half way up.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	if not project_constants['adaptive_concurrency']:
+		project_constants['concurrency'] = None
+		return
+
+	max_workers = project_constants['num_workers']
+	max_file_workers = project_constants['num_workers'] * project_constants['num_file_workers']
+	bounds = {
+		'subjects': (min(project_constants['adaptive_min_workers'], max_workers), max_workers),
+		'files': (min(project_constants['adaptive_min_file_workers'], max_file_workers), max_file_workers)
+	}
+
+	project_constants['concurrency'] = {
+		'bounds': bounds,
+		'limits': dict((kind, max(low, (high + 1) // 2)) for kind, (low, high) in bounds.items()),
+		'in_flight': {'subjects': 0, 'files': 0},
+		'condition': threading.Condition(),
+		'window': {'start_time': time.time(), 'requests': 0, 'errors': 0, 'latencies': [], 'bytes': 0},
+		'lowest_latency': None,
+		'last_decision': None,
+		'last_throughput': 0.0
+	}
+
+
+def init_connection_pool(project_constants):
+	'''
+	Summary:
+		Sizes the connection pool of the shared requests session to the number of concurrent uploads (subjects times files per subject), so that concurrent uploads reuse connections instead of opening and discarding them.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, project_constants['num_workers'] * project_constants['num_file_workers']))
+	project_constants['session'].mount('https://', adapter)
+	project_constants['session'].mount('http://', adapter)
+
+
+def init_directory_index(subject_metadata, project_constants):
+	'''
+	Summary:
+		Builds the in-memory index of the processed folders used by get_registration_files and the pre-flight check: every processed root (the folder containing the subjects' processed folders) and the resampled and stats-volumes folders of every subject are listed once, concurrently, recording the names, sizes and modification times of their entries.  Over NFS every listing is a round trip, so this replaces the listings each stage of the upload used to repeat.  When the header cache is enabled, the listings are stored in it and the next run doesn't list the folders whose modification time hasn't changed again, but still stats their files, since a file rewritten in place doesn't change the modification time of its folder.  Subject folders in the processed roots that the subject metadata doesn't reference are reported.
+	Args:
+		subject_metadata: A pandas DataFrame with subject metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	start_time = time.time()
+
+	processed_subj_dirs = set(os.path.abspath(processed_subj_dir) for processed_subj_dir in subject_metadata['ProcessedFolder'].dropna())
+	processed_roots = sorted(set(os.path.dirname(processed_subj_dir) for processed_subj_dir in processed_subj_dirs))
+	dir_names = processed_roots + sorted(os.path.join(processed_subj_dir, folder) for processed_subj_dir in processed_subj_dirs for folder in ['resampled', 'stats-volumes'])
+
+	header_cache = project_constants['header_cache']
+	cached_dirs = {}
+	if header_cache is not None:
+		with project_constants['header_cache_lock']:
+			cached_dirs = dict((path, (mtime, entries)) for path, mtime, entries in header_cache.execute('SELECT path, mtime, entries FROM directories'))
+
+	# The modification time is taken before the directory is listed, so that a change made while listing it isn't missed by the next run.
+	# It only changes when entries are added, removed or renamed, not when a file is rewritten in place, so the entries of a cached listing are stat'ed again.
+	def index_directory(dir_name):
+		try:
+			dir_mtime = os.stat(dir_name).st_mtime
+			if dir_name in cached_dirs and dir_mtime == cached_dirs[dir_name][0]:
+				cached_entries = dict((name.encode('utf-8'), entry) for name, entry in json.loads(cached_dirs[dir_name][1]).items())
+				entries = {}
+				for name in cached_entries:
+					entry_stat = os.stat(os.path.join(dir_name, name))
+					entries[name] = {'size': entry_stat.st_size, 'mtime': entry_stat.st_mtime, 'is_dir': stat.S_ISDIR(entry_stat.st_mode)}
+				return dir_name, entries, dir_mtime if entries != cached_entries else None
+			return dir_name, scan_directory(dir_name), dir_mtime
+		except OSError as e:
+			return dir_name, e, None
+
+	pool = ThreadPool(project_constants['num_preflight_workers'])
+	try:
+		results = pool.map(index_directory, dir_names)
+	finally:
+		pool.close()
+		pool.join()
+
+	with project_constants['directory_index_lock']:
+		for dir_name, entries, dir_mtime in results:
+			project_constants['directory_index'][dir_name] = entries
+
+	# Only the directories that were listed again need to be stored; the others count as used.
+	scanned_dirs = [(dir_name, dir_mtime, entries) for dir_name, entries, dir_mtime in results if dir_mtime is not None]
+	if header_cache is not None:
+		with project_constants['header_cache_lock']:
+			for dir_name, entries, dir_mtime in results:
+				if dir_mtime is None and dir_name in cached_dirs:
+					project_constants['header_cache_hits'][('directories', dir_name)] = time.time()
+			for dir_name, dir_mtime, entries in scanned_dirs:
+				store_header_cache_entry(header_cache, 'directories', dir_name, {'mtime': dir_mtime, 'entries': json.dumps(entries)}, project_constants)
+
+	record_metric('directory index', None, time.time() - start_time, project_constants, directories=len(dir_names), scanned=len(scanned_dirs))
+
+	# Subject folders of the processed roots that aren't referenced by the subject metadata.
+	unreferenced_dirs = []
+	for processed_root in processed_roots:
+		entries = project_constants['directory_index'][processed_root]
+		if isinstance(entries, dict):
+			unreferenced_dirs.extend(os.path.join(processed_root, name) for name in sorted(entries)
+				if entries[name]['is_dir'] and os.path.join(processed_root, name) not in processed_subj_dirs)
+
+	if unreferenced_dirs:
+		lines = [str(len(unreferenced_dirs)) + ' processed folder(s) are not referenced by ' + project_constants['subject_metadata_file'] + ':']
+		lines.extend('    ' + unreferenced_dir for unreferenced_dir in unreferenced_dirs)
+		notify_user('\n'.join(lines), project_constants)
+		write_to_logfile('\n' + '\n'.join(lines) + '\n', project_constants)
+
+
+def init_header_cache(project_constants):
+	'''
+	Summary:
+		Opens (creating if necessary) the SQLite database used to cache parsed MINC headers between runs.  Entries are keyed on the path, size and modification time of the MINC file, so a changed file is read again.  The database also holds the file digests, the directory listings of the directory index (see init_directory_index) and the manifests of uploaded zip files (see record_zip_manifests).  The tables are bounded together by header_cache_max_bytes (see store_header_cache_entry).
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		header_cache: The sqlite3 connection to the cache database.
+	'''
+
+	cache_dir = os.path.dirname(project_constants['header_cache_file'])
+
+	if cache_dir and not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+
+	# The connection is shared by the upload workers, which serialize access with header_cache_lock.
+	header_cache = sqlite3.connect(project_constants['header_cache_file'], check_same_thread=False)
+	header_cache.execute('CREATE TABLE IF NOT EXISTS minc_headers (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, last_used REAL, header TEXT)')
+	header_cache.execute('CREATE TABLE IF NOT EXISTS file_digests (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, last_used REAL, md5 TEXT)')
+	header_cache.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime REAL, last_used REAL, entries TEXT)')
+	header_cache.execute('CREATE TABLE IF NOT EXISTS zip_files (path TEXT PRIMARY KEY, size INTEGER, md5 TEXT, last_used REAL, members TEXT)')
+	for table in project_constants['header_cache_tables']:
+		# Caches written before the digests and listings were evicted don't record their last use.
+		if 'last_used' not in [column[1] for column in header_cache.execute('PRAGMA table_info(' + table + ')')]:
+			header_cache.execute('ALTER TABLE ' + table + ' ADD COLUMN last_used REAL DEFAULT 0')
+		header_cache.execute('CREATE INDEX IF NOT EXISTS ' + table + '_last_used ON ' + table + ' (last_used)')
+	header_cache.commit()
+
+	project_constants['header_cache_bytes'] = sum(entry_bytes for table, path, entry_bytes in select_header_cache_entries(header_cache, project_constants))
+	project_constants['header_cache_hits'] = {}
+
+	return header_cache
+
+
+def init_journal(project_constants, resume, dry_run=False):
+	'''
+	Summary:
+		Opens the journal recording every upload step (subject, session, scan, resource, file) as it completes.  The journal is kept in the cache directory, one per project.  When resuming, the steps recorded by the previous run are loaded so that they can be skipped; otherwise the journal is started over.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		resume: A boolean; True to continue the journal of the previous run.
+		dry_run: A boolean; True to only load the steps of the previous run, leaving the journal as it is.
+	Returns:
+		journal_file: The journal file handle, or None for a dry run.
+	'''
+
+	journal_dir = project_constants['journal_dir']
+	journal_fname = os.path.join(journal_dir, project_constants['project_name'] + ' journal.jsonl')
+
+	if not os.path.isdir(journal_dir):
+		os.makedirs(journal_dir)
+
+	project_constants['journal_completed'] = set()
+
+	if resume and os.path.exists(journal_fname):
+		with open(journal_fname) as journal_file:
+			for line in journal_file:
+				try:
+					step = json.loads(line)
+				except ValueError:
+					# The last line may be incomplete if the previous run was killed while writing it.
+					continue
+				project_constants['journal_completed'].add((step['subject'], step['step'], step['file']))
+
+	if dry_run:
+		return None
+
+	return open(journal_fname, 'a' if resume else 'w')
+
+
+def init_log_file(project_constants):
+	'''
+	Summary:
+		Creates a log file to record subjects that were successfully uploaded to Brain-CODE.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		spred_log_file: The log file handle.
+	'''
+
+	# log files will be found in this subdirectory.
+	log_dir_name = 'logs'
+
+	if not os.path.isdir(log_dir_name):
+		os.makedirs(log_dir_name)
+
+	todays_datetime = datetime.datetime.now()
+	fname = log_dir_name + '/' + str(todays_datetime) + ' spred braincode upload.txt'
+	spred_log_file = open(fname, 'w')
+	spred_log_file.writelines('Uploaded the following subjects and related information into project: ' + project_constants['project_name'] + '\n')
+	spred_log_file.writelines('Uploaded data to the following url: ' + project_constants['base_url'] + '\n')
+	spred_log_file.writelines('Data was uploaded by user: ' + project_constants['username'] + '\n')
+	spred_log_file.writelines('\n')
+	spred_log_file.writelines('SPReD_ID' + ',' + 'MINC_Filename' + ',' + 'Processed_Folder' '\n')
+
+	return spred_log_file
+
+
+def init_metrics_file(log_fname):
+	'''
+	Summary:
+		Creates the file recording the time taken by every phase of the upload (reading headers, generating IDs, web service calls, building zip files, uploading files), next to the log file.  Every line is a JSON object.
+	Args:
+		log_fname: The name of the log file of the upload.
+	Returns:
+		metrics_file: The metrics file handle.
+	'''
+
+	return open(os.path.splitext(log_fname)[0] + ' metrics.jsonl', 'w')
+
+
+def init_project_constants(username=None, password=None):
+	'''
+	Summary:
+		Initialize project constants used for the upload, such as the PI first and last name, constant scanning parameters, etc.  Decided against using collections.namedtuple().  For a new project, the user should change the values here!
+	Args:
+		username: Optionally, the SPReD username; the user is asked for it if it isn't given.
+		password: Optionally, the SPReD password; the user is asked for it if it isn't given.
+	Returns:
+		project_constants: A dictionary containing name:value pairs constant throughout the project.  This is preferred over global variables so that the module can potentially be imported down the line.  It's unlikely that this module will be imported simply because there is so much customization specific to MICe here.
+	'''
+
+	project = 'PND11'
+	site = 'HSC'
+
+	if username is None:
+		username = raw_input('SPReD username:')
+	if password is None:
+		password = raw_input('SPReD password:')
+
+	session = requests.session()
+	session.auth = (username, password)
+
+	project_constants = {
+		# project details
+		'project': project,
+		'site': site,
+		'project_name': project + '_' + site + '_' + 'test',
+		'visit_num': '01',
+		'session_num': '01',
+		'scan_num': '01',
+		'resource_num': '01',
+		'pi_firstname': 'Jason',
+		'pi_lastname': 'Lerch',
+		'acquisition_site': 'Mouse Imaging Centre (MICe)',
+		'base_url': 'https://spreddev.braincode.ca/spred/data/archive/projects/',
+		# scanning parameters
+		'modality': 'MR',
+		'field_strength': '7.0T',
+		'scanner': 'Agilent 7T Animal System',
+		'scanner_manufacturer': 'Agilent',
+		'scan_type': 'T2 FSE 3D MICE EX-VIVO',
+		'quality': 'usable',
+		'file_type': 'MINC',
+		'flip_angle': 90,  # will this always be 90?
+		# logon info
+		'username': username,
+		'password': password,
+		'session': 	session,
+		# upload parameters
+		'subject_metadata_file': 'SubjectMetadata.csv',
+		'automatic_upload': False,  # upload is interactive by default
+		'dry_run': False,  # only print the upload plan
+		'num_workers': 1,  # number of subjects uploaded concurrently
+		'stream_uploads': False,  # generate zip files while uploading them instead of writing them to disk first
+		'raw_minc_upload': False,  # upload the distortion corrected MINC file as it is, straight from a memory map, instead of in a zip file
+		'pipeline_uploads': False,  # overlap the stages (header, zip files, creation, transfer) of consecutive subjects
+		'pipeline_queue_size': 2,  # number of subjects waiting between two stages of the pipeline, which bounds the zip files on disk
+		'recreate_subjects': False,  # delete and recreate existing subjects instead of updating them in place
+		'fail_fast': False,  # stop at the first subject that fails instead of putting it on the dead letter list
+		'max_retries': 5,  # number of times a failed web service call is retried
+		'retry_backoff_secs': 2.0,  # wait before the first retry, doubled for every retry after
+		'retry_max_backoff_secs': 120.0,
+		'retry_statuses': [408, 429, 500, 502, 503, 504],  # transient HTTP errors worth retrying
+		'request_timeout': (60, 600),  # seconds to wait to connect, and between bytes of a response
+		'xml_upload': False,  # create the subject, session and scan with one XML document instead of one request each
+		'upload_files_individually': False,  # upload resource files one by one instead of as a zip file so that a later update can compare them
+		'num_file_workers': 1,  # number of files of a resource uploaded concurrently; more than 1 uploads them individually
+		'adaptive_concurrency': False,  # adjust the subjects and file transfers in flight to the server's latency and errors (see adjust_concurrency)
+		'adaptive_min_workers': 1,  # lowest number of subjects in flight; -j is the highest
+		'adaptive_min_file_workers': 1,  # lowest number of file transfers in flight; -j times --file-jobs is the highest
+		'adaptive_interval_secs': 10.0,  # how often the limits are adjusted
+		'adaptive_min_requests': 5,  # requests needed in an interval before adjusting the limits
+		'adaptive_latency_factor': 2.0,  # a median latency this many times the lowest seen means the server is overloaded
+		'adaptive_max_error_rate': 0.05,  # a larger fraction of requests failing with transient errors means the server is overloaded
+		'verify_uploads': True,  # check the size and digest of every uploaded file against the listing of its resource
+		'verify_retries': 2,  # number of times files that don't match are uploaded again
+		'bandwidth_limit': None,  # MB/s shared by every transfer, None for unlimited
+		'bandwidth_schedule': [],  # (start minute, end minute, MB/s or None) windows of the day overriding bandwidth_limit, see parse_bandwidth_schedule
+		'bandwidth_burst_secs': 1.0,  # seconds of the bandwidth limit that can be sent at once after an idle spell
+		'compress_level': 6,  # zlib deflate level, 0 stores every file uncompressed
+		'compress_min_ratio': 0.9,  # files whose sample doesn't compress below this fraction of its size are stored
+		'num_compress_workers': multiprocessing.cpu_count(),  # number of files compressed in parallel in one zip file
+		'compress_queue_chunks': 4,  # chunks (1 MB each) a file compressed ahead of the one being written can hold in memory
+		'num_metadata_workers': 8,  # number of concurrent requests when retrieving existing subjects one at a time
+		'num_preflight_workers': 16,  # number of subjects whose files are checked concurrently before the upload
+		'num_audit_workers': 16,  # number of subjects compared with SPReD concurrently by --audit
+		'header_cache_file': 'cache/minc_headers.sqlite',  # set to None to always read MINC headers from the files
+		'journal_dir': 'cache',  # directory of the journals used to resume uploads
+		'header_cache_max_bytes': 64 * 1024 * 1024,  # total size of the headers, digests, directory listings and zip file manifests kept in the header cache
+		'header_cache_tables': {'minc_headers': 'header', 'file_digests': 'md5', 'directories': 'entries', 'zip_files': 'members'},  # tables of the header cache, and the column holding each entry
+		# shared state for concurrent uploads
+		'log_file': None,
+		'compression_report': None,
+		'audit_report': None,
+		'metrics_file': None,
+		'metrics': {},  # seconds and bytes of every phase, for the summary at the end of the upload
+		'metrics_lock': threading.Lock(),
+		'journal_file': None,
+		'journal_lock': threading.Lock(),
+		'journal_completed': set(),
+		'server_subject_IDs': set(),
+		'dead_letters': [],
+		'log_lock': threading.Lock(),
+		'header_cache': None,
+		'header_cache_lock': threading.Lock(),
+		'header_cache_bytes': 0,  # total size of the entries in the header cache, see store_header_cache_entry
+		'header_cache_hits': {},  # last use of the entries read from the header cache since the last flush, by table and path, see flush_header_cache
+		'directory_index': {},  # listings of the processed folders, see init_directory_index
+		'directory_index_lock': threading.Lock(),
+		'stats_lock': threading.Lock(),
+		'concurrency': None,  # state of the adaptive concurrency controller, see init_concurrency_control
+		'bandwidth_bucket': {'tokens': 0.0, 'time': None, 'wait_secs': 0.0},  # token bucket of the bandwidth limit, see throttle_bandwidth
+		'bandwidth_lock': threading.Lock(),
+		'upload_stats': {'subjects': 0, 'bytes': 0}
+	}
+
+	return project_constants
+
+
+def insert(original, new, pos):
+	'''Inserts a char (new) inside original string (original) at the specified position (pos).'''
+
+	return original[:pos] + new + original[pos:]
+
+
+def is_server_file_uploaded(url, server_name, file_size, subj_spred_ID, project_constants):
+	'''
+	Summary:
+		Checks whether a file upload that appeared to fail was actually stored by SPReD, so that it doesn't have to be sent again.
+	Args:
+		url: A string specifying the url of the resource's files (ending in /files/).
+		server_name: The path of the file within the resource.
+		file_size: An integer; the size of the file in bytes.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A boolean; True if the resource holds a file with that name and size.
+	'''
+
+	try:
+		server_files = get_server_resource_files(url, subj_spred_ID, project_constants)
+	except SpredUploadError:
+		return False
+
+	return server_files is not None and server_name in server_files and int(server_files[server_name].get('size', -1)) == file_size
+
+
+def is_server_file_current(file_name, server_file, project_constants):
+	'''
+	Summary:
+		Compares a local file with its entry in a SPReD resource file listing.  Sizes are compared first; if the server reports a digest, the MD5 digest of the local file is compared too.
+	Args:
+		file_name: A string path to a local file.
+		server_file: The file's entry in the listing returned by get_server_resource_files, or None if the server doesn't have it.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A boolean; True if the server already has the same file.
+	'''
+
+	if server_file is None:
+		return False
+
+	if 'size' in server_file and int(server_file['size']) != os.path.getsize(file_name):
+		return False
+
+	if server_file.get('digest'):
+		return str(server_file['digest']).lower() == get_file_md5(file_name, project_constants)
+
+	return True
+
+
+def is_step_completed(subj_spred_ID, step, MINC_filename, project_constants):
+	'''
+	Summary:
+		Checks whether an upload step for a subject was recorded in the journal by the run being resumed.
+	Args:
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		step: A string naming the step (e.g. subject, session, registrations file).
+		MINC_filename: The name of the MINC file of the subject; a step completed for a different file doesn't count.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A boolean; True if the step can be skipped.
+	'''
+
+	return (subj_spred_ID, step, MINC_filename) in project_constants['journal_completed']
+
+
+def notify_user(message, project_constants):
+	'''Prints a message to the user without interleaving it with messages from other upload workers.'''
+
+	with project_constants['log_lock']:
+		print message
+
+
+def notify_user_of_success(subj_spred_ID, project_constants):
+	'''Notifies the user of the successful creation of a collective subject, session, scan.'''
+
+	notify_user('Successfully created subject: ' + subj_spred_ID, project_constants)
+
+
+def observe_request(secs, failed, has_body, project_constants):
+	'''
+	Summary:
+		Adds an attempt of a web service call to the interval observed by the adaptive concurrency controller, and calls adjust_concurrency once the interval is over.  Does nothing unless adaptive concurrency is enabled.
+	Args:
+		secs: A float; the time the attempt took.
+		failed: A boolean; True if the connection failed or the server returned a transient error.
+		has_body: A boolean; True if the request sent a file, whose latency depends on its size rather than on the load of the server.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	concurrency = project_constants['concurrency']
+	if concurrency is None:
+		return
+
+	with concurrency['condition']:
+		window = concurrency['window']
+		window['requests'] += 1
+		window['errors'] += int(failed)
+		if not has_body:
+			window['latencies'].append(secs)
+		if time.time() - window['start_time'] >= project_constants['adaptive_interval_secs'] and window['requests'] >= project_constants['adaptive_min_requests']:
+			adjust_concurrency(project_constants)
+
+
+def package_scan_files(uploads, subj_spred_ID, project_constants):
+	'''
+	Summary:
+		Builds the temporary zip files of a scan's uploads ahead of time, so that they can be built while another subject is being uploaded (see run_subject_pipeline).  Nothing is built when the files are uploaded individually or as streamed zip files, since there is nothing to prepare.
+	Args:
+		uploads: A list of the scan's uploads, as returned by get_scan_uploads.  The size and MD5 digest of each zip file built are added to its upload (zip_size and zip_md5).
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	if project_constants['stream_uploads'] or project_constants['upload_files_individually'] or project_constants['num_file_workers'] > 1:
+		return
+
+	for upload in uploads:
+		if not upload['individually']:
+			upload['zip_size'], upload['zip_md5'] = build_zip_file(upload['file_names'], upload['zip_name'], subj_spred_ID, upload['action'], project_constants)
+
+
+def parse_bandwidth_limit(text):
+	'''
+	Summary:
+		Parses the --bandwidth-limit argument.
+	Args:
+		text: A string; the argument.
+	Returns:
+		The limit in MB/s.  Raises argparse.ArgumentTypeError unless it is a number more than 0.
+	'''
+
+	try:
+		limit = float(text)
+	except ValueError:
+		raise argparse.ArgumentTypeError('not a number: ' + text)
+
+	if not limit > 0:
+		raise argparse.ArgumentTypeError('the limit must be more than 0 MB/s: ' + text)
+
+	return limit
+
+
+def parse_bandwidth_schedule(text):
+	'''
+	Summary:
+		Parses the --bandwidth-schedule argument: comma separated windows of the day, each with the bandwidth limit in MB/s that applies during it, e.g. 08:00-18:00=2,18:00-08:00=unlimited.
+	Args:
+		text: A string; the argument.
+	Returns:
+		bandwidth_schedule: A list of (start minute, end minute, limit in MB/s or None for unlimited) tuples.  Raises argparse.ArgumentTypeError if the argument is malformed.
+	'''
+
+	bandwidth_schedule = []
+
+	for window in text.split(','):
+		match = re.match(r'^\s*(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(unlimited|\d+(\.\d*)?)\s*$', window)
+		if match is None:
+			raise argparse.ArgumentTypeError('expected HH:MM-HH:MM=MB/s or HH:MM-HH:MM=unlimited, got: ' + window)
+		start_hour, start_minute, end_hour, end_minute = [int(group) for group in match.groups()[:4]]
+		start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+		# 24:00 is the only time with hour 24, the end of the day.
+		if start_minute > 59 or end_minute > 59 or start > 24 * 60 or end > 24 * 60:
+			raise argparse.ArgumentTypeError('not a time of day: ' + window)
+		limit = None if match.group(5) == 'unlimited' else float(match.group(5))
+		if limit is not None and not limit > 0:
+			raise argparse.ArgumentTypeError('the limit must be more than 0 MB/s: ' + window)
+		# A window starting at 24:00 starts at midnight.
+		bandwidth_schedule.append((start % (24 * 60), end, limit))
+
+	return bandwidth_schedule
+
+
+def parse_command_line_args(argv):
+	'''
+	Summary:
+		Parses the command line arguments of the upload script.
+	Args:
+		argv: A list of command line arguments, excluding the script name.
+	Returns:
+		args: An argparse.Namespace with the parsed arguments.
+	'''
+
+	parser = argparse.ArgumentParser(description='Upload MICe non-DICOM data to a SPReD project.')
+	parser.add_argument('-a', dest='automatic_upload', action='store_true', help='run the upload automatically instead of interactively')
+	parser.add_argument('--audit', dest='audit', action='store_true', help='compare the SPReD project with the subject metadata and the local files, and write the differences to a JSON lines report, without uploading anything')
+	parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='print the upload plan (subjects to create, update or recreate, files, bytes and estimated time) without changing anything in SPReD')
+	parser.add_argument('-j', '--jobs', dest='num_workers', type=int, default=1, help='number of subjects to upload concurrently (default: 1)')
+	parser.add_argument('--resume', dest='resume', action='store_true', help='skip the steps completed by the previous run, according to its journal')
+	parser.add_argument('--sync', dest='sync', action='store_true', help='upload the files of new subjects individually instead of as zip files, so that later runs only upload the files that changed')
+	parser.add_argument('--recreate', dest='recreate_subjects', action='store_true', help='delete and recreate subjects that already exist instead of updating them in place')
+	parser.add_argument('--fail-fast', dest='fail_fast', action='store_true', help='stop at the first subject that fails to upload instead of carrying on with the others')
+	parser.add_argument('--pipeline', dest='pipeline_uploads', action='store_true', help="overlap reading headers, building zip files, creating subjects and uploading files of consecutive subjects")
+	parser.add_argument('--raw-minc', dest='raw_minc_upload', action='store_true', help='upload the distortion corrected MINC file as it is instead of in a zip file')
+	parser.add_argument('--bandwidth-limit', dest='bandwidth_limit', type=parse_bandwidth_limit, default=None, help='upload at most this many MB/s, shared by every concurrent transfer (default: unlimited)')
+	parser.add_argument('--bandwidth-schedule', dest='bandwidth_schedule', type=parse_bandwidth_schedule, default=None, help='bandwidth limits for times of the day, e.g. 08:00-18:00=2,18:00-08:00=unlimited; --bandwidth-limit applies outside them')
+	parser.add_argument('--stream', dest='stream_uploads', action='store_true', help='generate zip files while uploading them instead of writing temporary zip files')
+	parser.add_argument('--adaptive', dest='adaptive_concurrency', action='store_true', help='adjust the number of subjects and files uploaded at once, up to -j and --file-jobs, to the latency and errors of the server')
+	parser.add_argument('--file-jobs', dest='num_file_workers', type=int, default=1, help='upload the files of each resource individually, this many at a time, instead of as one zip file (default: 1, a zip file)')
+	parser.add_argument('--xml', dest='xml_upload', action='store_true', help='create each subject, session and scan with a single XML document instead of one request each')
+	parser.add_argument('--no-verify', dest='no_verify', action='store_true', help="don't check the files uploaded against the resource's file listing")
+	parser.add_argument('--compress-level', dest='compress_level', type=int, choices=range(0, 10), default=None, help='zlib deflate level used for compressible files (default: 6)')
+	parser.add_argument('--compress-workers', dest='num_compress_workers', type=int, default=None, help='number of files compressed in parallel (default: number of cores)')
+
+	return parser.parse_args(argv)
+
+
+def parse_minc_header(header_text):
+	'''
+	Summary:
+		Parses the CDL text printed by mincheader into a dictionary of attribute values.
+	Args:
+		header_text: A string containing the output of mincheader.
+	Returns:
+		minc_header: A dictionary mapping field names (variable:attribute, e.g. vnmr:tr) to string values.  String attributes are unquoted and numeric attributes lose their CDL type suffix, so values look like the output of mincinfo -attvalue.
+	'''
+
+	minc_header = {}
+	statement = ''
+
+	for line in header_text.splitlines():
+		# Attribute values only appear before the data section.
+		if line.strip() == 'data:':
+			break
+
+		# Attribute values may span several lines (e.g. long strings); a statement ends with ' ;'.
+		statement += line.strip() + ' '
+		if not statement.rstrip().endswith(';'):
+			continue
+
+		match = re.match(r'^([^\s:=]*):([^\s=]+) = (.*);\s*$', statement, re.DOTALL)
+		statement = ''
+		if match is None:
+			continue
+
+		field_name = match.group(1) + ':' + match.group(2)
+		raw_value = match.group(3).strip()
+
+		if raw_value.startswith('"'):
+			parts = re.findall(r'"((?:[^"\\]|\\.)*)"', raw_value)
+			value = ''.join(parts).replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+		else:
+			numbers = []
+			for number in raw_value.split(','):
+				number = number.strip().rstrip('fFsSbBlLdD')
+				if number.endswith('.'):
+					number = number[:-1]
+				numbers.append(number)
+			value = ' '.join(numbers)
+
+		minc_header[field_name] = value
+
+	return minc_header
+
+
+def parse_server_file(server_file):
+	'''
+	Summary:
+		Parses an entry of a SPReD file listing.
+	Args:
+		server_file: A dictionary; an entry of the ResultSet of a file listing.
+	Returns:
+		server_name: The path of the file within its resource.
+		server_file: The entry with lower case keys (e.g. size, digest, uri, collection).
+	'''
+
+	server_file = dict((str(key).lower(), value) for key, value in server_file.items())
+
+	# Files in subfolders of the resource are identified by their path within the resource, which is the end of their URI.
+	if '/files/' in server_file.get('uri', ''):
+		return str(server_file['uri'].split('/files/', 1)[1]), server_file
+
+	return str(server_file['name']), server_file
+
+
+def print_audit_summary(differences, project_constants):
+	'''
+	Summary:
+		Reports the number of differences of each level and status found by audit_project, and where the full list was written, to the user and to the log file.
+	Args:
+		differences: A list of the differences found, as returned by audit_subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	counts = collections.Counter((difference['level'], difference['status']) for difference in differences)
+
+	lines = ['Audit of project ' + project_constants['project_name'] + ': ' + str(len(differences)) + ' difference(s)']
+	lines.extend('    %-10s %-16s %8d' % (level, status, count) for (level, status), count in sorted(counts.items()))
+	lines.append('Differences written to: ' + project_constants['audit_report'].name)
+
+	notify_user('\n'.join(lines), project_constants)
+	write_to_logfile('\n' + '\n'.join(lines) + '\n', project_constants)
+
+
+def print_metrics_summary(project_constants):
+	'''
+	Summary:
+		Reports the number of times each phase of the upload ran, the percentiles of the time it took, and the throughput of the phases that moved bytes, to the user and to the log file.  Web service calls are broken down by action.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	if not project_constants['metrics']:
+		return
+
+	lines = ['%-60s %6s %8s %8s %8s %8s %9s %8s' % ('Phase', 'Count', 'p50 (s)', 'p90 (s)', 'p99 (s)', 'Max (s)', 'Total (s)', 'MB/s')]
+
+	with project_constants['metrics_lock']:
+		for phase, metric in sorted(project_constants['metrics'].items()):
+			secs = np.array(metric['secs'])
+			p50, p90, p99 = np.percentile(secs, [50, 90, 99])
+			throughput = '%8.2f' % (metric['bytes'] / (1024.0 * 1024.0) / max(secs.sum(), 1e-6)) if metric['bytes'] else '%8s' % '-'
+			lines.append('%-60s %6d %8.3f %8.3f %8.3f %8.3f %9.1f %s' % (phase[:60], len(secs), p50, p90, p99, secs.max(), secs.sum(), throughput))
+
+	notify_user('\n'.join(lines), project_constants)
+	write_to_logfile('\n' + '\n'.join(lines) + '\n', project_constants)
+
+
+def print_preflight_report(subject_metadata, preflight, project_constants):
+	'''
+	Summary:
+		Reports every problem found by the pre-flight check, grouped by subject, to the user and to the log file.
+	Args:
+		subject_metadata: A pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		preflight: The results of the pre-flight check, as returned by check_subject_metadata.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	failed_indices = [index for index in subject_metadata.index if index in preflight and preflight[index]['problems']]
+
+	lines = ['Pre-flight check: ' + str(len(preflight)) + ' subject(s) checked, ' + str(len(failed_indices)) + ' with problems' + (' (they will be skipped):' if failed_indices else '')]
+	for index in failed_indices:
+		subj_spred_ID, session_name = get_subject_spred_names(subject_metadata.loc[index], project_constants)
+		lines.append('    ' + subj_spred_ID + ' (row ' + str(index + 2) + ' of the subject metadata):')
+		for problem in preflight[index]['problems']:
+			lines.append('        ' + problem)
+
+	notify_user('\n'.join(lines), project_constants)
+	write_to_logfile('\n' + '\n'.join(lines) + '\n', project_constants)
+
+
+def print_to_logfile(subj_spred_ID, MINC_filename, processed_subj_dir, project_constants):
+	'''Prints a line to the log file containing the SPReD_ID of the subject and the file associated with that subject.'''
+
+	write_to_logfile(','.join([subj_spred_ID, MINC_filename, processed_subj_dir]) + '\n', project_constants)
+
+
+def print_upload_plan(plan, worker_loads, project_constants):
+	'''
+	Summary:
+		Reports the upload plan to the user and to the log file: what will be done for each subject, the totals, and the predicted makespan (how long the upload will take) at the throughput per worker of the previous upload.
+	Args:
+		plan: A list of the subjects of the upload, as returned by get_upload_plan.
+		worker_loads: A list of the number of bytes predicted to be uploaded by each worker, as returned by get_subject_schedule.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		predicted_secs: A float; the predicted makespan in seconds, or None if no previous upload was measured.
+	'''
+
+	lines = ['%-24s %-40s %6s %10s  %s' % ('SPReD_ID', 'Action', 'Files', 'MB', 'MINC_Filename')]
+	for entry in plan:
+		lines.append('%-24s %-40s %6d %10.1f  %s' % (entry['subject'], entry['action'][:40], entry['num_files'], entry['bytes'] / (1024.0 * 1024.0), entry['file']))
+
+	uploads = [entry for entry in plan if entry['upload']]
+	total_bytes = sum(entry['bytes'] for entry in uploads)
+	actions = collections.Counter(entry['action'] for entry in uploads)
+
+	lines.append('')
+	lines.append('Plan: %d subjects to upload (%s), %d skipped, %d files, %.1f MB' % (len(uploads),
+		', '.join('%d %s' % (count, action) for action, count in sorted(actions.items())) or 'none', len(plan) - len(uploads),
+		sum(entry['num_files'] for entry in uploads), total_bytes / (1024.0 * 1024.0)))
+
+	# The busiest worker decides the makespan; an even split of the bytes is the best any schedule could do.
+	lines.append('Largest worker load: %.1f MB over %d worker(s), an even split would be %.1f MB' % (
+		max(worker_loads) / (1024.0 * 1024.0), len(worker_loads), total_bytes / (1024.0 * 1024.0) / len(worker_loads)))
+
+	throughput, measured_workers = get_measured_throughput(project_constants)
+	predicted_secs = None
+	if throughput:
+		worker_throughput = throughput / measured_workers
+		predicted_secs = max(worker_loads) / worker_throughput
+		lines.append('Predicted makespan: %s at %.2f MB/s per worker, the throughput of the previous upload (updates only send the files that changed)' % (
+			datetime.timedelta(seconds=int(predicted_secs)), worker_throughput / (1024.0 * 1024.0)))
+	else:
+		lines.append('Predicted makespan: unknown until an upload has been measured')
+
+	notify_user('\n'.join(lines), project_constants)
+	write_to_logfile('\nUpload plan:\n' + '\n'.join(lines) + '\n\n', project_constants)
+
+	return predicted_secs
+
+
+def print_upload_summary(elapsed_secs, project_constants, predicted_secs=None):
+	'''
+	Summary:
+		Reports the aggregate throughput of the upload, and its actual and predicted makespan, to the user and to the log file.
+	Args:
+		elapsed_secs: A float; the wall time taken by the upload in seconds.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		predicted_secs: Optionally, a float; the makespan predicted by print_upload_plan in seconds.
+	'''
+
+	upload_stats = project_constants['upload_stats']
+	megabytes = upload_stats['bytes'] / (1024.0 * 1024.0)
+	elapsed_secs = max(elapsed_secs, 1e-6)
+
+	summary = 'Uploaded %d subjects (%.1f MB) in %.1f s with %d worker(s): %.2f MB/s, %.2f subjects/min' % (
+		upload_stats['subjects'], megabytes, elapsed_secs, project_constants['num_workers'],
+		megabytes / elapsed_secs, upload_stats['subjects'] * 60.0 / elapsed_secs)
+
+	summary += '\nMakespan: %.1f s, predicted %s' % (elapsed_secs, '%.1f s' % predicted_secs if predicted_secs is not None else 'unknown')
+
+	if project_constants['bandwidth_limit'] is not None or project_constants['bandwidth_schedule']:
+		summary += '\nBandwidth limit: transfers waited %.1f s in total' % project_constants['bandwidth_bucket']['wait_secs']
+
+	notify_user(summary, project_constants)
+	write_to_logfile('\n' + summary + '\n', project_constants)
+
+	# Subjects whose upload failed; rerun with --resume to retry them.
+	if project_constants['dead_letters']:
+		notify_user(str(len(project_constants['dead_letters'])) + ' subject(s) failed to upload and can be retried with --resume:', project_constants)
+		write_to_logfile('\nFailed subjects:\n', project_constants)
+		for subj_spred_ID, MINC_filename, problem in project_constants['dead_letters']:
+			notify_user('    ' + subj_spred_ID + ' (' + MINC_filename + '): ' + problem, project_constants)
+			write_to_logfile(','.join([subj_spred_ID, MINC_filename, problem]) + '\n', project_constants)
+
+
+def record_compression_stats(subj_spred_ID, file_name, zinfo, compress_secs, project_constants):
+	'''
+	Summary:
+		Writes a line to the compression report describing how a file was compressed.
+	Args:
+		subj_spred_ID: The well-formatted SPReD ID.
+		file_name: A string path to the file that was compressed.
+		zinfo: The zipfile.ZipInfo of the file, after it was compressed by compress_zip_member.
+		compress_secs: A float; the time spent reading and compressing the file in seconds.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	if project_constants['compression_report'] is None:
+		return
+
+	method = 'deflated' if zinfo.compress_type == zipfile.ZIP_DEFLATED else 'stored'
+	ratio = zinfo.compress_size / float(zinfo.file_size) if zinfo.file_size else 1.0
+
+	with project_constants['log_lock']:
+		project_constants['compression_report'].writelines(','.join([subj_spred_ID, file_name, method, str(zinfo.file_size), str(zinfo.compress_size), '%.3f' % ratio, '%.3f' % compress_secs]) + '\n')
+		project_constants['compression_report'].flush()
+
+
+def record_file_md5(file_name, file_stat, md5, project_constants):
+	'''
+	Summary:
+		Stores the MD5 digest of a file in the header cache (see get_file_md5), if the cache is enabled.  It is committed by flush_header_cache.
+	Args:
+		file_name: A string path to a file.
+		file_stat: The os.stat of the file when it was read.
+		md5: A string; the hexadecimal MD5 digest of the file.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	header_cache = project_constants.get('header_cache')
+	if header_cache is None:
+		return
+
+	with project_constants['header_cache_lock']:
+		store_header_cache_entry(header_cache, 'file_digests', os.path.abspath(file_name), {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'md5': md5}, project_constants)
+
+
+def record_metric(phase, subj_spred_ID, secs, project_constants, **fields):
+	'''
+	Summary:
+		Records the time taken by a phase of the upload as a line of the metrics file, and adds it to the totals reported by print_metrics_summary.
+	Args:
+		phase: A string naming the phase (e.g. header, request, zip build, upload, subject).
+		subj_spred_ID: The well-formatted SPReD ID for the subject, or None for phases that aren't specific to a subject.
+		secs: A float; the wall time taken by the phase in seconds.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		fields: Other values to record (e.g. action, status, bytes, ratio).
+	'''
+
+	metric = dict(fields, time=str(datetime.datetime.now()), phase=phase, subject=subj_spred_ID, secs=round(secs, 6))
+	line = json.dumps(metric)
+
+	# Web service calls and uploads are summarized by action (e.g. creating subject).
+	summary_phase = phase + ': ' + fields['action'] if 'action' in fields else phase
+
+	with project_constants['metrics_lock']:
+		summary = project_constants['metrics'].setdefault(summary_phase, {'secs': [], 'bytes': 0})
+		summary['secs'].append(secs)
+		# The throughput of building a zip file is measured by the bytes compressed, not the bytes produced.
+		summary['bytes'] += fields.get('original_bytes', fields.get('bytes', 0))
+		if project_constants['metrics_file'] is not None:
+			project_constants['metrics_file'].write(line + '\n')
+			project_constants['metrics_file'].flush()
+
+
+def record_step_completed(subj_spred_ID, step, MINC_filename, project_constants):
+	'''
+	Summary:
+		Durably records in the journal that an upload step for a subject has completed, so that a resumed upload can skip it.
+	Args:
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		step: A string naming the step (e.g. subject, session, registrations file).
+		MINC_filename: The name of the MINC file of the subject.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	if project_constants['journal_file'] is None:
+		return
+
+	line = json.dumps({'subject': subj_spred_ID, 'step': step, 'file': MINC_filename, 'time': str(datetime.datetime.now())})
+
+	with project_constants['journal_lock']:
+		project_constants['journal_file'].write(line + '\n')
+		project_constants['journal_file'].flush()
+		os.fsync(project_constants['journal_file'].fileno())
+		project_constants['journal_completed'].add((subj_spred_ID, step, MINC_filename))
+
+
+def record_upload_stats(project_constants, subjects=0, num_bytes=0):
+	'''
+	Summary:
+		Adds to the counters used to report the aggregate throughput of the upload.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		subjects: An integer; the number of subjects that finished uploading.
+		num_bytes: An integer; the number of bytes sent to SPReD.
+	'''
+
+	with project_constants['stats_lock']:
+		project_constants['upload_stats']['subjects'] += subjects
+		project_constants['upload_stats']['bytes'] += num_bytes
+
+	# The adaptive concurrency controller watches the throughput too.
+	concurrency = project_constants['concurrency']
+	if concurrency is not None and num_bytes:
+		with concurrency['condition']:
+			concurrency['window']['bytes'] += num_bytes
+
+
+def record_zip_manifests(url, uploaded, zip_name, file_entries, project_constants):
+	'''
+	Summary:
+		Stores in the header cache, if it is enabled, the manifest of every zip file uploaded to a resource: its size and digest, and the path, size and modification time of every file it holds.  The next update of the subject uses them to keep the zip file if the files haven't changed (see get_current_zip_files).
+	Args:
+		url: A string specifying the url of the resource's files (ending in /files/).
+		uploaded: A list of the files uploaded, as returned by send_resource_files.
+		zip_name: A string; the name of the zip file, or None if the files were uploaded individually.
+		file_entries: A dictionary mapping every file uploaded to its size and modification time before it was read (see get_file_entry).
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	header_cache = project_constants.get('header_cache')
+	if header_cache is None or zip_name is None:
+		return
+
+	with project_constants['header_cache_lock']:
+		for entry in uploaded:
+			if entry['name'] == zip_name and entry['size'] is not None:
+				members = sorted([os.path.abspath(file_name), file_entries[file_name]['size'], file_entries[file_name]['mtime']] for file_name in entry['file_names'])
+				store_header_cache_entry(header_cache, 'zip_files', url + zip_name, {'size': entry['size'], 'md5': entry['md5'] or '', 'members': json.dumps(members)}, project_constants)
+
+
+def release_concurrency_slot(kind, project_constants):
+	'''
+	Summary:
+		Counts one subject or file transfer less in flight, after acquire_concurrency_slot.
+	Args:
+		kind: A string; subjects or files.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	concurrency = project_constants['concurrency']
+	if concurrency is None:
+		return
+
+	with concurrency['condition']:
+		concurrency['in_flight'][kind] -= 1
+		concurrency['condition'].notify_all()
+
+
+def run_audit(project_constants):
+	'''
+	Summary:
+		Opens the connection pool, log file, audit report and header cache, audits the project with audit_project, then closes everything.  The journal isn't touched.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	init_connection_pool(project_constants)
+
+	project_constants['log_file'] = init_log_file(project_constants)
+	project_constants['audit_report'] = init_audit_report(project_constants['log_file'].name)
+	project_constants['metrics_file'] = init_metrics_file(project_constants['log_file'].name)
+
+	if project_constants['header_cache_file'] is not None:
+		project_constants['header_cache'] = init_header_cache(project_constants)
+
+	try:
+		audit_project(project_constants)
+	finally:
+		project_constants['log_file'].close()
+		project_constants['audit_report'].close()
+		project_constants['metrics_file'].close()
+		if project_constants['header_cache'] is not None:
+			flush_header_cache(project_constants)
+			project_constants['header_cache'].close()
+
+
+def run_subject(row, project_constants):
+	'''
+	Summary:
+		Uploads a subject, putting it on the dead letter list if its upload fails, unless the upload should stop at the first failure (--fail-fast).
+	Args:
+		row: A row in a pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+	start_time = time.time()
+
+	try:
+		upload_subject(row, project_constants)
+	except SpredUploadError as e:
+		problem = str(e)
+	except (IOError, OSError) as e:
+		problem = 'reading files (' + str(e) + ')'
+		notify_user('Error processing subject: ' + subj_spred_ID + '\n' + 'Problem related to action: ' + problem, project_constants)
+	except Exception as e:
+		problem = 'unexpected error (' + repr(e) + ')'
+		notify_user('Error processing subject: ' + subj_spred_ID + '\n' + 'Problem related to action: ' + problem, project_constants)
+	else:
+		record_metric('subject', subj_spred_ID, time.time() - start_time, project_constants, status='uploaded')
+		return
+
+	record_metric('subject', subj_spred_ID, time.time() - start_time, project_constants, status='failed')
+	add_dead_letter(subj_spred_ID, row['Filename'], problem, project_constants)
+
+	if project_constants['fail_fast']:
+		sys.exit()
+
+
+def run_subject_pipeline(subject_rows, project_constants):
+	'''
+	Summary:
+		Uploads subjects through a pipeline of stages connected by bounded queues, so that the stages of consecutive subjects overlap: while a subject's files are being transferred, the zip files of the next subject are being built and the header of the one after is being read.
+			1. prepare: read the MINC header and list the files to upload (or find that the subject is updated in place)
+			2. package: build the temporary zip files (see package_scan_files)
+			3. create: create the subject, session, scan and resources
+			4. transfer: upload the files, or update the subject in place
+		Every stage but packaging runs num_workers subjects at a time.  Each queue holds at most pipeline_queue_size subjects, so a stage that gets ahead waits for the next one instead of piling up zip files on disk.  A subject that fails leaves the pipeline at that stage and is put on the dead letter list; if the upload has to stop (invalid credentials, or --fail-fast), the subjects still in the pipeline are dropped and the program exits once the running stages finish.
+	Args:
+		subject_rows: A list of rows from the subject metadata DataFrame to upload.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	abort_event = threading.Event()
+
+	def prepare(job):
+		if job['subject'] in project_constants['server_subject_IDs'] and not project_constants['recreate_subjects']:
+			job['update'] = True
+			return
+		job['minc_header'] = get_minc_header(job['file'], project_constants)
+		job['uploads'] = get_scan_uploads(job['file'], job['subject'], job['session'], job['row']['ProcessedFolder'], project_constants)
+
+	def package(job):
+		if not job.get('update'):
+			package_scan_files(job['uploads'], job['subject'], project_constants)
+
+	# The subjects in flight are the ones talking to SPReD, in the create and transfer stages.
+	# A slot is only held while a stage runs, not while it waits for the next stage, which would need a slot too.
+	def create(job):
+		if job.get('update'):
+			return
+		acquire_concurrency_slot('subjects', project_constants)
+		try:
+			if project_constants['xml_upload'] and not is_step_completed(job['subject'], 'subject', job['file'], project_constants):
+				create_subject_hierarchy(job['file'], job['subject'], job['session'], job['row'], project_constants, job['minc_header'])
+			create_subject(job['file'], job['subject'], job['row'], project_constants)
+			create_session(job['file'], job['subject'], job['session'], project_constants, job['minc_header'])
+			create_scan(job['file'], job['subject'], job['session'], project_constants, job['minc_header'])
+		finally:
+			release_concurrency_slot('subjects', project_constants)
+
+	def transfer(job):
+		acquire_concurrency_slot('subjects', project_constants)
+		try:
+			if job.get('update'):
+				update_subject(job['row'], project_constants)
+			else:
+				upload_scan_files(job['file'], job['subject'], job['row']['ProcessedFolder'], job['uploads'], project_constants)
+				record_upload_stats(project_constants, subjects=1)
+		finally:
+			release_concurrency_slot('subjects', project_constants)
+		record_metric('subject', job['subject'], time.time() - job['start_time'], project_constants, status='uploaded')
+
+	# Zip files built for a subject that leaves the pipeline early are deleted.
+	def drop_job(job, problem=None):
+		for upload in job.get('uploads', []):
+			if 'zip_size' in upload and os.path.exists(upload['zip_name']):
+				os.remove(upload['zip_name'])
+		if problem is not None:
+			record_metric('subject', job['subject'], time.time() - job['start_time'], project_constants, status='failed')
+			add_dead_letter(job['subject'], job['file'], problem, project_constants)
+			if project_constants['fail_fast']:
+				abort_event.set()
+
+	stages = [('prepare', prepare, project_constants['num_workers']), ('package', package, 1),
+		('create', create, project_constants['num_workers']), ('transfer', transfer, project_constants['num_workers'])]
+	queues = [Queue.Queue(maxsize=project_constants['pipeline_queue_size']) for stage in stages]
+
+	def stage_worker(stage_num):
+		stage_name, stage_func, num_threads = stages[stage_num]
+		while True:
+			job = queues[stage_num].get()
+			if job is None:
+				return
+			if abort_event.is_set():
+				drop_job(job)
+				continue
+			start_time = time.time()
+			try:
+				stage_func(job)
+			except SpredUploadError as e:
+				drop_job(job, str(e))
+			except (IOError, OSError) as e:
+				problem = 'reading files (' + str(e) + ')'
+				notify_user('Error processing subject: ' + job['subject'] + '\n' + 'Problem related to action: ' + problem, project_constants)
+				drop_job(job, problem)
+			except SystemExit:
+				abort_event.set()
+				drop_job(job)
+			except Exception as e:
+				# Any other error only drops the subject, so that the stage keeps draining its queue and the stages before it don't block.
+				notify_user('Unexpected error processing subject ' + job['subject'] + ' (' + stage_name + '): ' + repr(e), project_constants)
+				drop_job(job, str(e))
+			else:
+				record_metric('pipeline: ' + stage_name, job['subject'], time.time() - start_time, project_constants)
+				if stage_num + 1 < len(stages):
+					queues[stage_num + 1].put(job)
+
+	stage_threads = []
+	for stage_num, (stage_name, stage_func, num_threads) in enumerate(stages):
+		threads = [threading.Thread(target=stage_worker, args=(stage_num,)) for thread_num in range(num_threads)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		stage_threads.append(threads)
+
+	for row in subject_rows:
+		if abort_event.is_set():
+			break
+		subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+		queues[0].put({'row': row, 'subject': subj_spred_ID, 'session': session_name, 'file': row['Filename'], 'start_time': time.time()})
+
+	# Shut the stages down in order, each once the stage before it has passed on all of its subjects.
+	for stage_num, threads in enumerate(stage_threads):
+		for thread in threads:
+			queues[stage_num].put(None)
+		for thread in threads:
+			thread.join()
+
+	if abort_event.is_set():
+		sys.exit()
+
+
+def run_subject_pool(subject_rows, project_constants):
+	'''
+	Summary:
+		Uploads subjects concurrently with a pool of worker threads.  Each worker runs the whole pipeline for one subject (subject, session, scan, files), so the order of steps within a subject is preserved.  Failed subjects are put on the dead letter list by run_subject; if the upload has to stop (invalid credentials, or --fail-fast), subjects that have not started yet are skipped and the program exits once the running ones finish.
+	Args:
+		subject_rows: A list of rows from the subject metadata DataFrame to upload.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	abort_event = threading.Event()
+
+	def upload_worker(row):
+		if abort_event.is_set():
+			return
+		acquire_concurrency_slot('subjects', project_constants)
+		try:
+			run_subject(row, project_constants)
+		except SystemExit:
+			abort_event.set()
+		finally:
+			release_concurrency_slot('subjects', project_constants)
+
+	pool = ThreadPool(project_constants['num_workers'])
+	try:
+		for result in pool.imap_unordered(upload_worker, subject_rows):
+			pass
+	finally:
+		pool.close()
+		pool.join()
+
+	if abort_event.is_set():
+		sys.exit()
+
+
+def run_upload(project_constants, resume=False):
+	'''
+	Summary:
+		Opens the connection pool, log file, compression report, header cache and journal, uploads the subjects with upload_data, then closes everything.
+	Args:
+		project_constants: A dictionary containing metadata related to the project and upload.
+		resume: A boolean; True to skip the steps completed by the previous run, according to its journal.
+	'''
+
+	init_connection_pool(project_constants)
+
+	project_constants['log_file'] = init_log_file(project_constants)
+	project_constants['compression_report'] = init_compression_report(project_constants['log_file'].name)
+	project_constants['metrics_file'] = init_metrics_file(project_constants['log_file'].name)
+
+	if project_constants['header_cache_file'] is not None:
+		project_constants['header_cache'] = init_header_cache(project_constants)
+
+	project_constants['journal_file'] = init_journal(project_constants, resume, project_constants['dry_run'])
+	init_concurrency_control(project_constants)
+
+	try:
+		upload_data(project_constants)
+	finally:
+		project_constants['log_file'].close()
+		project_constants['compression_report'].close()
+		project_constants['metrics_file'].close()
+		if project_constants['journal_file'] is not None:
+			project_constants['journal_file'].close()
+		if project_constants['header_cache'] is not None:
+			flush_header_cache(project_constants)
+			project_constants['header_cache'].close()
+
+
+def scan_directory(dir_name):
+	'''
+	Summary:
+		Lists a directory with the size, modification time and type of each entry, using scandir when it is available (on Linux it gets the type of each entry with the listing), and os.listdir and os.stat otherwise.  Symbolic links are followed.
+	Args:
+		dir_name: A string path to a directory.
+	Returns:
+		entries: A dictionary mapping the names in the directory to dictionaries with their size, mtime and is_dir.
+	'''
 
-	datetime = get_minc_field('vnmr:time_submitted', MINC_filename)
-	if datetime is not None:
-		date = datetime[0:8]
-		date = insert(date, '-', 6)
-		date = insert(date, '-', 4)
-		# date should conform to YYYY-MM-DD format
-		session_params['xnat:mrSessionData/date'] = date
-		time = datetime[9:len(datetime)]
-		time = insert(time, ':', 4)
-		time = insert(time, ':', 2)
-		# time should conform to HH:MM:SS format
-		session_params['xnat:mrSessionData/time'] = time
-	
-	operator = get_minc_field('study:operator', MINC_filename)
-	if operator is not None:
-		session_params['xnat:mrSessionData/operator'] = operator
+	entries = {}
 
-	return session_params
+	if scandir is not None:
+		for entry in scandir(dir_name):
+			entry_stat = entry.stat()
+			entries[entry.name] = {'size': entry_stat.st_size, 'mtime': entry_stat.st_mtime, 'is_dir': entry.is_dir()}
+	else:
+		for name in os.listdir(dir_name):
+			entry_stat = os.stat(os.path.join(dir_name, name))
+			entries[name] = {'size': entry_stat.st_size, 'mtime': entry_stat.st_mtime, 'is_dir': stat.S_ISDIR(entry_stat.st_mode)}
 
+	return entries
 
-def get_subject_metadata(row, project_constants):
+
+def select_header_cache_entries(header_cache, project_constants):
 	'''
 	Summary:
-		Extracts subject metadata from a row from a pandas data frame (row) and creates a dictionary mapping XNAT XML (keys) to MINC metadata (values).
+		Lists the entries of every table of the header cache, least recently used first.
 	Args:
-		row: A row in a pandas data frame representing subject metadata.
+		header_cache: The sqlite3 connection to the cache database.
 		project_constants: A dictionary containing metadata related to the project and upload.
 	Returns:
-		subj_params: A dictionary containing subject metadata.
+		A sqlite3 cursor of (table, path, size in bytes) rows.  The size of an entry is the length of its path and its header, digest or listing.
 	'''
 
-	subj_params = {
-		'pi_firstname': project_constants['pi_firstname'],
-		'pi_lastname': project_constants['pi_lastname']
-	}
-	
-	if pd.notnull(row['Genotype']):
-		subj_params['group'] = row['Genotype']
-	if pd.notnull(row['dob']):
-		subj_params['dob'] = row['dob']
-	if pd.notnull(row['gender']):
-		subj_params['gender'] = row['gender']
-	if pd.notnull(row['handedness']):
-		subj_params['handedness'] = row['handedness']
-	if pd.notnull(row['race']):
-		subj_params['race'] = row['race']
-	if pd.notnull(row['ethnicity']):
-		subj_params['ethnicity'] = row['ethnicity']
-	if pd.notnull(row['weight']):
-		subj_params['weight'] = row['weight']
-	if pd.notnull(row['height']):
-		subj_params['height'] = row['height']
+	selects = ["SELECT '" + table + "' AS table_name, path, length(path) + length(" + column + ") AS entry_bytes, last_used FROM " + table for table, column in sorted(project_constants['header_cache_tables'].items())]
 
-	return subj_params
+	return header_cache.execute('SELECT table_name, path, entry_bytes FROM (' + ' UNION ALL '.join(selects) + ') ORDER BY last_used')
 
 
-def init_log_file(project_constants):
+def send_request(method, url, action, subj_spred_ID, project_constants, body_factory=None, accept_statuses=(), replay_accept_statuses=(), before_retry=None, **kwargs):
 	'''
 	Summary:
-		Creates a log file to record subjects that were successfully uploaded to Brain-CODE.
+		Calls a web service, retrying with exponential backoff and jitter if the connection fails or the server returns a transient error (e.g. 500, 502, 503, 504).  Other errors, such as 401 and 403, are not retried.  The final response is checked with check_HTTP_status_code.
 	Args:
+		method: A string; the HTTP method (get, put, post, delete).
+		url: A string specifying the url of the web service.
+		action: A string representing the action being taken (e.g. creating subject), used in error messages.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
 		project_constants: A dictionary containing metadata related to the project and upload.
+		body_factory: Optionally, a function returning the keyword arguments holding the request body (e.g. data or files).  It is called for every attempt, since a streamed body can only be sent once.
+		accept_statuses: A list of HTTP status codes to return to the caller instead of treating as errors (e.g. 404 when checking whether something exists).
+		replay_accept_statuses: A list of HTTP status codes that mean success when returned by a retried request (e.g. 404 when retrying a delete that may have succeeded).
+		before_retry: Optionally, a function called before each retry which returns True if the failed attempt actually took effect, so the request doesn't need to be sent again.
+		kwargs: Other keyword arguments passed to requests (e.g. params, headers).
 	Returns:
-		spred_log_file: The log file handle.
+		resp: The response of the web service call, or None if before_retry found that the request had taken effect.
 	'''
 
-	# log files will be found in this subdirectory.
-	log_dir_name = 'logs'
+	kwargs.setdefault('timeout', project_constants['request_timeout'])
+	start_time = time.time()
 
-	if not os.path.isdir(log_dir_name):
-		os.makedirs(log_dir_name)
+	for attempt in range(project_constants['max_retries'] + 1):
 
-	todays_datetime = datetime.datetime.now()
-	fname = log_dir_name + '/' + str(todays_datetime) + ' spred braincode upload.txt'
-	spred_log_file = open(fname, 'w')
-	spred_log_file.writelines('Uploaded the following subjects and related information into project: ' + project_constants['project_name'] + '\n')
-	spred_log_file.writelines('Uploaded data to the following url: ' + project_constants['base_url'] + '\n')
-	spred_log_file.writelines('Data was uploaded by user: ' + project_constants['username'] + '\n')
-	spred_log_file.writelines('\n')
-	spred_log_file.writelines('SPReD_ID' + ',' + 'MINC_Filename' + ',' + 'Processed_Folder' '\n')
+		if attempt > 0:
+			# Exponential backoff with jitter, so that concurrent workers don't retry in lockstep.
+			backoff_secs = min(project_constants['retry_max_backoff_secs'], project_constants['retry_backoff_secs'] * 2 ** (attempt - 1))
+			time.sleep(random.uniform(0.5, 1.0) * backoff_secs)
+			if before_retry is not None and before_retry():
+				record_metric('request', subj_spred_ID, time.time() - start_time, project_constants, action=action, method=method, status='already stored', attempts=attempt)
+				return None
 
-	return spred_log_file
+		request_kwargs = dict(kwargs)
+		if body_factory is not None:
+			request_kwargs.update(body_factory())
+		has_body = any(key in request_kwargs for key in ['data', 'files'])
+
+		attempt_start_time = time.time()
+		try:
+			resp = project_constants['session'].request(method, url, **request_kwargs)
+		except (requests.ConnectionError, requests.Timeout) as e:
+			observe_request(time.time() - attempt_start_time, True, has_body, project_constants)
+			if attempt == project_constants['max_retries']:
+				record_metric('request', subj_spred_ID, time.time() - start_time, project_constants, action=action, method=method, status='connection failed', attempts=attempt + 1)
+				notify_user('Error processing subject: ' + subj_spred_ID + '\n' + 'Problem related to action: ' + action + '\n' + 'Connection failed: ' + str(e), project_constants)
+				raise SpredUploadError(action + ' (connection failed)')
+			notify_user('Retrying ' + action + ' for subject ' + subj_spred_ID + ' after connection error: ' + str(e), project_constants)
+			continue
+
+		observe_request(time.time() - attempt_start_time, resp.status_code in project_constants['retry_statuses'], has_body, project_constants)
+
+		if resp.status_code in accept_statuses or (attempt > 0 and resp.status_code in replay_accept_statuses):
+			record_metric('request', subj_spred_ID, time.time() - start_time, project_constants, action=action, method=method, status=resp.status_code, attempts=attempt + 1)
+			return resp
+
+		if resp.status_code in project_constants['retry_statuses'] and attempt < project_constants['max_retries']:
+			notify_user('Retrying ' + action + ' for subject ' + subj_spred_ID + ' after HTTP ' + str(resp.status_code), project_constants)
+			continue
+
+		break
 
+	record_metric('request', subj_spred_ID, time.time() - start_time, project_constants, action=action, method=method, status=resp.status_code, attempts=attempt + 1)
+	check_HTTP_status_code(action, resp, subj_spred_ID, project_constants)
 
-def init_project_constants():
+	return resp
+
+
+def send_resource_files(file_names, zip_name, url, subj_spred_ID, action, project_constants, base_dir=None, individually=False, packaged_zip=None):
 	'''
 	Summary:
-		Initialize project constants used for the upload, such as the PI first and last name, constant scanning parameters, etc.  Decided against using collections.namedtuple().  For a new project, the user should change the values here!
+		Uploads the files of a SPReD resource, either as one zip file or, for uploads that can be synchronized later or that use several connections per subject, as individual files (see upload_files).  Files that still fail individually are uploaded as one zip file.  Every file is hashed while it is sent, so that the upload can be verified without reading it again.
+	Args:
+		file_names: A list of string paths to files.
+		zip_name: A string specifying the zip file name to upload, or None if the files must be uploaded individually.
+		url: A string specifying the location to upload files to.
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string specifying whether distortion corrected files or stats volumes are being uploaded.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		base_dir: Optionally, the folder the paths of individually uploaded files within the resource are relative to (see get_resource_file_name).
+		individually: Optionally, True to upload the files individually whatever the upload options.
+		packaged_zip: Optionally, the size and MD5 digest of the zip file already built by package_scan_files.
 	Returns:
-		project_constants: A dictionary containing name:value pairs constant throughout the project.  This is preferred over global variables so that the module can potentially be imported down the line.  It's unlikely that this module will be imported simply because there is so much customization specific to MICe here.
+		uploaded: A list of dictionaries, one for every file stored in the resource, with its name, size and md5, and the local files it holds (file_names).
 	'''
 
-	project = 'PND11'
-	site = 'HSC'
+	if packaged_zip is not None:
+		return [dict(send_zip_file(zip_name, packaged_zip[0], packaged_zip[1], url, subj_spred_ID, action, project_constants), file_names=file_names)]
 
-	username = raw_input('SPReD username:')
-	password = raw_input('SPReD password:')
+	uploaded = []
 
-	session = requests.session()
-	session.auth = (username, password)
+	if individually or project_constants['upload_files_individually'] or project_constants['num_file_workers'] > 1:
+		uploaded, failed_files = upload_files(file_names, url, subj_spred_ID, action, project_constants, base_dir)
+		if not failed_files:
+			return uploaded
+		if zip_name is None:
+			raise SpredUploadError(failed_files[0][1])
+		# Fall back to a single zip file for the files that couldn't be uploaded individually.
+		notify_user(str(len(failed_files)) + ' file(s) of subject ' + subj_spred_ID + ' failed to upload individually, uploading them as ' + zip_name + ' instead', project_constants)
+		file_names = [file_name for file_name, problem in failed_files]
 
-	project_constants = {
-		# project details
-		'project': project,
-		'site': site,
-		'project_name': project + '_' + site + '_' + 'test',
-		'visit_num': '01',
-		'session_num': '01',
-		'scan_num': '01',
-		'resource_num': '01',
-		'pi_firstname': 'Jason',
-		'pi_lastname': 'Lerch',
-		'acquisition_site': 'Mouse Imaging Centre (MICe)',
-		'base_url': 'https://spreddev.braincode.ca/spred/data/archive/projects/',
-		# scanning parameters
-		'modality': 'MR',
-		'field_strength': '7.0T',
-		'scanner': 'Agilent 7T Animal System',
-		'scanner_manufacturer': 'Agilent',
-		'scan_type': 'T2 FSE 3D MICE EX-VIVO',
-		'quality': 'usable',
-		'file_type': 'MINC',
-		'flip_angle': 90,  # will this always be 90?
-		# logon info
-		'username': username,
-		'password': password,
-		'session': 	session,
-		# upload parameters
-		'subject_metadata_file': 'SubjectMetadata.csv',
-		'automatic_upload': False  # upload is interactive by default
-	}
+	uploaded.append(dict(upload_zip(file_names=file_names, zip_name=zip_name, url=url, subj_spred_ID=subj_spred_ID, action=action, project_constants=project_constants), file_names=file_names))
 
-	return project_constants
+	return uploaded
 
 
-def insert(original, new, pos):
-	'''Inserts a char (new) inside original string (original) at the specified position (pos).'''
+def send_zip_file(zip_name, zip_size, zip_md5, url, subj_spred_ID, action, project_constants):
+	'''
+	Summary:
+		Uploads a temporary zip file written by build_zip_file to a SPReD resource, then deletes it.
+	Args:
+		zip_name: A string specifying the zip file name.
+		zip_size: An integer; the size of the zip file in bytes.
+		zip_md5: A string; the MD5 digest of the zip file.
+		url: A string specifying the location to upload files to.
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string specifying whether distortion corrected files or stats volumes are being uploaded.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A dictionary with the name, size and md5 of the file stored in the resource, for verify_resource_files.
+	'''
 
-	return original[:pos] + new + original[pos:]
+	zip_files = []
+
+	def open_zip_file():
+		zip_files.append(open(zip_name, 'rb'))
+		return {'files': {'file': zip_files[-1]}}
+
+	# A form is read whole before it is sent, so with a bandwidth limit the zip file is sent as the body of the request instead, which is throttled as it is read.
+	if project_constants['bandwidth_limit'] is None and not project_constants['bandwidth_schedule']:
+		request_url = url
+		body_factory = open_zip_file
+		params = dict(get_resource_metadata(project_constants), overwrite='true')
+		headers = {}
+	else:
+		request_url = url + zip_name
+		body_factory = lambda: {'data': generate_throttled_chunks(generate_mapped_file_chunks(zip_name), project_constants)}
+		params = dict(get_resource_metadata(project_constants), inbody='true', overwrite='true')
+		headers = {'Content-Type': 'application/zip'}
+
+	acquire_concurrency_slot('files', project_constants)
+	start_time = time.time()
+	try:
+		send_request('post', request_url, action, subj_spred_ID, project_constants,
+			body_factory=body_factory,
+			before_retry=lambda: is_server_file_uploaded(url, zip_name, zip_size, subj_spred_ID, project_constants),
+			params=params, headers=headers, stream=True)
+	finally:
+		release_concurrency_slot('files', project_constants)
+		for zip_file in zip_files:
+			zip_file.close()
+		# Delete the .zip file created to upload once it's done uploading
+		os.remove(zip_name)
+	record_metric('upload', subj_spred_ID, time.time() - start_time, project_constants, action=action, bytes=zip_size)
+	record_upload_stats(project_constants, num_bytes=zip_size)
+
+	return {'name': zip_name, 'size': zip_size, 'md5': zip_md5}
+
+
+def store_header_cache_entry(header_cache, table, path, fields, project_constants):
+	'''
+	Summary:
+		Stores an entry in a table of the header cache, replacing the entry of the same path, and evicts the least recently used entries if the cache has grown past header_cache_max_bytes (see evict_header_cache).  Doesn't commit, so that entries are written in a single transaction by flush_header_cache; the caller must hold header_cache_lock.
+	Args:
+		header_cache: The sqlite3 connection to the cache database.
+		table: A string; the table, one of header_cache_tables.
+		path: A string; the absolute path of the file or directory the entry describes, or the url of the zip file.
+		fields: A dictionary mapping the other columns of the table to their values.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
 
+	size_query = 'SELECT length(path) + length(' + project_constants['header_cache_tables'][table] + ') FROM ' + table + ' WHERE path = ?'
+	columns = sorted(fields)
 
-def notify_user_of_success(subj_spred_ID):
-	'''Notifies the user of the successful creation of a collective subject, session, scan.'''
+	replaced_row = header_cache.execute(size_query, (path,)).fetchone()
+	header_cache.execute('INSERT OR REPLACE INTO ' + table + ' (path, last_used, ' + ', '.join(columns) + ') VALUES (?, ?' + ', ?' * len(columns) + ')',
+		[path, time.time()] + [fields[column] for column in columns])
+	project_constants['header_cache_bytes'] += header_cache.execute(size_query, (path,)).fetchone()[0] - (replaced_row[0] if replaced_row is not None else 0)
+	project_constants['header_cache_hits'].pop((table, path), None)
 
-	print 'Successfully created subject: ' + subj_spred_ID
+	evict_header_cache(header_cache, project_constants)
 
 
-def print_to_logfile(subj_spred_ID, MINC_filename, processed_subj_dir):
-	'''Prints a line to the log file containing the SPReD_ID of the subject and the file associated with that subject.'''
+def throttle_bandwidth(num_bytes, project_constants):
+	'''
+	Summary:
+		Enforces the bandwidth limit in force (see get_bandwidth_limit) with a token bucket shared by every concurrent transfer.  The bucket fills at the limit and holds bandwidth_burst_secs of it.  A transfer takes the tokens for the bytes it is about to send, going into debt if there aren't enough, and waits for the debt to be paid back, so transfers are served in turn and share the limit fairly.  Does nothing when transfers aren't limited.
+	Args:
+		num_bytes: An integer; the number of bytes about to be sent.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	limit = get_bandwidth_limit(project_constants)
+	if limit is None:
+		return
+
+	with project_constants['bandwidth_lock']:
+		bucket = project_constants['bandwidth_bucket']
+		now = time.time()
+		capacity = limit * project_constants['bandwidth_burst_secs']
+		if bucket['time'] is None:
+			bucket['tokens'] = capacity
+		else:
+			bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['time']) * limit)
+		bucket['time'] = now
+		bucket['tokens'] -= num_bytes
+		wait_secs = max(0.0, -bucket['tokens'] / limit)
+		bucket['wait_secs'] += wait_secs
+
+	if wait_secs > 0:
+		time.sleep(wait_secs)
+
+
+def update_subject(row, project_constants):
+	'''
+	Summary:
+		Brings a subject that already exists in SPReD up to date without deleting it, which keeps its strain code and the files that are already correct.  One request retrieves the metadata of the subject, session, scan and resources, and only the fields that changed are sent.  A second request lists the files of every resource of the scan, which are compared with the local files by name, size and digest, and only the missing or different files are uploaded individually.  Missing sessions, scans and resources are created.  A zip file left by an earlier upload is kept as long as the files it holds haven't changed, according to the manifest recorded when it was uploaded (see get_current_zip_files); otherwise it is replaced by the individual files.
+	Args:
+		row: A row in a pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
 
-	spred_log_file.writelines(','.join([subj_spred_ID, MINC_filename, processed_subj_dir]) + '\n')
+	subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+	MINC_filename = row['Filename']
+	processed_subj_dir = row['ProcessedFolder']
+
+	subject_url = project_constants['base_url'] + project_constants['project_name'] + '/subjects/' + subj_spred_ID
+	session_url = subject_url + '/experiments/' + session_name
+	scan_url = session_url + '/scans/' + str(int(project_constants['scan_num']))
+
+	subject_item = get_server_subject(subj_spred_ID, project_constants)
+	session_item = get_xnat_child_item(subject_item, 'experiments/experiment', 'label', session_name)
+	scan_item = get_xnat_child_item(session_item, 'scans/scan', 'ID', str(int(project_constants['scan_num'])))
+
+	# Subject fields are REST shortcuts for fields of the subject's demographics and investigator.
+	subj_params = get_subject_metadata(row, project_constants)
+	field_paths = dict((key, 'demographics/' + key) for key in subj_params)
+	field_paths.update({'pi_firstname': 'investigator/firstname', 'pi_lastname': 'investigator/lastname', 'group': 'group'})
+	changed_params = get_changed_metadata(subj_params, field_paths, get_xnat_item_fields(subject_item))
+	if changed_params:
+		send_request('put', subject_url, 'updating subject', subj_spred_ID, project_constants, params=changed_params)
+
+	minc_header = get_minc_header(MINC_filename, project_constants)
+
+	# A missing session or scan is created with all of its fields.
+	for url, item, params, action in [
+		(session_url, session_item, get_session_metadata(minc_header, session_name, project_constants), 'updating session'),
+		(scan_url, scan_item, get_scan_metadata(minc_header, project_constants), 'updating scan')
+	]:
+		field_paths = dict((key, key.split('/', 1)[1]) for key in params if key != 'xsiType')
+		changed_params = get_changed_metadata(params, field_paths, get_xnat_item_fields(item)) if item is not None else params
+		if changed_params:
+			changed_params['xsiType'] = params['xsiType']
+			send_request('put', url, action, subj_spred_ID, project_constants, params=changed_params)
+
+	server_resources = get_server_scan_files(scan_url, subj_spred_ID, project_constants) or {}
+
+	resources = [
+		(int(project_constants['resource_num']), [MINC_filename], None, 'upload distortion corrected'),
+		(int(project_constants['resource_num']) + 1, get_registration_files(processed_subj_dir, project_constants), processed_subj_dir, 'upload resampled and stats registrations')
+	]
+
+	num_uploaded = 0
+	num_files = 0
+
+	for resource_num, file_names, base_dir, action in resources:
+		url = scan_url + '/resources/' + str(resource_num) + '/files/'
+		server_files = server_resources.get(str(resource_num))
+
+		if server_files is None:
+			# An empty resource doesn't appear in the file listing.
+			if get_xnat_child_item(scan_item, 'file', 'label', str(resource_num)) is None:
+				create_resource(scan_url, resource_num, subj_spred_ID, project_constants)
+			server_files = {}
+
+		current_zips = get_current_zip_files(url, server_files, file_names, project_constants)
+		zipped_files = set(file_name for zipped in current_zips.values() for file_name in zipped)
+
+		local_names = set(get_resource_file_name(file_name, base_dir) for file_name in file_names)
+		changed_files = [file_name for file_name in file_names if file_name not in zipped_files and
+			not is_server_file_current(file_name, server_files.get(get_resource_file_name(file_name, base_dir)), project_constants)]
+		if changed_files:
+			upload_resource_files(changed_files, None, url, subj_spred_ID, action, project_constants, base_dir, individually=True)
+		num_files += len(file_names)
+		num_uploaded += len(changed_files)
+
+		for server_name in server_files:
+			if server_name not in local_names and server_name not in current_zips:
+				if server_name.endswith('.zip'):
+					send_request('delete', url + server_name, 'deleting zip file', subj_spred_ID, project_constants, replay_accept_statuses=[404])
+				else:
+					notify_user('File ' + server_name + ' of subject ' + subj_spred_ID + ' is in SPReD but not in ' + processed_subj_dir, project_constants)
+
+	notify_user('Updated subject ' + subj_spred_ID + ': uploaded ' + str(num_uploaded) + ' of ' + str(num_files) + ' files', project_constants)
+	print_to_logfile(subj_spred_ID, MINC_filename, processed_subj_dir, project_constants)
+	record_step_completed(subj_spred_ID, 'complete', MINC_filename, project_constants)
+	record_upload_stats(project_constants, subjects=1)
 
 
 def upload_data(project_constants):
@@ -640,82 +3652,364 @@ def upload_data(project_constants):
 		project_constants: A dictionary containing metadata related to the project and upload.
 	'''
 
-	# Get a list of all SPReD IDs currently in the project.
-	server_subject_IDs = get_server_subject_IDs(project_constants)
+	# Get the SPReD IDs and strains currently in the project with one listing request.
+	subjects_json = get_server_project_snapshot(project_constants, ['label', 'ethnicity'])
+	server_subject_IDs = get_server_subject_IDs(project_constants, subjects_json)
+	project_constants['server_subject_IDs'] = server_subject_IDs
 
 	# Construct dictionary of strains currently in the project and their associated strain codes.
-	server_uploaded_strains = get_server_uploaded_strains(project_constants, server_subject_IDs)
+	server_uploaded_strains = get_server_uploaded_strains(project_constants, server_subject_IDs, subjects_json)
 
 	# Create data.frame-like structure using pandas which will contain the subject metadata.
 	subject_metadata = pd.read_table(filepath_or_buffer=project_constants['subject_metadata_file'], dtype={'Filename': str}, sep=',')
+	check_subject_metadata_columns(subject_metadata, project_constants)
+
+	# List the processed folders once, for every later stage of the upload.
+	init_directory_index(subject_metadata, project_constants)
 
 	# Generate SPReD IDs for subjects defined in the subject metadata file.
+	id_start_time = time.time()
 	subject_metadata = generate_subject_IDs(project_constants, server_uploaded_strains, subject_metadata)
+	record_metric('generate IDs', None, time.time() - id_start_time, project_constants, subjects=len(subject_metadata))
 
-	# Loop through subject metadata, dispatch other methods calling web services to create subject, session, and scan.
-	# Use status_code variable to keep track of whether the upload was successful.
-	for index, row in subject_metadata.iterrows():
+	# Check the files of every subject before anything is changed in SPReD.
+	preflight = check_subject_metadata(subject_metadata, project_constants)
+	print_preflight_report(subject_metadata, preflight, project_constants)
 
-		subj_num = str(row['SubjNum'])
-		# subj_num = zero_pad_num(subj_num, 4)
+	# Work out the whole upload first, so that it can be reviewed and approved once, then carried out unattended.
+	plan = get_upload_plan(subject_metadata, preflight, project_constants)
+	schedule, worker_loads = get_subject_schedule(plan, project_constants['num_workers'])
+	predicted_secs = print_upload_plan(plan, worker_loads, project_constants)
 
-		MINC_filename = row['Filename']
-		processed_subj_dir = row['ProcessedFolder']
-		subj_spred_ID = project_constants['project_name'] + '_' + subj_num
-		session_name = subj_spred_ID + '_' +  project_constants['visit_num'] + '_' + 'SE' +  project_constants['session_num'] + '_' +  project_constants['modality']
-		are_you_sure = ''
-
-		if os.path.exists(MINC_filename):
-
-			# Only accept 'y' and 'n' as valid user input for choosing to create a subject entity.
-			# Don't give user option if it's an automatic upload.
-			while are_you_sure != 'y' and are_you_sure != 'n':
-				if project_constants['automatic_upload'] == True:
-					are_you_sure = 'y'
-				else:
-					are_you_sure = raw_input("Create subject %s" % subj_spred_ID + " with file %s? (y/n): " % MINC_filename)
-				if are_you_sure == 'y':
-					create_subject(MINC_filename, subj_spred_ID, row, project_constants)
-					create_session(MINC_filename, subj_spred_ID, session_name, project_constants)
-					create_scan(MINC_filename, subj_spred_ID, session_name, project_constants, processed_subj_dir)
-				elif are_you_sure == 'n':
-					pass
-				else:
-					print 'Please enter either y or n'
+	if project_constants['dry_run']:
+		return
 
-		else:
+	if not confirm_upload_plan(plan, project_constants):
+		notify_user('Upload cancelled.', project_constants)
+		return
+
+	start_time = time.time()
+
+	# Dispatch other methods calling web services to create subject, session, and scan, for every subject of the plan.
+	subject_rows = [entry['row'] for entry in schedule]
+	if project_constants['pipeline_uploads']:
+		run_subject_pipeline(subject_rows, project_constants)
+	elif project_constants['num_workers'] > 1:
+		run_subject_pool(subject_rows, project_constants)
+	else:
+		for row in subject_rows:
+			run_subject(row, project_constants)
+
+	# The throughput of the run is used to predict how long the next upload will take.
+	elapsed_secs = time.time() - start_time
+	record_metric('run', None, elapsed_secs, project_constants, bytes=project_constants['upload_stats']['bytes'], subjects=project_constants['upload_stats']['subjects'],
+		planned_bytes=sum(worker_loads), workers=project_constants['num_workers'], predicted_secs=predicted_secs)
+	print_upload_summary(elapsed_secs, project_constants, predicted_secs)
+	print_metrics_summary(project_constants)
+
+
+def upload_file(file_name, url, subj_spred_ID, action, project_constants, base_dir=None):
+	'''
+	Summary:
+		Uploads a single file, uncompressed, to a SPReD resource.  The file is streamed from a memory map in the body of the request (see generate_mapped_file_chunks), replacing a file with the same name.  Its MD5 digest is computed while it is sent and stored in the header cache, so that a later update can compare it without reading it again.
+	Args:
+		file_name: A string path to a file.
+		url: A string specifying the url of the resource's files (ending in /files/).
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string describing the upload, used in error messages.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		base_dir: Optionally, the folder the file's path within the resource is relative to (see get_resource_file_name).
+	Returns:
+		A dictionary with the name, size and md5 of the file stored in the resource, for verify_resource_files.
+	'''
+
+	server_name = get_resource_file_name(file_name, base_dir)
+	file_stat = os.stat(file_name)
+	file_size = file_stat.st_size
+	digests = {}
+
+	# overwrite=true makes a retried upload safe, and before retrying, the resource is checked in case the failed attempt actually stored the file.
+	# The resource metadata is sent so that the upload can create the resource when it doesn't exist yet (see create_subject_hierarchy).
+	acquire_concurrency_slot('files', project_constants)
+	start_time = time.time()
+	try:
+		send_request('post', url + server_name, action, subj_spred_ID, project_constants,
+			body_factory=lambda: {'data': generate_throttled_chunks(generate_mapped_file_chunks(file_name, digests), project_constants)},
+			before_retry=lambda: is_server_file_uploaded(url, server_name, file_size, subj_spred_ID, project_constants),
+			params=dict(get_resource_metadata(project_constants), inbody='true', overwrite='true'))
+	finally:
+		release_concurrency_slot('files', project_constants)
+	record_metric('upload', subj_spred_ID, time.time() - start_time, project_constants, action=action, bytes=file_size)
+	record_upload_stats(project_constants, num_bytes=file_size)
+
+	# The digest is only complete if the whole file was sent, and only valid if the file didn't change meanwhile.
+	if 'md5' in digests and os.stat(file_name).st_mtime == file_stat.st_mtime:
+		record_file_md5(file_name, file_stat, digests['md5'], project_constants)
+
+	return {'name': server_name, 'size': file_size, 'md5': digests.get('md5')}
+
+
+def upload_files(file_names, url, subj_spred_ID, action, project_constants, base_dir=None):
+	'''
+	Summary:
+		Uploads files individually to a SPReD resource, up to num_file_workers at a time over separate connections, so that the upload of a subject's files is bounded by bandwidth rather than by sending them one after the other.  Each file is retried on its own by send_request, and a file that still fails doesn't stop the others.
+	Args:
+		file_names: A list of string paths to files.
+		url: A string specifying the url of the resource's files (ending in /files/).
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string describing the upload, used in error messages.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		base_dir: Optionally, the folder the paths of the files within the resource are relative to (see get_resource_file_name).
+	Returns:
+		uploaded: A list of the files uploaded, as returned by upload_file, with the local file (file_names).
+		failed_files: A list of (file name, problem) pairs for the files that failed to upload.
+	'''
+
+	# SystemExit (invalid credentials) would silently kill a pool thread, so it is passed back and raised again once the pool is done.
+	def upload_worker(file_name):
+		try:
+			return dict(upload_file(file_name, url, subj_spred_ID, action, project_constants, base_dir), file_names=[file_name])
+		except SpredUploadError as e:
+			return file_name, str(e)
+		except SystemExit:
+			return file_name, SystemExit
+
+	num_file_workers = min(project_constants['num_file_workers'], len(file_names))
+	if num_file_workers <= 1:
+		results = [upload_worker(file_name) for file_name in file_names]
+	else:
+		pool = ThreadPool(num_file_workers)
+		try:
+			results = pool.map(upload_worker, file_names)
+		finally:
+			pool.close()
+			pool.join()
+
+	uploaded = [result for result in results if isinstance(result, dict)]
+	failed_files = [result for result in results if not isinstance(result, dict)]
+	if any(problem is SystemExit for file_name, problem in failed_files):
+		sys.exit()
+
+	return uploaded, failed_files
+
+
+def upload_resource_files(file_names, zip_name, url, subj_spred_ID, action, project_constants, base_dir=None, individually=False, packaged_zip=None):
+	'''
+	Summary:
+		Uploads the files of a SPReD resource (see send_resource_files), then verifies them against a single listing of the resource (see verify_resource_files).  Files whose size or digest don't match are uploaded again, up to verify_retries times, before the upload fails.  Once the files are uploaded, the manifest of the zip file is recorded (see record_zip_manifests).
+	Args:
+		file_names: A list of string paths to files.
+		zip_name: A string specifying the zip file name to upload, or None if the files must be uploaded individually.
+		url: A string specifying the location to upload files to.
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string specifying whether distortion corrected files or stats volumes are being uploaded.
+		project_constants: A dictionary containing metadata related to the project and upload.
+		base_dir: Optionally, the folder the paths of individually uploaded files within the resource are relative to (see get_resource_file_name).
+		individually: Optionally, True to upload the files individually whatever the upload options.
+		packaged_zip: Optionally, the size and MD5 digest of the zip file already built by package_scan_files.
+	'''
+
+	# The files are stat'ed before they are read, so that a file changed while it is uploaded doesn't match the zip file's manifest.
+	file_entries = dict((file_name, get_file_entry(file_name, project_constants)) for file_name in file_names)
+
+	uploaded = send_resource_files(file_names, zip_name, url, subj_spred_ID, action, project_constants, base_dir, individually, packaged_zip)
+	# A file sent again replaces the one of the same name.
+	stored = dict((entry['name'], entry) for entry in uploaded)
+
+	if not project_constants['verify_uploads']:
+		record_zip_manifests(url, stored.values(), zip_name, file_entries, project_constants)
+		return
+
+	for attempt in range(project_constants['verify_retries'] + 1):
+		mismatched = verify_resource_files(url, uploaded, subj_spred_ID, action, project_constants)
+		if not mismatched:
+			record_zip_manifests(url, stored.values(), zip_name, file_entries, project_constants)
+			return
+
+		mismatched_names = ', '.join(entry['name'] for entry in mismatched)
+		if attempt == project_constants['verify_retries']:
+			notify_user('Error processing subject: ' + subj_spred_ID + '\n' + 'Problem related to action: verifying ' + action + '\n' +
+				'SPReD does not have the files that were uploaded: ' + mismatched_names, project_constants)
+			raise SpredUploadError('verifying ' + action + ' (' + mismatched_names + ')')
+
+		notify_user('SPReD does not have the files of subject ' + subj_spred_ID + ' that were uploaded (' + mismatched_names + '), uploading them again', project_constants)
+		write_to_logfile(' '.join(['Uploading again', mismatched_names, 'for subject', subj_spred_ID]) + '\n', project_constants)
+		uploaded = send_resource_files([file_name for entry in mismatched for file_name in entry['file_names']], zip_name, url, subj_spred_ID, action, project_constants, base_dir, individually)
+		stored.update((entry['name'], entry) for entry in uploaded)
+
+
+def upload_scan_files(MINC_filename, subj_spred_ID, processed_subj_dir, uploads, project_constants):
+	'''
+	Summary:
+		Uploads the files of a scan created by create_scan, recording each upload in the journal, then reports the subject as uploaded.  Zip files already built by package_scan_files are sent as they are.
+	Args:
+		MINC_filename: The name of the MINC file to upload.
+		subj_spred_ID: The well-formatted SPReD ID for the subject.
+		processed_subj_dir: The processed folder containing the registrations of the MINC file.
+		uploads: A list of the scan's uploads, as returned by get_scan_uploads.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	for upload in uploads:
+		packaged_zip = (upload['zip_size'], upload['zip_md5']) if 'zip_size' in upload else None
+		upload_resource_files(file_names=upload['file_names'], zip_name=upload['zip_name'], url=upload['url'], subj_spred_ID=subj_spred_ID,
+			action=upload['action'], project_constants=project_constants, base_dir=upload['base_dir'], individually=upload['individually'], packaged_zip=packaged_zip)
+		record_step_completed(subj_spred_ID, upload['step'], MINC_filename, project_constants)
+
+	# Notify user of success and print information about the upload to a logfile
+	notify_user_of_success(subj_spred_ID, project_constants)
+	print_to_logfile(subj_spred_ID, MINC_filename, processed_subj_dir, project_constants)
+	record_step_completed(subj_spred_ID, 'complete', MINC_filename, project_constants)
+
+
+def upload_subject(row, project_constants):
+	'''
+	Summary:
+		Runs the whole upload pipeline for one subject: create the subject, session, and scan, then upload the associated files.
+	Args:
+		row: A row in a pandas DataFrame with subject metadata, after generate_subject_IDs has been run.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	subj_spred_ID, session_name = get_subject_spred_names(row, project_constants)
+	MINC_filename = row['Filename']
+	processed_subj_dir = row['ProcessedFolder']
 
-			print MINC_filename + ' does not exist!  No subject data uploaded.'
+	if subj_spred_ID in project_constants['server_subject_IDs'] and not project_constants['recreate_subjects']:
+		update_subject(row, project_constants)
+		return
+
+	# Read every header field needed by the session and scan metadata at once.
+	minc_header = get_minc_header(MINC_filename, project_constants)
+
+	# The steps recorded by create_subject_hierarchy are skipped below, leaving only the files to upload.
+	if project_constants['xml_upload'] and not is_step_completed(subj_spred_ID, 'subject', MINC_filename, project_constants):
+		create_subject_hierarchy(MINC_filename, subj_spred_ID, session_name, row, project_constants, minc_header)
+
+	create_subject(MINC_filename, subj_spred_ID, row, project_constants)
+	create_session(MINC_filename, subj_spred_ID, session_name, project_constants, minc_header)
+	create_scan(MINC_filename, subj_spred_ID, session_name, project_constants, minc_header)
+	upload_scan_files(MINC_filename, subj_spred_ID, processed_subj_dir, get_scan_uploads(MINC_filename, subj_spred_ID, session_name, processed_subj_dir, project_constants), project_constants)
+
+	record_upload_stats(project_constants, subjects=1)
 
 
 def upload_zip(file_names, zip_name, url, subj_spred_ID, action, project_constants):
 	'''
 	Summary:
-		Uploads a zip file to a specific url containing a set of files relating to a SPReD subject.
+		Uploads a zip file to a specific url containing a set of files relating to a SPReD subject.  When streaming uploads are enabled, the zip file is generated while it is being sent in the body of the request, so no temporary file is written and memory use stays constant; otherwise a temporary zip file is written to the working directory and uploaded.
 	Args:
 		file_names: A list of string paths to files.
 		zip_name: A string specifying the zip file name to upload.
 		url: A string specifying the location to upload files to.
 		subj_spred_ID: The well-formatted SPReD ID.
 		action: A string specifying whether distortion corrected files or stats volumes are being uploaded.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		A dictionary with the name, size and md5 of the file stored in the resource, for verify_resource_files.
 	'''
 
-	# Create .zip file containing all files in the file list to be uploaded.
-	# Hopefully faster than uploading the uncompressed files, but has added step of zipping the files.
-	with zipfile.ZipFile(file=zip_name, mode='a') as zf:
-		for file_name in file_names:
-			zf.write(filename=file_name, compress_type=zipfile.ZIP_DEFLATED)
+	if project_constants['stream_uploads']:
+
+		bytes_sent = [0]
+		original_bytes = sum(os.path.getsize(file_name) for file_name in file_names)
+		digests = {}
+
+		# Only the time spent generating the zip file counts towards building it, not the time spent sending it.
+		# The zip file is hashed as it is sent; a retry generates it again, so the digest starts over.
+		def count_bytes(zip_stream):
+			build_secs = 0.0
+			zip_bytes = 0
+			md5 = hashlib.md5()
+			digests['md5'] = None
+			while True:
+				start_time = time.time()
+				try:
+					chunk = next(zip_stream)
+				except StopIteration:
+					break
+				build_secs += time.time() - start_time
+				zip_bytes += len(chunk)
+				bytes_sent[0] += len(chunk)
+				md5.update(chunk)
+				yield chunk
+			digests['md5'] = md5.hexdigest()
+			digests['size'] = zip_bytes
+			record_metric('zip build', subj_spred_ID, build_secs, project_constants, action=action, bytes=zip_bytes, original_bytes=original_bytes, ratio=zip_bytes / float(max(original_bytes, 1)))
+
+		# A generator body is sent with chunked transfer encoding; inbody tells XNAT that the request body is the file itself.
+		# The zip file is generated again if the upload has to be retried, and overwrite=true replaces a partially stored one.
+		acquire_concurrency_slot('files', project_constants)
+		start_time = time.time()
+		try:
+			send_request('post', url + zip_name, action, subj_spred_ID, project_constants,
+				body_factory=lambda: {'data': generate_throttled_chunks(count_bytes(generate_zip_stream(file_names, subj_spred_ID, project_constants)), project_constants)},
+				params=dict(get_resource_metadata(project_constants), inbody='true', overwrite='true'), headers={'Content-Type': 'application/zip'})
+		finally:
+			release_concurrency_slot('files', project_constants)
+		record_metric('upload', subj_spred_ID, time.time() - start_time, project_constants, action=action, bytes=bytes_sent[0])
+		record_upload_stats(project_constants, num_bytes=bytes_sent[0])
+
+		return {'name': zip_name, 'size': digests.get('size'), 'md5': digests.get('md5')}
+
+	zip_size, zip_md5 = build_zip_file(file_names, zip_name, subj_spred_ID, action, project_constants)
+	return send_zip_file(zip_name, zip_size, zip_md5, url, subj_spred_ID, action, project_constants)
+
+
+def verify_resource_files(url, uploaded, subj_spred_ID, action, project_constants):
+	'''
+	Summary:
+		Checks that a SPReD resource holds the files that were just uploaded to it, by comparing one listing of the resource with the size and MD5 digest computed while each file was sent.  The digest is only compared when SPReD reports one.
+	Args:
+		url: A string specifying the url of the resource's files (ending in /files/).
+		uploaded: A list of the files uploaded, as returned by send_resource_files.
+		subj_spred_ID: The well-formatted SPReD ID.
+		action: A string describing the upload, used in error messages.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	Returns:
+		mismatched: The files of uploaded that the resource doesn't hold, or holds with a different size or digest.
+	'''
 
-	# Upload a file
-	file_to_upload = {'file':open(zip_name, 'rb')}
-	resp = project_constants['session'].post(url, files=file_to_upload, stream=True)
-	check_HTTP_status_code(action, resp, subj_spred_ID)
+	server_files = get_server_resource_files(url, subj_spred_ID, project_constants) or {}
+	mismatched = []
 
-	# Delete the .zip file created to upload once it's done uploading
-	os.remove(zip_name)
+	for entry in uploaded:
+		server_file = server_files.get(entry['name'])
+		if server_file is None:
+			mismatched.append(entry)
+		elif entry['size'] is not None and 'size' in server_file and int(server_file['size']) != entry['size']:
+			mismatched.append(entry)
+		elif entry['md5'] and server_file.get('digest') and str(server_file['digest']).lower() != entry['md5']:
+			mismatched.append(entry)
+
+	return mismatched
+
+
+def write_header_cache_hits(header_cache, project_constants):
+	'''
+	Summary:
+		Updates the last use of the entries read from the header cache since the last flush, without committing.  The caller must hold header_cache_lock.
+	Args:
+		header_cache: The sqlite3 connection to the cache database.
+		project_constants: A dictionary containing metadata related to the project and upload.
+	'''
+
+	header_cache_hits = project_constants['header_cache_hits']
+
+	for table in project_constants['header_cache_tables']:
+		table_hits = [(last_used, path) for (hit_table, path), last_used in header_cache_hits.items() if hit_table == table]
+		if table_hits:
+			header_cache.executemany('UPDATE ' + table + ' SET last_used = ? WHERE path = ?', table_hits)
+	header_cache_hits.clear()
+
+
+def write_to_logfile(line, project_constants):
+	'''Writes a line to the log file; safe to call from concurrent upload workers.'''
+
+	with project_constants['log_lock']:
+		project_constants['log_file'].writelines(line)
+		project_constants['log_file'].flush()
 
-	# TODO - return error message if it failed
-	
 
 def zero_pad_num(num, d):
 	'''
@@ -740,20 +4034,16 @@ def main():
 		The main control flow of the upload program.
 	'''
 
-	global spred_log_file
+	args = parse_command_line_args(sys.argv[1:])
 
 	project_constants = init_project_constants()
 
-	# run script automatically or interactively
-	if len(sys.argv) > 1:
-		if sys.argv[1] == '-a':
-			project_constants['automatic_upload'] = True
-
-	spred_log_file = init_log_file(project_constants)
-
-	upload_data(project_constants)
+	apply_command_line_args(args, project_constants)
 
-	spred_log_file.close()
+	if args.audit:
+		run_audit(project_constants)
+	else:
+		run_upload(project_constants, args.resume)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,366 @@
+# !/usr/bin/python
+
+'''
+Measures SpredNonDicomUpload.py end to end against the local XNAT stand-in in SpredMockServer.py.  A synthetic dataset (MINC-like files, registrations and a SubjectMetadata.csv manifest) is generated in a work directory, then upload_data is run on it, each pass in a process of its own, and the subjects per minute, MB/s, requests per subject and peak memory use of the pass's process are reported.
+
+Options of the upload script go after --, e.g.: python SpredUploadBenchmark.py --subjects 40 --latency 0.05 -- -j 4 --stream
+'''
+
+import argparse
+import datetime
+import json
+import os
+import pandas as pd
+import requests
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import SpredNonDicomUpload
+
+
+def get_mock_stats(base_url):
+	'''Retrieves the request statistics of the mock server.'''
+
+	return requests.get(base_url + '_mock/stats').json()
+
+
+def get_peak_rss_mb():
+	'''Returns the peak resident memory of this process in MB (ru_maxrss is in kilobytes on Linux and bytes on macOS).'''
+
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	if sys.platform == 'darwin':
+		return peak_rss / (1024.0 * 1024.0)
+
+	return peak_rss / 1024.0
+
+
+def install_mincheader_stand_in(work_dir):
+	'''
+	Summary:
+		Puts a mincheader command in front of the PATH that prints the example MINC header, since the synthetic files aren't real MINC files and minc-tools may not be installed.
+	Args:
+		work_dir: The benchmark's work directory.
+	'''
+
+	bin_dir = os.path.join(work_dir, 'bin')
+	example_header = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_files', 'minc_header_example.txt')
+
+	if not os.path.isdir(bin_dir):
+		os.makedirs(bin_dir)
+
+	mincheader = os.path.join(bin_dir, 'mincheader')
+	with open(mincheader, 'w') as script:
+		script.write('#!/bin/sh\ncat "' + example_header + '"\n')
+	os.chmod(mincheader, 0755)
+
+	os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+
+def make_synthetic_dataset(data_dir, num_subjects, num_strains, file_size_mb, num_registrations, registration_size_mb, size_spread=1.0):
+	'''
+	Summary:
+		Generates MINC-like files for a number of subjects, their registrations (split between resampled and stats-volumes folders), and the SubjectMetadata.csv manifest listing them.  The dataset is reused if one with the same parameters is already in data_dir.
+	Args:
+		data_dir: The directory to generate the dataset in.
+		num_subjects: An integer; the number of subjects.
+		num_strains: An integer; the number of strains the subjects are divided between.
+		file_size_mb: A float; the size of each distortion corrected file in MB.
+		num_registrations: An integer; the number of registration files of each subject.
+		registration_size_mb: A float; the size of each registration file in MB.
+		size_spread: A float; the last subject of the manifest is this many times larger than the first, with the sizes of the others in between, so that the largest subjects come last.
+	Returns:
+		manifest_fname: The path of the manifest.
+	'''
+
+	parameters = [num_subjects, num_strains, file_size_mb, num_registrations, registration_size_mb, size_spread]
+	parameters_fname = os.path.join(data_dir, 'parameters.json')
+	manifest_fname = os.path.join(data_dir, 'SubjectMetadata.csv')
+
+	if os.path.exists(parameters_fname) and json.load(open(parameters_fname)) == parameters:
+		return manifest_fname
+
+	if os.path.isdir(data_dir):
+		shutil.rmtree(data_dir)
+	os.makedirs(data_dir)
+
+	rows = []
+	for subj_index in range(num_subjects):
+		strain = 'STRAIN%02d' % (subj_index * num_strains // num_subjects + 1)
+		subj_label = strain + '_%04d' % (subj_index + 1)
+		scale = 1.0 + (size_spread - 1.0) * subj_index / max(1, num_subjects - 1)
+
+		MINC_filename = os.path.join(data_dir, 'distortion_corrected', subj_label + '.mnc')
+		write_synthetic_minc(MINC_filename, int(scale * file_size_mb * 1024 * 1024))
+
+		processed_subj_dir = os.path.join(data_dir, 'processed', subj_label)
+		for registration_index in range(num_registrations):
+			folder = 'resampled' if registration_index % 2 == 0 else 'stats-volumes'
+			registration_fname = os.path.join(processed_subj_dir, folder, subj_label + '_registration_%02d.mnc' % registration_index)
+			write_synthetic_minc(registration_fname, int(scale * registration_size_mb * 1024 * 1024))
+		for folder in ['resampled', 'stats-volumes']:
+			if not os.path.isdir(os.path.join(processed_subj_dir, folder)):
+				os.makedirs(os.path.join(processed_subj_dir, folder))
+
+		rows.append({'Filename': MINC_filename, 'ProcessedFolder': processed_subj_dir, 'Genotype': 'WT', 'SubjLabel': subj_label, 'SubjNum': None,
+			'dob': None, 'gender': None, 'handedness': None, 'race': None, 'ethnicity': strain, 'weight': None, 'height': None})
+
+	columns = ['Filename', 'ProcessedFolder', 'Genotype', 'SubjLabel', 'SubjNum', 'dob', 'gender', 'handedness', 'race', 'ethnicity', 'weight', 'height']
+	pd.DataFrame(rows, columns=columns).to_csv(manifest_fname, index=False)
+
+	json.dump(parameters, open(parameters_fname, 'w'))
+
+	return manifest_fname
+
+
+def parse_command_line_args(argv):
+	'''
+	Summary:
+		Parses the command line arguments of the benchmark.  Arguments after -- are passed to the upload script (see SpredNonDicomUpload.parse_command_line_args).
+	Args:
+		argv: A list of command line arguments, excluding the script name.
+	Returns:
+		args: An argparse.Namespace with the parsed arguments; upload_argv holds the upload arguments as given, to pass on to the pass's process.
+		upload_args: An argparse.Namespace with the parsed upload arguments.
+	'''
+
+	upload_argv = []
+	if '--' in argv:
+		upload_argv = argv[argv.index('--') + 1:]
+		argv = argv[:argv.index('--')]
+
+	parser = argparse.ArgumentParser(description='Benchmark SpredNonDicomUpload.py against a local XNAT stand-in.  Upload options go after --.')
+	parser.add_argument('--subjects', dest='num_subjects', type=int, default=20, help='number of subjects (default: 20)')
+	parser.add_argument('--strains', dest='num_strains', type=int, default=2, help='number of strains (default: 2)')
+	parser.add_argument('--file-size', dest='file_size_mb', type=float, default=4.0, help='size of each distortion corrected file in MB (default: 4)')
+	parser.add_argument('--registrations', dest='num_registrations', type=int, default=6, help='number of registration files per subject (default: 6)')
+	parser.add_argument('--registration-size', dest='registration_size_mb', type=float, default=1.0, help='size of each registration file in MB (default: 1)')
+	parser.add_argument('--size-spread', dest='size_spread', type=float, default=1.0, help='make the last subject of the manifest this many times larger than the first, with the largest subjects last (default: 1)')
+	parser.add_argument('--passes', dest='num_passes', type=int, default=1, help='number of times to run the upload; later passes find the subjects already uploaded (default: 1)')
+	parser.add_argument('--latency', dest='latency_secs', type=float, default=0.0, help='seconds the mock adds to every request (default: 0)')
+	parser.add_argument('--bandwidth', dest='bandwidth_mb', type=float, default=None, help='upload bandwidth of the mock in MB/s (default: unlimited)')
+	parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='fraction of requests the mock answers with an error (default: 0)')
+	parser.add_argument('--error-status', dest='error_status', type=int, default=503, help='HTTP status of injected errors (default: 503)')
+	parser.add_argument('--work-dir', dest='work_dir', default='benchmark', help='directory for the dataset, logs and cache (default: benchmark)')
+	parser.add_argument('--results', dest='results_fname', default=None, help='append the results of every pass to this file as JSON lines, to track regressions')
+	parser.add_argument('--quiet', action='store_true', help="hide the upload script's messages")
+
+	args = parser.parse_args(argv)
+	args.upload_argv = upload_argv
+	upload_args = SpredNonDicomUpload.parse_command_line_args(upload_argv)
+
+	return args, upload_args
+
+
+def print_benchmark_report(results):
+	'''Prints the results of a benchmark pass.'''
+
+	print 'Pass %d: %d subjects in %.1f s' % (results['pass'], results['subjects'], results['elapsed_secs'])
+	print '    %.2f subjects/min, %.2f MB/s (%.1f MB of files, %.1f MB received by the server)' % (
+		results['subjects_per_min'], results['mb_per_sec'], results['file_mb'], results['received_mb'])
+	print '    %.1f requests per subject (%s), %d errors injected, %d failed subjects' % (
+		results['requests_per_subject'], ', '.join('%s %.1f' % (method.upper(), count) for method, count in sorted(results['requests_per_subject_by_method'].items())),
+		results['errors_injected'], results['failed_subjects'])
+	print '    peak RSS %.1f MB' % results['peak_rss_mb']
+
+
+def run_benchmark_pass(pass_num, args, upload_args, base_url, manifest_fname):
+	'''
+	Summary:
+		Runs upload_data once over the synthetic dataset in a new process (see run_upload_pass) and measures it.  Running every pass in a process of its own keeps the peak memory of a pass from including the earlier passes' or the benchmark's own.
+	Args:
+		pass_num: An integer; the number of the pass, starting at 1.
+		args: The benchmark's arguments, as returned by parse_command_line_args.
+		upload_args: The upload script's arguments.
+		base_url: The base url of the mock server's projects.
+		manifest_fname: The path of the manifest of the dataset.
+	Returns:
+		results: A dictionary of measurements.
+	'''
+
+	requests.delete(base_url + '_mock/stats')
+
+	pass_results_fname = os.path.abspath('benchmark_pass.json')
+	if os.path.isfile(pass_results_fname):
+		os.remove(pass_results_fname)
+
+	command = [sys.executable, os.path.abspath(__file__), '--upload-pass', base_url, manifest_fname, pass_results_fname, '--'] + args.upload_argv
+	stdout = open(os.devnull, 'w') if args.quiet else None
+	try:
+		return_code = subprocess.call(command, stdout=stdout)
+	finally:
+		if stdout is not None:
+			stdout.close()
+
+	if return_code != 0 or not os.path.isfile(pass_results_fname):
+		sys.exit('Pass %d of the upload failed (exit status %d)' % (pass_num, return_code))
+
+	pass_results = json.load(open(pass_results_fname))
+	os.remove(pass_results_fname)
+
+	mock_stats = get_mock_stats(base_url)
+	num_subjects = max(1, args.num_subjects)
+	elapsed_secs = pass_results['elapsed_secs']
+	file_mb = pass_results['bytes'] / (1024.0 * 1024.0)
+
+	results = {
+		'time': str(datetime.datetime.now()),
+		'pass': pass_num,
+		'upload_options': vars(upload_args),
+		'dataset': [args.num_subjects, args.num_strains, args.file_size_mb, args.num_registrations, args.registration_size_mb, args.size_spread],
+		'mock': {'latency_secs': args.latency_secs, 'bandwidth_mb': args.bandwidth_mb, 'error_rate': args.error_rate},
+		'subjects': pass_results['subjects'],
+		'failed_subjects': pass_results['failed_subjects'],
+		'elapsed_secs': elapsed_secs,
+		'subjects_per_min': pass_results['subjects'] * 60.0 / elapsed_secs,
+		'file_mb': file_mb,
+		'received_mb': mock_stats['bytes_received'] / (1024.0 * 1024.0),
+		'mb_per_sec': file_mb / elapsed_secs,
+		'requests_per_subject': mock_stats['requests'] / float(num_subjects),
+		'requests_per_subject_by_method': dict((method, mock_stats.get(method, 0) / float(num_subjects)) for method in ['get', 'put', 'post', 'delete']),
+		'errors_injected': mock_stats['errors_injected'],
+		'peak_rss_mb': pass_results['peak_rss_mb']
+	}
+
+	return results
+
+
+def run_upload_pass(argv):
+	'''
+	Summary:
+		Runs upload_data once over the synthetic dataset in this process, and writes what the benchmark needs of it to a JSON file: the subjects and bytes uploaded, the number of failed subjects, the time taken and the peak memory of this process.
+	Args:
+		argv: A list of command line arguments: the base url of the mock server's projects, the path of the manifest, the path of the JSON file to write, then the upload script's arguments after --.
+	'''
+
+	base_url, manifest_fname, pass_results_fname = argv[:3]
+	upload_args = SpredNonDicomUpload.parse_command_line_args(argv[argv.index('--') + 1:])
+
+	project_constants = SpredNonDicomUpload.init_project_constants('benchmark', 'benchmark')
+	SpredNonDicomUpload.apply_command_line_args(upload_args, project_constants)
+	project_constants['automatic_upload'] = True
+	project_constants['base_url'] = base_url
+	project_constants['subject_metadata_file'] = manifest_fname
+
+	start_time = time.time()
+	SpredNonDicomUpload.run_upload(project_constants, upload_args.resume)
+	elapsed_secs = max(time.time() - start_time, 1e-6)
+
+	pass_results = {
+		'subjects': project_constants['upload_stats']['subjects'],
+		'bytes': project_constants['upload_stats']['bytes'],
+		'failed_subjects': len(project_constants['dead_letters']),
+		'elapsed_secs': elapsed_secs,
+		'peak_rss_mb': get_peak_rss_mb()
+	}
+
+	with open(pass_results_fname, 'w') as pass_results_file:
+		json.dump(pass_results, pass_results_file)
+
+
+def start_mock_server(args):
+	'''
+	Summary:
+		Starts SpredMockServer.py in a separate process, so that its memory use isn't counted in the upload's, and waits until it answers.
+	Args:
+		args: The benchmark's arguments, as returned by parse_command_line_args.
+	Returns:
+		mock_process: The subprocess.Popen of the mock server.
+		base_url: The base url of the mock server's projects.
+	'''
+
+	# Find a free port.
+	port_socket = socket.socket()
+	port_socket.bind(('127.0.0.1', 0))
+	port = port_socket.getsockname()[1]
+	port_socket.close()
+
+	mock_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SpredMockServer.py')
+	command = [sys.executable, mock_server, '--port', str(port), '--latency', str(args.latency_secs),
+		'--error-rate', str(args.error_rate), '--error-status', str(args.error_status)]
+	if args.bandwidth_mb is not None:
+		command += ['--bandwidth', str(args.bandwidth_mb)]
+
+	mock_process = subprocess.Popen(command, stdout=open(os.devnull, 'w'))
+	base_url = 'http://127.0.0.1:%d/data/archive/projects/' % port
+
+	for attempt in range(100):
+		try:
+			get_mock_stats(base_url)
+			return mock_process, base_url
+		except requests.ConnectionError:
+			if mock_process.poll() is not None:
+				break
+			time.sleep(0.1)
+
+	mock_process.kill()
+	sys.exit('The mock server did not start')
+
+
+def write_synthetic_minc(file_name, size_bytes, chunk_size=1024*1024):
+	'''
+	Summary:
+		Writes a file that stands in for a MINC file: a NetCDF signature followed by blocks that alternate between random bytes and zeros, so that it compresses about as well as an image with a background.
+	Args:
+		file_name: A string path to the file to write.
+		size_bytes: An integer; the size of the file.
+		chunk_size: An integer; the size of the blocks.
+	'''
+
+	if not os.path.isdir(os.path.dirname(file_name)):
+		os.makedirs(os.path.dirname(file_name))
+
+	with open(file_name, 'wb') as minc_file:
+		minc_file.write(b'CDF\x01'[:size_bytes])
+		written = min(4, size_bytes)
+		block_num = 0
+		while written < size_bytes:
+			block_size = min(chunk_size, size_bytes - written)
+			minc_file.write(os.urandom(block_size) if block_num % 2 == 0 else b'\x00' * block_size)
+			written += block_size
+			block_num += 1
+
+
+def main():
+	'''
+	Summary:
+		Generates the dataset, starts the mock server, runs the benchmark passes and reports them.  Run with --upload-pass, runs a single pass instead (see run_upload_pass).
+	'''
+
+	if sys.argv[1:2] == ['--upload-pass']:
+		run_upload_pass(sys.argv[2:])
+		return
+
+	args, upload_args = parse_command_line_args(sys.argv[1:])
+
+	work_dir = os.path.abspath(args.work_dir)
+	manifest_fname = make_synthetic_dataset(os.path.join(work_dir, 'data'), args.num_subjects, args.num_strains,
+		args.file_size_mb, args.num_registrations, args.registration_size_mb, args.size_spread)
+	install_mincheader_stand_in(work_dir)
+
+	mock_process, base_url = start_mock_server(args)
+
+	# The logs, header cache and journal of the upload go in the work directory, and the first pass starts with a cold cache.
+	results_fname = os.path.abspath(args.results_fname) if args.results_fname else None
+	os.chdir(work_dir)
+	if os.path.isdir('cache'):
+		shutil.rmtree('cache')
+
+	try:
+		for pass_num in range(1, args.num_passes + 1):
+			results = run_benchmark_pass(pass_num, args, upload_args, base_url, manifest_fname)
+			print_benchmark_report(results)
+			if results_fname is not None:
+				with open(results_fname, 'a') as results_file:
+					results_file.write(json.dumps(results) + '\n')
+	finally:
+		mock_process.terminate()
+
+
+if __name__ == '__main__':
+
+	main()